@@ -0,0 +1,292 @@
+"""
+asyncio 机器人客户端
+与 CommonRobotGateway 相同的执行协议: 提交指令 -> 轮询指令完成 -> 检查实例状态
+一个后台事件循环同时跟踪进程内所有进行中的指令和数据库查询, 每次请求和查询都有超时,
+等待完成可设置总超时, 并可按实例取消(POST /debug/cancel/<instance_id>)
+同步接口 execute_robot_command 在事件循环中执行并等待结果, 规划流程无需修改
+
+配置 ROBOT_CLIENT_BACKEND 为 "asyncio" 开启, 依赖 aiohttp, 查询PostgreSQL时依赖 asyncpg, 只在开启时导入
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import threading
+import time
+
+import metrics
+import traffic_capture
+from common_robot_gateway import INSTANCE_FORCE_FAILED, SUBMIT_RETRIES
+from logger_handler import bind_log_context, create_logger
+from query_instance_status import db_params
+from robot_command import encode_commands
+from tracing import record_span, span
+
+log = create_logger("INFO", "AsyncRobotClient")
+
+# 单次HTTP请求超时(秒)
+REQUEST_TIMEOUT = 30
+
+# 单次实例状态查询超时(秒)
+DB_TIMEOUT = 10
+
+# 等待指令完成的最长时间(秒), 0表示不限制
+COMPLETION_TIMEOUT = 0
+
+
+class EventLoopThread:
+    """
+    后台事件循环线程, 进程内所有设备共用
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="robot-event-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro, timeout=None):
+        """
+        在事件循环中执行协程并等待结果, 协程继承调用方的日志上下文与任务追踪
+        超时后取消协程并抛出 concurrent.futures.TimeoutError
+        """
+        context = contextvars.copy_context()
+        result = concurrent.futures.Future()
+        holder = {}
+
+        def on_done(task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        def start():
+            task = self.loop.create_task(coro, context=context)
+            holder["task"] = task
+            task.add_done_callback(on_done)
+
+        self.loop.call_soon_threadsafe(start)
+        try:
+            return result.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.loop.call_soon_threadsafe(lambda: holder["task"].cancel() if "task" in holder else None)
+            raise
+
+
+_event_loop_thread = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop_thread():
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is None:
+            _event_loop_thread = EventLoopThread()
+        return _event_loop_thread
+
+
+class AsyncRobotClient:
+    """
+    robot: CommonRobotGateway, 复用其地址、设备编码、轮询间隔与请求体编码
+    """
+    def __init__(self, robot, request_timeout=None, db_timeout=None, completion_timeout=None):
+        import aiohttp
+        self.aiohttp = aiohttp
+        self.robot = robot
+        self.request_timeout = request_timeout or REQUEST_TIMEOUT
+        self.db_timeout = db_timeout or DB_TIMEOUT
+        self.completion_timeout = completion_timeout or COMPLETION_TIMEOUT
+        self.runner = get_event_loop_thread()
+        # 以下对象只在事件循环线程中创建和使用
+        self._session = None
+        self._pool = None
+        # 实例编号(字符串) -> 进行中的执行任务, 上游传入的实例编号可能是数字或字符串
+        self._inflight = {}
+
+    async def get_session(self):
+        if self._session is None:
+            self._session = self.aiohttp.ClientSession(timeout=self.aiohttp.ClientTimeout(total=self.request_timeout))
+        return self._session
+
+    async def get_pool(self):
+        if self._pool is None:
+            import asyncpg
+            self._pool = await asyncpg.create_pool(user=db_params["user"], password=db_params["password"],
+                                                   database=db_params["dbname"], host=db_params["host"],
+                                                   port=int(db_params["port"]), min_size=1, max_size=10,
+                                                   command_timeout=self.db_timeout)
+        return self._pool
+
+    async def check_instance_status(self, instance_id):
+        """
+        检查实例状态, SQLite 在线程中查询, PostgreSQL 使用连接池异步查询
+        """
+        start = time.perf_counter()
+        status = -1
+        try:
+            instance_status = self.robot.instance_status
+            if instance_status.sqlite_path is not None:
+                status = await asyncio.wait_for(
+                    asyncio.to_thread(instance_status.check_sqlite_instance_status, instance_id), self.db_timeout)
+            else:
+                pool = await self.get_pool()
+                # asyncpg 严格按类型绑定参数, 上游传入的实例编号可能是字符串
+                row = await asyncio.wait_for(pool.fetchrow("SELECT status FROM task_instance WHERE id = $1",
+                                                           int(instance_id)), self.db_timeout)
+                status = row["status"] if row is not None else -1
+        except asyncio.TimeoutError:
+            log.error("实例%s 状态查询超时(%s秒)", instance_id, self.db_timeout)
+        except Exception as e:
+            log.error("实例%s 状态查询失败: %s", instance_id, e)
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.DB_QUERY_SECONDS.observe(seconds)
+            traffic_capture.record("db.status", instance_id=instance_id, status=status, seconds=round(seconds, 6))
+        return status
+
+    async def submit(self, command, instance_id, pipeline_id, operation_counts, body):
+        """
+        提交指令, 失败按重试间隔重试, 返回 instruction_id, 失败返回None
+        """
+        robot = self.robot
+        session = await self.get_session()
+        for _ in range(SUBMIT_RETRIES):
+            headers = {"Content-Type": "application/json"}
+            if robot.request_gzip:
+                headers["Content-Encoding"] = "gzip"
+            submit_start = time.perf_counter()
+            try:
+                with span("robot.submit"):
+                    async with session.post(robot.robot_command_url, data=body, headers=headers) as response:
+                        status = response.status
+                        body = await response.json(content_type=None) if status != 415 else None
+                metrics.ROBOT_SUBMIT_SECONDS.observe(time.perf_counter() - submit_start)
+                log.info("调用机器人指定返回: %s", status)
+                if status == 415 and robot.request_gzip:
+                    log.error("上游不支持gzip压缩请求体, 改为不压缩发送")
+                    robot.request_gzip = False
+                    body = robot.prepare_request_body(command, instance_id, pipeline_id)
+                    continue
+                instruction_id = body.get("data", None) if isinstance(body, dict) else None
+                traffic_capture.record("robot.submit", instance_id=instance_id, pipeline_id=pipeline_id,
+                                       commands=len(command), operations=operation_counts,
+                                       bytes=robot.last_submit_metrics.get("wire_bytes"),
+                                       seconds=round(time.perf_counter() - submit_start, 6),
+                                       status=status, submitted_instruction_id=instruction_id,
+                                       body=encode_commands(command) if traffic_capture.capture_robot_body else None)
+                if status == 200 and instruction_id is not None:
+                    return instruction_id
+                log.error("调用机器人接口失败,%s秒后重试", robot.retry_interval)
+            except Exception as e:
+                traffic_capture.record("robot.submit", instance_id=instance_id, commands=len(command),
+                                       seconds=round(time.perf_counter() - submit_start, 6), error=repr(e))
+                log.error("调用机器人接口异常: %r, %s秒后重试", e, robot.retry_interval)
+            await asyncio.sleep(robot.retry_interval)
+        log.error("机器人接口调用失败, 已达重试次数上限%s次", SUBMIT_RETRIES)
+        return None
+
+    async def poll_instruction(self, instruction_id):
+        """
+        查询指令是否完成, 返回 True 完成, False 未完成或执行失败等待重试, None 查询失败
+        """
+        session = await self.get_session()
+        with span("robot.poll"):
+            async with session.get(self.robot.robot_callback_url + str(instruction_id)) as response:
+                json_data = await response.json(content_type=None)
+        rsp_data = json_data.get("data", None)
+        if rsp_data is None:
+            return None
+        callback_data = rsp_data.get("callbackData", "")
+        log.info("等待机器人回调%s", callback_data)
+        if callback_data == "" or callback_data is None:
+            return False
+        if json.loads(callback_data).get("code", 500) == 200:
+            return True
+        log.info("机器人执行失败,等待指令列表中指令重试")
+        return False
+
+    async def wait_completion(self, instruction_id, instance_id):
+        """
+        等待指令完成, 每轮同时查询实例状态与指令状态
+        """
+        submitted_at = time.perf_counter()
+        poll_count = 0
+        while True:
+            poll_count += 1
+            status, done = await asyncio.gather(self.check_instance_status(instance_id),
+                                                self.poll_instruction(instruction_id), return_exceptions=True)
+            if status == INSTANCE_FORCE_FAILED:
+                log.info("当前实例已经强制失败")
+                traffic_capture.record("robot.complete", seconds=round(time.perf_counter() - submitted_at, 6),
+                                       polls=poll_count, ok=False)
+                return False
+            if done is True:
+                break
+            if isinstance(done, Exception) or done is None:
+                log.info("查询机器人是否完成接口失败: %r, %s秒后重新查询", done, self.robot.retry_interval)
+                await asyncio.sleep(self.robot.retry_interval)
+                continue
+            await asyncio.sleep(self.robot.poll_interval)
+        log.info("当前指令执行完成")
+        completion_seconds = time.perf_counter() - submitted_at
+        metrics.ROBOT_COMPLETION_SECONDS.observe(completion_seconds)
+        traffic_capture.record("robot.complete", seconds=round(completion_seconds, 6), polls=poll_count, ok=True)
+        record_span("robot.wait", submitted_at, instruction_id=instruction_id, polls=poll_count)
+        metrics.ROBOT_POLL_COUNT.observe(poll_count)
+        return True
+
+    async def execute(self, command, instance_id, pipeline_id, operation_counts=None, body=None):
+        """
+        提交并等待指令完成, 可在事件循环中并发调用
+        按实例取消或超过等待时间时返回False
+        """
+        if body is None:
+            operation_counts, body = self.robot.begin_execution(command, instance_id, pipeline_id)
+        task = asyncio.current_task()
+        key = str(instance_id)
+        self._inflight.setdefault(key, set()).add(task)
+        try:
+            instruction_id = await self.submit(command, instance_id, pipeline_id, operation_counts, body)
+            if instruction_id is None:
+                return False
+            # 之后的日志关联到当前机器人指令
+            bind_log_context(instruction_id=instruction_id)
+            log.info("机器人指令已提交, instruction_id: %s", instruction_id)
+            if self.completion_timeout > 0:
+                return await asyncio.wait_for(self.wait_completion(instruction_id, instance_id), self.completion_timeout)
+            return await self.wait_completion(instruction_id, instance_id)
+        except asyncio.TimeoutError:
+            log.error("等待机器人指令完成超过%s秒", self.completion_timeout)
+            return False
+        finally:
+            tasks = self._inflight.get(key)
+            tasks.discard(task)
+            if len(tasks) == 0:
+                self._inflight.pop(key, None)
+
+    def cancel_instance(self, instance_id):
+        """
+        取消实例进行中的指令等待, 可在任意线程调用, 返回取消的任务数量
+        """
+        async def cancel():
+            tasks = list(self._inflight.get(str(instance_id), ()))
+            for task in tasks:
+                task.cancel()
+            return len(tasks)
+        return self.runner.run(cancel())
+
+    def execute_robot_command(self, command, instance_id, pipeline_id):
+        """
+        同步接口, 与 CommonRobotGateway.execute_robot_command_release 的返回值一致
+        请求体在调用线程中编码, 不占用事件循环
+        """
+        operation_counts, body = self.robot.begin_execution(command, instance_id, pipeline_id)
+        try:
+            return self.runner.run(self.execute(command, instance_id, pipeline_id, operation_counts, body))
+        except concurrent.futures.CancelledError:
+            log.error("实例%s 的机器人指令已取消", instance_id)
+            return False
@@ -0,0 +1,73 @@
+"""
+合成请求生成
+按台面布局生成容器上下文、移液参数和溶液交换参数, 供基准测试使用
+"""
+import random
+
+from deck_layout import DeckLayout
+
+# 移液量范围(uL)
+DEFAULT_VOLUME_RANGE = (50, 1000)
+
+# 排液量范围(uL), 超过1000时拆分为多次吸液
+DEFAULT_DISCHARGE_RANGE = (200, 2500)
+
+
+def build_context(deck: DeckLayout, rng: random.Random, fill=1.0, instance_id=1, pipeline_id=1):
+    """
+    生成容器上下文, 每个样品架作为一个容器组
+    fill: 每个样品架上放置容器的比例
+    """
+    groups = []
+    for rack in deck.racks:
+        count = max(0, min(rack.capacity, round(rack.capacity * fill)))
+        logic_nos = sorted(rng.sample(range(1, rack.capacity + 1), count))
+        groups.append({
+            "containers": [{"containerTypeCode": rack.container_type_code, "logicNo": logic_no} for logic_no in logic_nos]
+        })
+    return {"pipelineId": pipeline_id, "instanceId": instance_id, "containers": groups}
+
+
+def build_liquid_handling_param(deck: DeckLayout, rng: random.Random, sources=None, volume_range=DEFAULT_VOLUME_RANGE):
+    """
+    生成移液参数, 每个样品架使用同一组原液瓶
+    sources: 使用的原液瓶数量, 为空时使用全部原液瓶
+    """
+    bottle_nos = [bottle.no for bottle in deck.bottles]
+    if sources is not None and sources < len(bottle_nos):
+        bottle_nos = sorted(rng.sample(bottle_nos, sources))
+    param = {}
+    for rack in deck.racks:
+        param[rack.operate_param] = {
+            "operateList": [{"originalSolutionBottle": bottle_no,
+                             "originalSolutionVolume": rng.randint(*volume_range)} for bottle_no in bottle_nos]
+        }
+    return param
+
+
+def build_exchange_param(deck: DeckLayout, rng: random.Random, sources=None, overrides=0, cycle_count=1,
+                         sleep_time=0, volume_range=DEFAULT_VOLUME_RANGE, discharge_range=DEFAULT_DISCHARGE_RANGE):
+    """
+    生成溶液交换参数, 包含排液量和移液参数
+    overrides: 每个样品架单独指定排液量的位置数量
+    """
+    param = build_liquid_handling_param(deck, rng, sources, volume_range)
+    for rack in deck.racks:
+        locations = rng.sample(range(1, rack.capacity + 1), min(overrides, rack.capacity))
+        param[rack.exchange_param] = {
+            "defalut_rack_info": rng.randint(*discharge_range),
+            "specified_volume": [{"location": location, "volume": rng.randint(*discharge_range)} for location in locations]
+        }
+    param["cycleCount"] = cycle_count
+    param["time"] = sleep_time
+    return param
+
+
+def build_request(task_id, param, context=None):
+    """
+    组装网关请求体
+    """
+    body = {"id": task_id, "param": param}
+    if context is not None:
+        body["context"] = context
+    return body
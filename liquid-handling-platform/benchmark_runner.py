@@ -0,0 +1,217 @@
+"""
+端到端基准测试
+按请求比例驱动网关, 通过模拟服务等待任务回调, 统计吞吐量、延迟分位数和机器人空闲时间
+
+python robot_simulator.py --time-scale 0.001
+LIQUID_HANDLING_SETTINGS=settings_simulator.json python liquid_handling_platform_server.py
+python benchmark_runner.py --tasks 50 --mix liquid=6,exchange=1,tips=2,stock=1
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+import requests
+
+from bench_workload import build_context, build_exchange_param, build_liquid_handling_param, build_request
+from deck_layout import DeckLayout
+
+# 请求类型 -> (接口, 是否异步回调)
+REQUEST_KINDS = {
+    "liquid": ("/setLiquidHandlingInfo", True),
+    "exchange": ("/setSolutionExchengeInfo", True),
+    "tips": ("/getTipsCount", False),
+    "stock": ("/getStockSolutionInfo", False)
+}
+
+DEFAULT_MIX = "liquid=6,exchange=1,tips=2,stock=1"
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"未知的请求类型: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values, percent):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(percent / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    if len(values) == 0:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p90": round(percentile(values, 90), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4)
+    }
+
+
+class BenchmarkRunner:
+    def __init__(self, gateway_url, simulator_url, deck, rng, timeout=600.0, tip_threshold=96,
+                 fill=1.0, sources=None, overrides=2, cycle_count=1):
+        self.gateway_url = gateway_url.rstrip("/")
+        self.simulator_url = simulator_url.rstrip("/")
+        self.deck = deck
+        self.rng = rng
+        self.timeout = timeout
+        self.tip_threshold = tip_threshold
+        self.fill = fill
+        self.sources = sources
+        self.overrides = overrides
+        self.cycle_count = cycle_count
+        self.session = requests.Session()
+        self.next_task_id = int(time.time() * 1000)
+        # 请求类型 -> 接收耗时/端到端耗时列表
+        self.accept_seconds = {}
+        self.complete_seconds = {}
+        self.failures = {}
+
+    def new_task_id(self):
+        self.next_task_id += 1
+        return self.next_task_id
+
+    def post_gateway(self, path, body):
+        start = time.time()
+        response = self.session.post(self.gateway_url + path, data=json.dumps(body),
+                                     headers={"Content-Type": "application/json"}, timeout=self.timeout)
+        return start, time.time() - start, response.json()
+
+    def wait_callback(self, task_id, since):
+        """
+        等待模拟服务收到任务回调, 返回回调内容和接收时间
+        """
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            callbacks = self.session.get(self.simulator_url + "/sim/callbacks", params={"since": since}).json()
+            for callback in callbacks:
+                if callback["body"].get("id") == task_id:
+                    return callback
+            time.sleep(0.05)
+        return None
+
+    def ensure_tips(self):
+        _, _, response = self.post_gateway("/getTipsCount", build_request(self.new_task_id(), {}))
+        if (response.get("data") or {}).get("tipsCount", 0) >= self.tip_threshold:
+            return
+        task_id = self.new_task_id()
+        start, _, _ = self.post_gateway("/resetTipBoxs", build_request(task_id, {}))
+        self.wait_callback(task_id, start)
+
+    def build_body(self, kind, task_id):
+        if kind == "liquid":
+            param = build_liquid_handling_param(self.deck, self.rng, self.sources)
+        elif kind == "exchange":
+            param = build_exchange_param(self.deck, self.rng, self.sources, self.overrides, self.cycle_count)
+        else:
+            return build_request(task_id, {})
+        context = build_context(self.deck, self.rng, self.fill, instance_id=task_id, pipeline_id=1)
+        return build_request(task_id, param, context)
+
+    def run_one(self, kind):
+        path, is_async = REQUEST_KINDS[kind]
+        if is_async:
+            self.ensure_tips()
+        task_id = self.new_task_id()
+        start, accept_seconds, response = self.post_gateway(path, self.build_body(kind, task_id))
+        self.accept_seconds.setdefault(kind, []).append(accept_seconds)
+        if response.get("code") != 200:
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            return
+        if not is_async:
+            self.complete_seconds.setdefault(kind, []).append(accept_seconds)
+            return
+        callback = self.wait_callback(task_id, start)
+        if callback is None or callback["body"].get("code") != 200:
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            return
+        self.complete_seconds.setdefault(kind, []).append(callback["received_at"] - start)
+
+    def run(self, tasks, mix):
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        self.session.post(self.simulator_url + "/sim/reset")
+        start = time.time()
+        for _ in range(tasks):
+            self.run_one(self.rng.choices(kinds, weights)[0])
+        elapsed = time.time() - start
+        robot = self.session.get(self.simulator_url + "/sim/stats").json()
+        completed = sum(len(values) for values in self.complete_seconds.values())
+        return {
+            "tasks": tasks,
+            "completed": completed,
+            "failures": self.failures,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_per_minute": round(completed / elapsed * 60, 3) if elapsed > 0 else 0.0,
+            "accept_latency": {kind: summarize(values) for kind, values in self.accept_seconds.items()},
+            "complete_latency": {kind: summarize(values) for kind, values in self.complete_seconds.items()},
+            "robot": {
+                "busy_seconds": robot["busy_seconds"],
+                "idle_seconds": robot["idle_seconds"],
+                "utilization": robot["utilization"],
+                "instructions": robot["instructions"],
+                "commands": robot["commands"],
+                "robot_seconds": robot["robot_seconds"]
+            }
+        }
+
+
+def print_report(report):
+    print(f"任务 {report['completed']}/{report['tasks']} 完成, 耗时 {report['elapsed_seconds']}s, "
+          f"吞吐量 {report['throughput_per_minute']} 个/分钟, 失败 {report['failures']}")
+    for kind, stats in report["complete_latency"].items():
+        if stats["count"] == 0:
+            continue
+        accept = report["accept_latency"].get(kind, {})
+        print(f"  {kind:<8} n={stats['count']:<4} p50={stats['p50']:.3f}s p90={stats['p90']:.3f}s "
+              f"p99={stats['p99']:.3f}s max={stats['max']:.3f}s 接收p99={accept.get('p99', 0):.3f}s")
+    robot = report["robot"]
+    print(f"  机器人 繁忙 {robot['busy_seconds']}s 空闲 {robot['idle_seconds']}s 利用率 {robot['utilization']:.2%} "
+          f"指令 {robot['instructions']} 条({robot['commands']} 个动作, 估计 {robot['robot_seconds']}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="液体处理网关端到端基准测试")
+    parser.add_argument("--gateway", default="http://127.0.0.1:6001", help="网关地址")
+    parser.add_argument("--simulator", default="http://127.0.0.1:18080", help="模拟服务地址")
+    parser.add_argument("--tasks", type=int, default=20, help="请求数量")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="请求比例, 如 liquid=6,exchange=1,tips=2,stock=1")
+    parser.add_argument("--fill", type=float, default=0.5, help="样品架容器放置比例")
+    parser.add_argument("--sources", type=int, default=3, help="每个请求使用的原液瓶数量, 0表示全部")
+    parser.add_argument("--overrides", type=int, default=2, help="每个样品架单独指定排液量的位置数量")
+    parser.add_argument("--cycles", type=int, default=1, help="溶液交换循环次数")
+    parser.add_argument("--tip-threshold", type=int, default=96, help="剩余Tip头低于该数量时重置")
+    parser.add_argument("--timeout", type=float, default=600.0, help="单个任务最长等待时间(秒)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--settings", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"),
+                        help="读取台面布局的配置文件")
+    parser.add_argument("--output", help="结果JSON输出文件")
+    args = parser.parse_args()
+
+    with open(args.settings, "r", encoding="utf-8") as f:
+        deck = DeckLayout(json.load(f).get("DECK_LAYOUT"))
+    runner = BenchmarkRunner(args.gateway, args.simulator, deck, random.Random(args.seed), args.timeout,
+                             args.tip_threshold, args.fill, args.sources or None, args.overrides, args.cycles)
+    report = runner.run(args.tasks, parse_mix(args.mix))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+任务回调发件箱
+回调先写入SQLite再由后台线程投递, 任务线程不再等待上游响应
+每个回调地址一个投递线程, 多个地址并行投递, 失败按指数退避重试, 重启后继续投递未完成的回调
+"""
+import json
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+
+import metrics
+import traffic_capture
+from logger_handler import create_logger
+
+log = create_logger("INFO", "CallbackOutbox")
+
+# 首次重试间隔(秒)
+BASE_RETRY_DELAY = 1.0
+
+# 最大重试间隔(秒)
+MAX_RETRY_DELAY = 300.0
+
+# 单次投递超时时间(秒)
+DELIVERY_TIMEOUT = 10.0
+
+
+class CallbackOutbox:
+    """
+    回调发件箱
+    targets: 回调地址名称 -> URL, URL为空的地址不投递
+    max_attempts: 最多投递次数, 0表示一直重试
+    """
+    def __init__(self, path, targets, timeout=DELIVERY_TIMEOUT, base_delay=BASE_RETRY_DELAY,
+                 max_delay=MAX_RETRY_DELAY, max_attempts=0):
+        self.path = path
+        self.targets = {name: url for name, url in targets.items() if url}
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._wakeups = {name: threading.Event() for name in self.targets}
+        self._threads = {}
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    task_id TEXT,
+                    payload TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    last_error TEXT
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (target, next_attempt, id)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        """
+        启动投递线程, 重复调用不会重复启动
+        """
+        with self._lock:
+            for name in self.targets:
+                if name in self._threads:
+                    continue
+                thread = threading.Thread(target=self._deliver_loop, args=(name,), name=f"callback-{name}", daemon=True)
+                self._threads[name] = thread
+                thread.start()
+
+    def enqueue(self, task_id, payload):
+        """
+        写入回调, 返回写入的记录数
+        """
+        if len(self.targets) == 0:
+            return 0
+        text = json.dumps(payload, ensure_ascii=False)
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO outbox (target, task_id, payload, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                [(name, str(task_id), text, now, now) for name in self.targets])
+        for event in self._wakeups.values():
+            event.set()
+        return len(self.targets)
+
+    def pending_counts(self):
+        """
+        各回调地址待投递数量, 只统计当前配置的地址
+        已移除的地址的记录保留在文件中, 重新配置该地址后继续投递
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT target, COUNT(*) FROM outbox GROUP BY target").fetchall()
+        counts = {name: 0 for name in self.targets}
+        counts.update((name, count) for name, count in rows if name in counts)
+        return counts
+
+    def get_pending_metrics(self):
+        return [((name,), count) for name, count in self.pending_counts().items()]
+
+    def retry_delay(self, attempts):
+        """
+        指数退避并加入随机抖动, 避免多个回调同时重试
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _next_due(self, conn, target):
+        return conn.execute("SELECT id, task_id, payload, created, attempts, next_attempt FROM outbox "
+                            "WHERE target = ? ORDER BY next_attempt, id LIMIT 1", (target,)).fetchone()
+
+    def _deliver_loop(self, target):
+        url = self.targets[target]
+        wakeup = self._wakeups[target]
+        session = requests.Session()
+        conn = self._connect()
+        while True:
+            try:
+                row = self._next_due(conn, target)
+                if row is None:
+                    wakeup.wait()
+                    wakeup.clear()
+                    continue
+                row_id, task_id, payload, created, attempts, next_attempt = row
+                wait_seconds = next_attempt - time.time()
+                if wait_seconds > 0:
+                    # 等待到期或有新回调写入
+                    wakeup.wait(wait_seconds)
+                    wakeup.clear()
+                    continue
+                self._deliver(conn, session, target, url, row_id, task_id, payload, created, attempts)
+            except Exception as e:
+                log.error("回调投递线程异常 %s: %s", target, e)
+                time.sleep(self.base_delay)
+
+    def _deliver(self, conn, session, target, url, row_id, task_id, payload, created, attempts):
+        start = time.perf_counter()
+        error = None
+        status = None
+        try:
+            response = session.post(url=url, headers={"Content-Type": "application/json"},
+                                    data=payload.encode("utf-8"), timeout=self.timeout)
+            status = response.status_code
+            body = response.json()
+            log.info("回调 %s 任务%s 返回: %s", url, task_id, body)
+            if status != 200 or body.get("code") != 200:
+                error = f"status:{status} body:{body}"
+        except Exception as e:
+            error = str(e)
+        traffic_capture.record("callback", target=target, callback_task_id=task_id,
+                               seconds=round(time.perf_counter() - start, 6), status=status, error=error)
+
+        attempts += 1
+        if error is None:
+            with conn:
+                conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            metrics.CALLBACK_DELIVERY_SECONDS.observe(time.time() - created, target)
+            return
+        if self.max_attempts > 0 and attempts >= self.max_attempts:
+            log.error("回调 %s 任务%s 已重试%s次, 放弃投递: %s", url, task_id, attempts, error)
+            metrics.CALLBACK_FAILURES.inc(1, target)
+            with conn:
+                conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            return
+        delay = self.retry_delay(attempts)
+        log.error("回调 %s 任务%s 第%s次投递失败, %.1f秒后重试: %s", url, task_id, attempts, delay, error)
+        metrics.CALLBACK_RETRIES.inc(1, target)
+        with conn:
+            conn.execute("UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                         (attempts, time.time() + delay, error, row_id))
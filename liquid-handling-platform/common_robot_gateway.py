@@ -3,20 +3,52 @@
 """
 
 import json
+import logging
 import time
+import zlib
 import requests
-from logger_handler import create_logger
+import metrics
+import traffic_capture
+from tracing import record_span, span, traced
+from logger_handler import bind_log_context, create_dump_logger, create_logger
 from query_instance_status import QueryInstanceStatus
+from robot_command import CommandSummary, RobotCommand, encode_command, encode_commands
 log = create_logger("INFO", "CommonRobotGateway")
+dump_log = create_dump_logger()
 
 is_debug = False
 
+# 编码请求体时每段的大致字节数, 开启gzip时逐段压缩
+ENCODE_CHUNK_SIZE = 16 * 1024
+
+# 等待机器人完成时的查询间隔(秒)
+POLL_INTERVAL = 10
+
+# 调用失败后的重试间隔(秒)
+RETRY_INTERVAL = 5
+
+# 提交指令最多尝试次数
+SUBMIT_RETRIES = 20
+
+# 实例已被强制失败的状态值
+INSTANCE_FORCE_FAILED = 260
+
 class CommonRobotGateway():
-    def __init__(self, robot_command_url, robot_callback_url, robot_id, machine_code):
+    def __init__(self, robot_command_url, robot_callback_url, robot_id, machine_code, request_gzip=False):
         self.robot_command_url = robot_command_url
         self.robot_callback_url = robot_callback_url
         self.robot_id = robot_id
         self.machine_code = machine_code
+        # 上游支持时使用gzip压缩请求体
+        self.request_gzip = request_gzip
+        # 最近一次提交的请求体大小与编码耗时
+        self.last_submit_metrics = {}
+        self.poll_interval = POLL_INTERVAL
+        self.retry_interval = RETRY_INTERVAL
+        # asyncio 客户端, 为空时使用同步实现
+        self.async_client = None
+        # 实例状态数据库, 默认查询PostgreSQL, 由网关按配置替换
+        self.instance_status = QueryInstanceStatus()
 
     """
     生成机器人move指令
@@ -30,24 +62,97 @@ class CommonRobotGateway():
         instance_id: 实例编号
         pipline_id: 流水线编号
         """
-        source = {
-            slot_type : source_no,
-            "workstation": source_name
-        }
-        target = {
-            slot_type : target_no,
-            "workstation": target_name
-        }
-        operation = {
-            "operation": "move",
-            "containerTypeCode": container_type,
-            "source": source,
-            "target": target
+        return RobotCommand("move", source_name, slot_type, source_no, target_name, slot_type, target_no,
+                            container_type=container_type)
+
+    def iter_request_body(self, command, instance_id, pipeline_id):
+        """
+        指令列表在提交时才编码为机器人接口格式, 按段逐段生成
+        """
+        yield ('{"identifyingCode":' + json.dumps(self.machine_code)
+               + ',"instanceId":' + json.dumps(instance_id)
+               + ',"param":[').encode("utf-8")
+        buffer = []
+        size = 0
+        for index, item in enumerate(command):
+            fragment = encode_command(item)
+            if index > 0:
+                fragment = "," + fragment
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= ENCODE_CHUNK_SIZE:
+                yield "".join(buffer).encode("utf-8")
+                buffer.clear()
+                size = 0
+        buffer.append('],"pipelineId":' + json.dumps(pipeline_id)
+                      + ',"robotId":' + json.dumps(self.robot_id) + '}')
+        yield "".join(buffer).encode("utf-8")
+
+    @traced("robot.encode")
+    def prepare_request_body(self, command, instance_id, pipeline_id):
+        """
+        编码(并压缩)请求体, 返回完整的请求体, 重试时复用, 提交时不再复制
+        同时记录请求体大小与编码耗时
+        """
+        start = time.perf_counter()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if self.request_gzip else None
+        chunks = []
+        raw_bytes = 0
+        for chunk in self.iter_request_body(command, instance_id, pipeline_id):
+            raw_bytes += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            chunks.append(chunk)
+        if compressor is not None:
+            chunks.append(compressor.flush())
+        body = b"".join(chunks)
+
+        self.last_submit_metrics = {
+            "commands": len(command),
+            "raw_bytes": raw_bytes,
+            "wire_bytes": len(body),
+            "encode_ms": round((time.perf_counter() - start) * 1000, 3),
+            "gzip": compressor is not None
         }
-        return operation
+        metrics.ROBOT_SUBMIT_BYTES.observe(self.last_submit_metrics["wire_bytes"])
+        log.info("请求体编码完成: %s", self.last_submit_metrics)
+        return body
+
+    @traced("robot.submit")
+    def submit_request_body(self, body):
+        headers = { "Content-Type": "application/json" }
+        if self.request_gzip:
+            headers["Content-Encoding"] = "gzip"
+        start = time.perf_counter()
+        try:
+            return requests.post(url=self.robot_command_url, headers=headers, data=body)
+        finally:
+            metrics.ROBOT_SUBMIT_SECONDS.observe(time.perf_counter() - start)
+
+    def use_async_backend(self, request_timeout=None, db_timeout=None, completion_timeout=None):
+        """
+        改用 asyncio 客户端执行指令, 同步接口不变
+        """
+        from async_robot_client import AsyncRobotClient
+        self.async_client = AsyncRobotClient(self, request_timeout, db_timeout, completion_timeout)
+
+    def cancel_instance(self, instance_id):
+        """
+        取消实例进行中的指令等待, 指令执行返回失败, 返回取消的任务数量
+        只有 asyncio 客户端支持, 否则返回None
+        """
+        if self.async_client is None:
+            return None
+        return self.async_client.cancel_instance(instance_id)
 
     def execute_robot_command(self, command, instance_id, pipeline_id):
-        return self.execute_robot_command_debug(command, instance_id, pipeline_id) if is_debug else self.execute_robot_command_release(command, instance_id, pipeline_id)
+        if is_debug:
+            return self.execute_robot_command_debug(command, instance_id, pipeline_id)
+        if self.async_client is not None:
+            return self.async_client.execute_robot_command(command, instance_id, pipeline_id)
+        return self.execute_robot_command_release(command, instance_id, pipeline_id)
 
     def execute_robot_command_debug(self, command, instance_id, pipeline_id):
         log.info("调试拆分命令:")
@@ -58,32 +163,52 @@ class CommonRobotGateway():
             if ret is False:
                 log.error("执行机械臂命令失败")
                 return False
+    def begin_execution(self, command, instance_id, pipeline_id):
+        """
+        提交前的统计与编码, 同步与 asyncio 客户端共用
+        返回 (各类操作数量, 请求体)
+        """
+        summary = CommandSummary(command)
+        log.info("执行机械臂命令: %s", summary)
+        metrics.PLAN_COMMANDS.observe(len(command))
+        operation_counts = summary.counts()
+        for operation, count in operation_counts.items():
+            metrics.PLAN_OPERATIONS.inc(count, operation)
+        if dump_log.isEnabledFor(logging.DEBUG):
+            dump_log.debug("实例%s 指令内容: %s", instance_id, encode_commands(command))
+        return operation_counts, self.prepare_request_body(command, instance_id, pipeline_id)
+
     def execute_robot_command_release(self, command, instance_id, pipeline_id):
-        log.info("执行机械臂命令:")
-        log.info(command)
-        data = {
-            "identifyingCode": self.machine_code,
-            "instanceId": instance_id,
-            "param": command,
-            "pipelineId": pipeline_id,
-            "robotId": self.robot_id,
-        }
-        headers = { "Content-Type": "application/json" }
-        retry_count = 20
+        operation_counts, body = self.begin_execution(command, instance_id, pipeline_id)
+        retry_count = SUBMIT_RETRIES
         while retry_count > 0:
+            submit_start = time.perf_counter()
             try:
-                response = requests.post(url=self.robot_command_url, headers=headers, data=json.dumps(data))
-                log.info(f"调用机器人指定返回: {response}")
+                response = self.submit_request_body(body)
+                log.info("调用机器人指定返回: %s", response)
+                if response.status_code == 415 and self.request_gzip:
+                    log.error("上游不支持gzip压缩请求体, 改为不压缩发送")
+                    self.request_gzip = False
+                    body = self.prepare_request_body(command, instance_id, pipeline_id)
+                    continue
                 instruction_id = response.json().get("data", None)
+                traffic_capture.record("robot.submit", instance_id=instance_id, pipeline_id=pipeline_id,
+                                       commands=len(command), operations=operation_counts,
+                                       bytes=self.last_submit_metrics.get("wire_bytes"),
+                                       seconds=round(time.perf_counter() - submit_start, 6),
+                                       status=response.status_code, submitted_instruction_id=instruction_id,
+                                       body=encode_commands(command) if traffic_capture.capture_robot_body else None)
                 if response.status_code != 200 or instruction_id is None:
-                    log.error("调用机器人接口失败,5秒后重试")
-                    time.sleep(5)
+                    log.error("调用机器人接口失败,%s秒后重试", self.retry_interval)
+                    time.sleep(self.retry_interval)
                     continue
                 else:
                     break
             except Exception as e:
-                log.error(f"调用机器人接口异常: {e}, 5秒后重试")
-                time.sleep(5)
+                traffic_capture.record("robot.submit", instance_id=instance_id, commands=len(command),
+                                       seconds=round(time.perf_counter() - submit_start, 6), error=str(e))
+                log.error(f"调用机器人接口异常: {e}, {self.retry_interval}秒后重试")
+                time.sleep(self.retry_interval)
             finally:
                 retry_count -= 1
 
@@ -95,23 +220,33 @@ class CommonRobotGateway():
             log.info("调用机器人接口失败")
             return False
 
+        # 之后的日志关联到当前机器人指令
+        bind_log_context(instruction_id=instruction_id)
+        log.info("机器人指令已提交, instruction_id: %s", instruction_id)
+
+        submitted_at = time.perf_counter()
+        poll_count = 0
         while True:
-            result = QueryInstanceStatus.check_instance_status(instance_id)
-            if result == 260:
+            result = self.instance_status.check_instance_status(instance_id)
+            if result == INSTANCE_FORCE_FAILED:
                 log.info("当前实例已经强制失败")
+                traffic_capture.record("robot.complete", seconds=round(time.perf_counter() - submitted_at, 6),
+                                       polls=poll_count, ok=False)
                 return False
 
             try:
-                response = requests.get(url=(self.robot_callback_url + str(instruction_id)))
+                poll_count += 1
+                with span("robot.poll"):
+                    response = requests.get(url=(self.robot_callback_url + str(instruction_id)))
                 """判断机器人是否完成动作"""
                 json_data = response.json()
                 rsp_data = json_data.get("data", None)
 
                 if rsp_data is not None:
                     callback_data = rsp_data.get("callbackData", "")
-                    log.info(f"等待机器人回调{callback_data}")
+                    log.info("等待机器人回调%s", callback_data)
                     if callback_data == "" or callback_data is None:
-                        time.sleep(10)
+                        time.sleep(self.poll_interval)
                         continue
                     callback_json = json.loads(callback_data)
                     code = callback_json.get("code", 500)
@@ -119,15 +254,21 @@ class CommonRobotGateway():
                         log.info("当前指令执行完成")
                     else:
                         log.info("机器人执行失败,等待指令列表中指令重试")
-                        time.sleep(10)
+                        time.sleep(self.poll_interval)
                         continue
                 else:
                     log.info("查询机器人是否完成接口失败")
-                    time.sleep(5)
+                    time.sleep(self.retry_interval)
                     continue
                 break
             except Exception as e:
-                log.info("查询异常,5秒后重新查询")
-                time.sleep(5)
+                log.info("查询异常,%s秒后重新查询", self.retry_interval)
+                time.sleep(self.retry_interval)
                 log.error(e)
+        completion_seconds = time.perf_counter() - submitted_at
+        metrics.ROBOT_COMPLETION_SECONDS.observe(completion_seconds)
+        traffic_capture.record("robot.complete", commands=len(command), seconds=round(completion_seconds, 6),
+                               polls=poll_count, ok=True)
+        record_span("robot.wait", submitted_at, instruction_id=instruction_id, polls=poll_count)
+        metrics.ROBOT_POLL_COUNT.observe(poll_count)
         return True
\ No newline at end of file
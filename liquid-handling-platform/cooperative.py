@@ -0,0 +1,102 @@
+"""
+协作式运行模式(gevent)
+开启后对标准库打补丁: 任务线程、心跳、回调投递都变为greenlet,
+time.sleep 与 requests 的网络等待让出执行权, 大量并发等待只占用很少内存
+PostgreSQL 查询通过 psycopg2 等待回调变为非阻塞, 无法让出的阻塞调用(如SQLite)放到gevent线程池执行
+
+开启方式: 配置 COOPERATIVE_MODE 为 true, 或环境变量 LIQUID_HANDLING_COOPERATIVE=1
+入口脚本需在导入其他模块之前调用 init(), 否则已导入的模块仍使用未打补丁的阻塞实现
+"""
+import importlib
+import json
+import os
+import sys
+
+DEFAULT_SETTINGS = os.path.abspath(os.path.join(os.path.dirname(__file__), "settings.json"))
+
+# 是否已开启协作模式, 由 init 设置
+cooperative_enable = False
+
+
+def settings_argument(default):
+    """
+    命令行 --settings 指定的配置文件, 入口脚本解析参数之前使用
+    """
+    argv = sys.argv[1:]
+    for index, arg in enumerate(argv):
+        if arg == "--settings" and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith("--settings="):
+            return arg.split("=", 1)[1]
+    return default
+
+
+def is_enabled(settings_path):
+    env = os.environ.get("LIQUID_HANDLING_COOPERATIVE")
+    if env is not None:
+        return env.strip().lower() in ("1", "true", "yes", "on")
+    try:
+        with open(settings_path, "r", encoding="utf-8") as f:
+            return bool(json.load(f).get("COOPERATIVE_MODE", False))
+    except (OSError, ValueError):
+        return False
+
+
+def init(settings_path=DEFAULT_SETTINGS):
+    """
+    按配置开启协作模式, 返回是否已开启
+    """
+    global cooperative_enable
+    if cooperative_enable or not is_enabled(settings_path):
+        return cooperative_enable
+    from gevent import monkey
+    monkey.patch_all()
+    patch_psycopg()
+    cooperative_enable = True
+    return True
+
+
+def patch_psycopg():
+    """
+    psycopg2 等待数据库响应时让出执行权
+    """
+    try:
+        from psycopg2 import extensions
+    except ImportError:
+        return
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state!r}")
+
+
+def run_blocking(function, *args):
+    """
+    在gevent线程池中执行无法让出的阻塞调用, 未开启协作模式时直接调用
+    """
+    if not cooperative_enable:
+        return function(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(function, args)
+
+
+def original(module_name, name):
+    """
+    打补丁之前的原始实现, 例如需要真实线程的采样分析器
+    """
+    if cooperative_enable:
+        from gevent import monkey
+        return monkey.get_original(module_name, name)
+    return getattr(importlib.import_module(module_name), name)
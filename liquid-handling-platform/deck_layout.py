@@ -0,0 +1,191 @@
+"""
+台面布局模型
+原液瓶槽位、样品架偏移、容量与指令字符串统一由配置描述
+启动时加载一次并预先生成查找表, 规划流程只做 O(1) 查表
+"""
+
+# 默认台面布局, 可通过 settings.json 中的 DECK_LAYOUT 覆盖
+DEFAULT_DECK_LAYOUT = {
+    # 物料站原液瓶, 按编号顺序排列 (编号从1开始)
+    "SOURCE_BOTTLES": [
+        {"spec": "4ml", "count": 2, "lidStation": True},
+        {"spec": "50ml", "count": 8},
+        {"spec": "100ml", "count": 2}
+    ],
+    # 样品架, 顺序即容器收集顺序
+    "SAMPLE_RACKS": [
+        {"containerTypeCode": "container_sample_3_4ml", "size": "4ml", "offset": 28, "capacity": 14,
+         "operateParam": "param4mlRack3", "exchangeParam": "solutionExchangeInfoRack3"},
+        {"containerTypeCode": "container_sample_2_4ml", "size": "4ml", "offset": 14, "capacity": 14,
+         "operateParam": "param4mlRack2", "exchangeParam": "solutionExchangeInfoRack2"},
+        {"containerTypeCode": "container_sample_1_4ml", "size": "4ml", "offset": 0, "capacity": 14,
+         "operateParam": "param4mlRack1", "exchangeParam": "solutionExchangeInfoRack1"},
+        {"containerTypeCode": "container_bottle_20ml", "size": "20ml", "offset": 0, "capacity": 8,
+         "operateParam": "param20mlRack1", "exchangeParam": "solutionExchangeInfoRack4"}
+    ],
+    # 每种规格的开盖工位数量 (一批最多同时开盖的容器数)
+    "LID_CAPACITY": {
+        "4ml": 12,
+        "20ml": 8
+    }
+}
+
+# 样品架规格对应的机器人指令/容器/槽位类型
+SAMPLE_SIZE_COMMANDS = {
+    "4ml": {
+        "container": "container_4ml",
+        "container_no_lid": "container_4ml",
+        "slot": "slot_4ml_position",
+        "open": "open_slot_4ml",
+        "close": "close_slot_4ml",
+        "suck": "suck_from_4ml",
+        "drop": "drip_to_slot_4ml"
+    },
+    "20ml": {
+        "container": "container_20ml",
+        "container_no_lid": "container_20ml_nocap",
+        "slot": "slot_20ml_position",
+        "open": "open_slot_20ml",
+        "close": "close_slot_20ml",
+        "suck": "suck_from_20ml",
+        "drop": "drip_to_slot_20ml"
+    }
+}
+
+
+class SourceBottleSlot:
+    """
+    物料站原液瓶槽位
+    no: 原液瓶编号(从1开始)
+    location: 指令中的槽位编号(同规格内从0开始)
+    """
+    __slots__ = ("no", "spec", "location", "lid_station", "suck_command",
+                 "open_put", "open_take", "close_put", "close_take", "open_start", "close_start")
+
+    def __init__(self, no, spec, location, lid_station):
+        self.no = no
+        self.spec = spec
+        self.location = location
+        # 需搬运到开关盖工作站开盖的原液瓶
+        self.lid_station = lid_station
+        self.suck_command = f"suck_from_{spec}"
+        # 开关盖工作站上的开/关盖指令
+        self.open_start = f"open_slot_{spec}_start"
+        self.close_start = f"close_slot_{spec}_start"
+        if lid_station:
+            self.open_put = self.open_take = f"open_slot_{spec}"
+            self.close_put = self.close_take = f"close_slot_{spec}"
+        else:
+            self.open_put = f"open_slot_{spec}_put"
+            self.open_take = f"open_slot_{spec}_take"
+            self.close_put = f"close_slot_{spec}_put"
+            self.close_take = f"close_slot_{spec}_take"
+
+    def open_lid_command_string(self, move_type="put"):
+        return self.open_put if move_type == "put" else self.open_take
+
+    def close_lid_command_string(self, move_type="put"):
+        return self.close_put if move_type == "put" else self.close_take
+
+
+class SampleRack:
+    """
+    样品架
+    offset: 架上1号位在同规格逻辑编号中的偏移
+    capacity: 架上容器位数量
+    """
+    __slots__ = ("container_type_code", "size", "offset", "capacity",
+                 "operate_param", "exchange_param", "commands")
+
+    def __init__(self, container_type_code, size, offset, capacity, operate_param, exchange_param):
+        if size not in SAMPLE_SIZE_COMMANDS:
+            raise ValueError(f"未知的样品架规格: {size}")
+        self.container_type_code = container_type_code
+        self.size = size
+        self.offset = offset
+        self.capacity = capacity
+        self.operate_param = operate_param
+        self.exchange_param = exchange_param
+        self.commands = SAMPLE_SIZE_COMMANDS[size]
+
+    def to_position(self, logic_no):
+        """
+        架上逻辑编号(从1开始)转换为同规格全局编号(从1开始)
+        """
+        return logic_no + self.offset
+
+
+class DeckLayout:
+    """
+    台面布局查找表
+    """
+    __slots__ = ("bottles", "bottle_table", "racks", "racks_by_offset", "rack_table", "position_rack",
+                 "size_capacity", "lid_capacity")
+
+    def __init__(self, config=None):
+        config = config or DEFAULT_DECK_LAYOUT
+
+        # 原液瓶编号 -> 槽位, 下标0留空使编号可直接索引
+        self.bottles = []
+        self.bottle_table = [None]
+        spec_location = {}
+        for group in config["SOURCE_BOTTLES"]:
+            spec = group["spec"]
+            for _ in range(group["count"]):
+                location = spec_location.get(spec, 0)
+                spec_location[spec] = location + 1
+                slot = SourceBottleSlot(len(self.bottle_table), spec, location, group.get("lidStation", False))
+                self.bottles.append(slot)
+                self.bottle_table.append(slot)
+
+        # 容器类型 -> 样品架
+        self.racks = []
+        self.rack_table = {}
+        self.size_capacity = {}
+        for item in config["SAMPLE_RACKS"]:
+            rack = SampleRack(item["containerTypeCode"], item["size"], item["offset"], item["capacity"],
+                              item["operateParam"], item["exchangeParam"])
+            if rack.container_type_code in self.rack_table:
+                raise ValueError(f"样品架重复定义: {rack.container_type_code}")
+            self.racks.append(rack)
+            self.rack_table[rack.container_type_code] = rack
+            end = rack.offset + rack.capacity
+            self.size_capacity[rack.size] = max(self.size_capacity.get(rack.size, 0), end)
+
+        # 按偏移排序的样品架, 同规格内即逻辑编号顺序
+        self.racks_by_offset = sorted(self.racks, key=lambda rack: rack.offset)
+
+        # 同规格全局编号(从0开始) -> 样品架
+        self.position_rack = {size: [None] * capacity for size, capacity in self.size_capacity.items()}
+        for rack in self.racks:
+            table = self.position_rack[rack.size]
+            for index in range(rack.offset, rack.offset + rack.capacity):
+                if table[index] is not None:
+                    raise ValueError(f"样品架编号区间重叠: {rack.container_type_code}")
+                table[index] = rack
+
+        self.lid_capacity = dict(config.get("LID_CAPACITY", DEFAULT_DECK_LAYOUT["LID_CAPACITY"]))
+
+    def get_bottle(self, bottle_no):
+        """
+        根据原液瓶编号获取槽位, 编号无效返回None
+        """
+        if 0 < bottle_no < len(self.bottle_table):
+            return self.bottle_table[bottle_no]
+        return None
+
+    def get_rack(self, container_type_code):
+        return self.rack_table.get(container_type_code)
+
+    def get_rack_by_position(self, size, position):
+        """
+        根据同规格全局编号(从0开始)获取样品架
+        """
+        table = self.position_rack.get(size)
+        if table is None or position < 0 or position >= len(table):
+            return None
+        return table[position]
+
+    @property
+    def bottle_count(self):
+        return len(self.bottles)
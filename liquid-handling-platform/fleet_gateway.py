@@ -0,0 +1,359 @@
+"""
+多设备网关
+一个进程加载多台移液工作站, 每台设备的全部接口挂载在 /<设备名>/... 下
+根路径的 /setLiquidHandlingInfo 与 /setSolutionExchengeInfo 进入调度队列,
+由调度线程按提交顺序分配给空闲且Tip头与原液余量足够的设备
+
+设备列表见 settings_fleet.json, 每台设备的配置项覆盖 SETTINGS 指定的基础配置
+未配置时 CACHE_DIR 为 ./devices/<设备名>, 回调发件箱与任务索引放在 CACHE_DIR 下, URI 为 /<设备名>/
+每台设备需配置不同的 ROBOT_ID 与 CACHE_DIR, 否则拒绝启动; 模板中第二台设备的 ROBOT_ID 需按实际机器人填写
+
+python fleet_gateway.py --settings settings_fleet.json
+"""
+import os
+
+# 最先导入, 统计启动各阶段耗时
+import startup_timing
+import cooperative
+# 协作模式需在导入其他模块之前打补丁, 开关取自多设备配置文件
+DEFAULT_FLEET_SETTINGS = os.path.abspath(os.path.join(os.path.dirname(__file__), "settings_fleet.json"))
+cooperative.init(cooperative.settings_argument(os.environ.get("FLEET_SETTINGS") or DEFAULT_FLEET_SETTINGS))
+
+import argparse
+import json
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+import metrics
+from liquid_handling_platform import LiquidHandlingGateway
+from liquid_handling_platform_server import create_device_blueprint, debug_blueprint
+from logger_handler import create_logger
+from operate_wrapper import accept_task, decode_task_request, duplicate_response, reject_request
+from request_schema import RequestError, TaskRequest
+
+log = create_logger("INFO", "FleetGateway")
+startup_timing.mark("imports")
+
+# 调度检查间隔(秒), 设备状态变化时立即检查
+DISPATCH_INTERVAL = 1.0
+
+# 排队超时时间(秒), 超时未分配的任务回调失败
+QUEUE_TIMEOUT = 3600
+
+# 调度接口 -> (设备上的处理方法, 是否溶液交换)
+FLEET_ENDPOINTS = {
+    "setLiquidHandlingInfo": ("set_liquid_handling_info_operate", False),
+    "setSolutionExchengeInfo": ("set_solution_exchenge_info", True)
+}
+
+
+class FleetTask:
+    """
+    排队中的任务
+    contexts: 设备名 -> 按该设备台面布局校验后的上下文
+    required_tips/bottles: 设备名 -> 该设备上需要的Tip头数量/使用的原液瓶, 无法在该设备执行的设备不在其中
+    """
+    def __init__(self, endpoint, task_id, param, contexts, required_tips, bottles):
+        self.endpoint = endpoint
+        self.task_id = task_id
+        self.param = param
+        self.contexts = contexts
+        self.required_tips = required_tips
+        self.bottles = bottles
+        self.submitted_at = time.time()
+
+
+def check_devices(base_settings, device_overrides):
+    """
+    启动前检查设备配置, 每台设备需使用不同的机器人与缓存目录,
+    否则两个调度同时向同一台机器人提交指令, 或共用同一份Tip头与原液余量
+    """
+    with open(base_settings, "r", encoding="utf-8") as f:
+        base_robot_id = json.load(f).get("ROBOT_ID")
+    robot_ids = {}
+    cache_dirs = {}
+    for name, overrides in device_overrides.items():
+        robot_id = overrides.get("ROBOT_ID", base_robot_id)
+        if robot_id is None:
+            raise ValueError(f"设备 {name} 未配置 ROBOT_ID")
+        if robot_id in robot_ids:
+            raise ValueError(f"设备 {name} 与 {robot_ids[robot_id]} 使用相同的 ROBOT_ID: {robot_id}")
+        robot_ids[robot_id] = name
+        cache_dir = os.path.normcase(os.path.abspath(overrides["CACHE_DIR"]))
+        if cache_dir in cache_dirs:
+            raise ValueError(f"设备 {name} 与 {cache_dirs[cache_dir]} 使用相同的 CACHE_DIR: {overrides['CACHE_DIR']}")
+        cache_dirs[cache_dir] = name
+
+
+class FleetGateway:
+    def __init__(self, settings_path=DEFAULT_FLEET_SETTINGS):
+        with open(settings_path, "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        base_settings = os.path.join(os.path.dirname(os.path.abspath(settings_path)),
+                                     self.config.get("SETTINGS", "settings.json"))
+        self.port = self.config.get("PORT", 6001)
+        self.dispatch_interval = self.config.get("FLEET_DISPATCH_INTERVAL", DISPATCH_INTERVAL)
+        self.queue_timeout = self.config.get("FLEET_QUEUE_TIMEOUT", QUEUE_TIMEOUT)
+
+        device_overrides = {}
+        for device in self.config["DEVICES"]:
+            name = device["name"]
+            overrides = {key: value for key, value in device.items() if key != "name"}
+            overrides.setdefault("CACHE_DIR", os.path.join(".", "devices", name))
+            overrides.setdefault("CALLBACK_OUTBOX_PATH", os.path.join(overrides["CACHE_DIR"], ".callback_outbox.db"))
+            overrides.setdefault("TASK_REGISTRY_PATH", os.path.join(overrides["CACHE_DIR"], ".task_registry.db"))
+            overrides.setdefault("URI", f"/{name}/")
+            overrides.setdefault("PORT", self.port)
+            device_overrides[name] = overrides
+        check_devices(base_settings, device_overrides)
+
+        self.devices = {}
+        for name, overrides in device_overrides.items():
+            os.makedirs(overrides["CACHE_DIR"], exist_ok=True)
+            gateway = LiquidHandlingGateway(base_settings, overrides)
+            # 设备状态变化(如任务完成)时立即尝试分配排队任务
+            gateway.machine_status.add_listener(self.notify_device_change)
+            self.devices[name] = gateway
+            log.info("加载设备 %s: 机器人%s 设备编码%s", name, gateway.robot_id, gateway.machine_code)
+
+        self.queue = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # 单设备指标只对应最后加载的设备, 多设备模式下改为按设备汇总导出
+        metrics.TIPS_REMAINING.set_function(None)
+        metrics.STOCK_VOLUME.set_function(None)
+        metrics.CALLBACK_OUTBOX_PENDING.set_function(None)
+        metrics.FLEET_DEVICE_TIPS.set_function(lambda: self.device_metrics(lambda gateway: gateway.get_tips_metrics()))
+        metrics.FLEET_DEVICE_STOCK.set_function(
+            lambda: self.device_metrics(lambda gateway: gateway.get_stock_volume_metrics()))
+        metrics.FLEET_CALLBACK_OUTBOX_PENDING.set_function(lambda: self.device_metrics(
+            lambda gateway: gateway.callback_outbox.get_pending_metrics() if getattr(gateway, "callback_outbox", None)
+            else []))
+        metrics.FLEET_QUEUE_DEPTH.set_function(lambda: [((), len(self.queue))])
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch_loop, name="fleet-dispatch", daemon=True)
+            self._thread.start()
+
+    def notify_device_change(self, status):
+        self._wakeup.set()
+
+    def device_metrics(self, get_metrics):
+        """
+        汇总各设备的指标, 标签前加上设备名
+        """
+        return [((name,) + tuple(labels), value)
+                for name, gateway in self.devices.items() for labels, value in get_metrics(gateway)]
+
+    def submit(self, endpoint, data):
+        """
+        接收任务并加入调度队列, 返回响应内容
+        """
+        method_name, exchange = FLEET_ENDPOINTS[endpoint]
+        try:
+            task_request = decode_task_request(data)
+        except RequestError as e:
+            return reject_request(e.task_id, getattr(LiquidHandlingGateway, method_name), e)
+        task_id = task_request.task_id
+        param = task_request.param
+        duplicate = self.find_duplicate(task_id, task_request.replay_callback)
+        if duplicate is not None:
+            return duplicate
+        response = {
+            'id': task_id,
+            'stamp': round(time.time() * 1000),
+            'message': '操作成功',
+            'msg': '操作成功',
+            'code': 200
+        }
+        contexts = {}
+        required_tips = {}
+        bottles = {}
+        errors = []
+        rejected = True
+        for name, gateway in self.devices.items():
+            # 各设备的台面布局可能不同, 分别校验
+            device_request = TaskRequest(task_id, param, task_request.context)
+            try:
+                gateway.request_schemas[endpoint].validate(device_request)
+                required_tips[name] = gateway.estimate_required_tips(param, device_request.context, exchange)
+                bottles[name] = gateway.used_source_bottles(param)
+                contexts[name] = device_request.context
+            except Exception as e:
+                rejected = rejected and isinstance(e, RequestError)
+                errors.append(f"{name}: {e.args[0] if isinstance(e, RequestError) else e}")
+        if len(required_tips) == 0:
+            message = f"没有可执行该任务的设备: {'; '.join(errors)}"
+            if rejected:
+                return reject_request(task_id, getattr(LiquidHandlingGateway, method_name), RequestError(message))
+            response["code"] = 500
+            response["message"] = response["msg"] = message
+            return response
+
+        task = FleetTask(endpoint, task_id, param, contexts, required_tips, bottles)
+        with self._lock:
+            # 重复提交的任务可能同时到达
+            position = self.queue_position(task_id)
+            if position is not None:
+                return self.queued_response(task_id, position)
+            self.queue.append(task)
+            position = len(self.queue)
+        log.info("任务%s 进入调度队列, 排队位置%s, 需要Tip头%s", task_id, position, required_tips)
+        response["data"] = {"queued": position}
+        self._wakeup.set()
+        return response
+
+    def queue_position(self, task_id):
+        for index, task in enumerate(self.queue):
+            if task.task_id == task_id:
+                return index + 1
+        return None
+
+    def queued_response(self, task_id, position):
+        log.info("任务%s 重复提交, 排队位置%s", task_id, position)
+        metrics.TASKS_DUPLICATE.inc(1, "QUEUED")
+        return {
+            'id': task_id,
+            'stamp': round(time.time() * 1000),
+            'message': '任务已在调度队列中',
+            'msg': '任务已在调度队列中',
+            'code': 200,
+            'data': {"queued": position, "duplicate": True}
+        }
+
+    def find_duplicate(self, task_id, replay_callback=False):
+        """
+        已在排队或已分配到设备的任务编号, 返回已有状态, 否则返回None
+        """
+        with self._lock:
+            position = self.queue_position(task_id)
+        if position is not None:
+            return self.queued_response(task_id, position)
+        for gateway in self.devices.values():
+            record = gateway.task_registry.get(task_id)
+            if record is not None:
+                return duplicate_response(gateway, task_id, record, replay_callback)
+        return None
+
+    def select_device(self, task):
+        """
+        选择空闲且Tip头与原液余量足够的设备, 多台可用时选择剩余Tip头最多的设备
+        """
+        best_name = None
+        best_tips = -1
+        for name, required_tips in task.required_tips.items():
+            gateway = self.devices[name]
+            if gateway.machine_status.get_machine_status() != "IDLE":
+                continue
+            tips = gateway.tip_box.get_tip_useful_count()
+            if tips < required_tips or not gateway.stock_available(task.bottles[name]):
+                continue
+            if tips > best_tips:
+                best_name = name
+                best_tips = tips
+        return best_name
+
+    def dispatch(self):
+        """
+        按提交顺序分配排队任务, 无可用设备的任务继续排队, 不阻塞后面的任务
+        """
+        with self._lock:
+            pending = list(self.queue)
+        for task in pending:
+            if time.time() - task.submitted_at > self.queue_timeout:
+                self._remove(task)
+                log.error("任务%s 排队超过%s秒仍无可用设备", task.task_id, self.queue_timeout)
+                next(iter(self.devices.values())).http_callback(task_id=task.task_id, code=500, data=None,
+                                                                msg="排队超时, 没有空闲且物料充足的设备")
+                continue
+            name = self.select_device(task)
+            if name is None:
+                continue
+            gateway = self.devices[name]
+            function = getattr(gateway, FLEET_ENDPOINTS[task.endpoint][0])
+            response = accept_task(gateway, task.task_id, task.param, task.contexts[name], function, use_context=True,
+                                   dedupe=True)
+            if response["code"] != 200:
+                # 设备在检查后被直接调用的任务占用
+                continue
+            self._remove(task)
+            wait_seconds = time.time() - task.submitted_at
+            metrics.FLEET_QUEUE_WAIT_SECONDS.observe(wait_seconds, name)
+            metrics.FLEET_DISPATCHED.inc(1, name)
+            log.info("任务%s 分配到设备%s, 排队%.3f秒", task.task_id, name, wait_seconds)
+
+    def _remove(self, task):
+        with self._lock:
+            if task in self.queue:
+                self.queue.remove(task)
+
+    def _dispatch_loop(self):
+        while True:
+            self._wakeup.wait(self.dispatch_interval)
+            self._wakeup.clear()
+            try:
+                self.dispatch()
+            except Exception as e:
+                log.error("调度异常: %s", e)
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            queue = [{"id": task.task_id, "endpoint": task.endpoint, "waitSeconds": round(now - task.submitted_at, 3),
+                      "requiredTips": task.required_tips} for task in self.queue]
+        devices = {name: {"status": gateway.machine_status.get_machine_status(),
+                          "tipsCount": gateway.tip_box.get_tip_useful_count(),
+                          "instanceId": gateway.instance_id} for name, gateway in self.devices.items()}
+        return {"devices": devices, "queue": queue}
+
+
+def create_fleet_app(fleet):
+    """
+    多设备应用: 各设备接口 + 调度接口 + 进程级的指标与调试接口
+    """
+    app = Flask(__name__)
+    for name, gateway in fleet.devices.items():
+        app.register_blueprint(create_device_blueprint(gateway, name), url_prefix=f"/{name}")
+    app.register_blueprint(debug_blueprint)
+
+    @app.route('/setLiquidHandlingInfo', methods=['POST'])
+    def setLiquidHandlingInfo():
+        return jsonify(fleet.submit("setLiquidHandlingInfo", request.data)), 200
+
+    @app.route('/setSolutionExchengeInfo', methods=['POST'])
+    def setSolutionExchengeInfo():
+        return jsonify(fleet.submit("setSolutionExchengeInfo", request.data)), 200
+
+    @app.route('/fleet/status', methods=['GET'])
+    def fleet_status():
+        return jsonify(fleet.status()), 200
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多设备移液网关")
+    parser.add_argument("--settings", default=os.environ.get("FLEET_SETTINGS") or DEFAULT_FLEET_SETTINGS,
+                        help="多设备配置文件")
+    args = parser.parse_args()
+
+    fleet = FleetGateway(args.settings)
+    fleet.start()
+    with startup_timing.phase("app"):
+        app = create_fleet_app(fleet)
+    with startup_timing.phase("server"):
+        from gevent import pywsgi
+    startup_timing.ready()
+    log.info('--- fleet gateway start, devices: %s --- %s', list(fleet.devices), startup_timing.summary())
+    server = pywsgi.WSGIServer(('0.0.0.0', fleet.port), app)
+    server.serve_forever()
+    log.info('--- fleet gateway stop ---')
+
+
+if __name__ == "__main__":
+    main()
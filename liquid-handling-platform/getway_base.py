@@ -16,20 +16,26 @@ import time
 
 from flask import Flask
 import requests
-import paho.mqtt.client as mqtt
-from gevent import pywsgi
 
-from logger_handler import create_logger
+import metrics
+import startup_timing
+from callback_outbox import DELIVERY_TIMEOUT, MAX_RETRY_DELAY, CallbackOutbox
+from heartbeat_service import HEARTBEAT_TIMEOUT, IP_REFRESH_INTERVAL, HeartbeatService, NetworkIdentity
+from task_registry import TASK_REGISTRY_CACHE_SIZE, TASK_REGISTRY_CAPACITY, TASK_REGISTRY_PATH, TaskRegistry
+from tracing import span
+from logger_handler import create_logger, enable_command_dump, enable_structured_log, start_log_maintenance
+from traffic_capture import enable_capture
 log = create_logger("INFO", "GetwayBase")
 
-import psutil
-
 """mqtt开关"""
 mqtt_enable = False
 
 """http回调开关"""
 http_callback_enable = True
 
+"""回调发件箱文件"""
+CALLBACK_OUTBOX_PATH = "./.callback_outbox.db"
+
 """心跳开关"""
 heartbeat_enable = True
 
@@ -38,22 +44,63 @@ online_check_enable = False
 
 """设备状态锁"""
 class MachineStatus:
-    machine_status = 0
-    machine_online_status = "ONLINE"
-    lock_online = threading.Lock()
-    lock = threading.Lock()
+    """
+    每个网关实例独立的设备状态, 同一进程中的多台设备互不影响
+    """
+    def __init__(self):
+        self.machine_status = 0
+        self.machine_online_status = "ONLINE"
+        self.lock_online = threading.Lock()
+        self.lock = threading.Lock()
+        # 状态变化监听函数, 参数为变化后的状态
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _set_status(self, value):
+        with self.lock:
+            changed = self.machine_status != value
+            self.machine_status = value
+        if changed:
+            self._notify()
+
+    def _notify(self):
+        status = self.get_machine_status()
+        for listener in self.listeners:
+            try:
+                listener(status)
+            except Exception as e:
+                log.error("设备状态监听异常: %s", e)
 
     def increase(self):
+        self._set_status(1)
+
+    def try_acquire(self):
+        """
+        空闲时置为忙碌并返回True, 检查与设置在同一把锁内完成, 避免两个任务同时被接收
+        """
+        if self.machine_online_status != "ONLINE":
+            return False
         with self.lock:
+            if self.machine_status != 0:
+                return False
             self.machine_status = 1
+        self._notify()
+        return True
 
     def decrease(self):
-        with self.lock:
-            self.machine_status = 0
+        self._set_status(0)
 
     def reset(self):
-        with self.lock:
-            self.machine_status = 0
+        self._set_status(0)
+
+    def set_online_status(self, online_status):
+        with self.lock_online:
+            changed = self.machine_online_status != online_status
+            self.machine_online_status = online_status
+        if changed:
+            self._notify()
 
     def get_machine_status(self):
         if self.machine_online_status != "ONLINE":
@@ -79,21 +126,28 @@ class GateWayError(Exception):
 settings_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'settings.json'))
 
 class GetwayBase:
-    app = Flask(__name__)
-
     def __init__(self):
+        # 每个网关实例使用独立的Flask应用保存配置
+        self.app = Flask(__name__)
         self.mqtt_host = None
         self.machine_status = MachineStatus()
         self.heart_beat_callback = None
         self.instance_id = None
         self.pipeline_id = None
+        # 近期任务索引, 用于识别重复提交的任务
+        self.task_registry = None
 
-    def load_config(self, path = settings_path):            
+    def load_config(self, path = settings_path, overrides = None):
         with open(path, 'r', encoding='utf-8') as f:
             self.app.config.from_mapping(json.load(f))
+        # 覆盖配置文件中的部分配置, 例如多设备模式下每台设备的机器人编号与设备编码
+        if overrides:
+            self.app.config.from_mapping(overrides)
 
         """构造MQTT对象"""
         if mqtt_enable:
+            # 只在开启时导入
+            import paho.mqtt.client as mqtt
             self.mqtt_host = self.app.config.get('MQ')['MQTT_HOST']
             self.mqtt_port = self.app.config.get('MQ')['MQTT_PORT']
             self.mqtt_topic = self.topic_name = self.app.config.get('MQ')['TOPIC']
@@ -102,6 +156,22 @@ class GetwayBase:
             self.mqtt_client.username_pw_set(username=self.app.config.get('MQ')['USER_NAME'],
                                         password=self.app.config.get('MQ')['PASSWORD'])
             
+        # 指令完整内容调试日志开关
+        enable_command_dump(self.app.config.get("COMMAND_DUMP_ENABLE", False))
+
+        # 结构化日志开关
+        enable_structured_log(self.app.config.get("STRUCTURED_LOG_ENABLE", False))
+
+        # 日志压缩与保留策略
+        start_log_maintenance(self.app.config.get("LOG_BACKUP_DAYS"),
+                              self.app.config.get("LOG_MAX_TOTAL_MB"),
+                              self.app.config.get("LOG_MAINTENANCE_INTERVAL"))
+
+        # 流量录制, 用于本地回放
+        if self.app.config.get("CAPTURE_ENABLE", False):
+            enable_capture(True, self.app.config.get("CAPTURE_DIR"), self.app.config.get("CAPTURE_ROBOT_BODY", False))
+        startup_timing.mark("settings")
+
         self.target_ip = self.app.config.get('TARGET_IP')
         self.target_port = self.app.config.get('TARGET_PORT')
 
@@ -131,6 +201,10 @@ class GetwayBase:
         # 心跳上报地址 2
         self.heartbeat_url_2 = self.app.config.get("HEARTBEAT_URL_2")
 
+        # 本机IP缓存, 网卡变化或超过刷新间隔时重新解析
+        self.network_identity = NetworkIdentity(self.get_wireless_ip_address,
+                                                self.app.config.get("HEARTBEAT_IP_REFRESH_SECONDS", IP_REFRESH_INTERVAL))
+
         # 结果上传地址
         self.upload_url = self.app.config.get("UPLOAD_URL")
         # 工作站编码
@@ -158,8 +232,36 @@ class GetwayBase:
             """http回调地址2"""
             self.http_callback_url_2 = self.app.config.get("HTTP_CALLBACK_URL_2", "")
 
+            """回调发件箱, 持久化未投递的回调"""
+            self.callback_outbox = CallbackOutbox(self.app.config.get("CALLBACK_OUTBOX_PATH", CALLBACK_OUTBOX_PATH),
+                                                  {"http_callback_url": self.http_callback_url,
+                                                   "http_callback_url_2": self.http_callback_url_2},
+                                                  timeout=self.app.config.get("CALLBACK_TIMEOUT", DELIVERY_TIMEOUT),
+                                                  max_delay=self.app.config.get("CALLBACK_MAX_RETRY_DELAY", MAX_RETRY_DELAY),
+                                                  max_attempts=self.app.config.get("CALLBACK_MAX_ATTEMPTS", 0))
+            metrics.CALLBACK_OUTBOX_PENDING.set_function(self.callback_outbox.get_pending_metrics)
+            self.callback_outbox.start()
+            startup_timing.mark("callback_outbox")
+
+        """近期任务索引, 重复提交的任务返回已有结果"""
+        with startup_timing.phase("task_registry"):
+            self.task_registry = TaskRegistry(self.app.config.get("TASK_REGISTRY_PATH", TASK_REGISTRY_PATH),
+                                              self.app.config.get("TASK_REGISTRY_CAPACITY", TASK_REGISTRY_CAPACITY),
+                                              self.app.config.get("TASK_REGISTRY_CACHE_SIZE", TASK_REGISTRY_CACHE_SIZE))
+
+    def start_services(self):
+        """
+        启动心跳、MQTT连接与在线检查, 子类在机器人客户端等全部初始化完成后调用,
+        避免设备尚不能接收任务时就上报在线
+        """
         if heartbeat_enable is True:
-            threading.Thread(target=self.report_heartbeat, name="dryer-heartbeat-thread", daemon=True).start()
+            self.heartbeat = HeartbeatService([(self.heartbeat_url, self.machine_code),
+                                               (self.heartbeat_url_2, self.machine_code_2 or self.machine_code)],
+                                              self.build_heartbeat, self.heartbeat_time_interval,
+                                              log_every=self.heartbeat_log_time_interval,
+                                              timeout=self.app.config.get("HEARTBEAT_TIMEOUT", HEARTBEAT_TIMEOUT))
+            self.machine_status.add_listener(self.heartbeat.notify_status_change)
+            self.heartbeat.start()
 
         if mqtt_enable is True:
             threading.Thread(target=self.on_mqtt_connect).start()
@@ -168,8 +270,6 @@ class GetwayBase:
             threading.Thread(target=self.check_device_online, name="dryer-online-thread", daemon=True).start()
             
     def http_callback(self, task_id, code, data = None, msg = "", vars = None):
-        if http_callback_enable is not True:
-            return
         request = {
             "id":task_id,
             "code": code,
@@ -180,34 +280,25 @@ class GetwayBase:
         }
         if data is not None:
             request["data"] = data
-        headers = {
-            "Content-Type": "application/json"
-        }
-        retry_count = 10
-        while retry_count > 0:
-            try:
-                if self.http_callback_url is None or self.http_callback_url == "":
-                    break
-                response = requests.post(url = self.http_callback_url, headers = headers, data = json.dumps(request))
-                log.info(response.json())
-                if response.json()["code"] == 200:
-                    break
-            except Exception as e:
-                log.error(e)
-            retry_count -= 1
+        # 记录任务结果, 重复提交时返回
+        if self.task_registry is not None:
+            self.task_registry.finish(task_id, request)
+        if http_callback_enable is not True:
+            return
+        # 写入发件箱后立即返回, 由后台线程投递到各回调地址
+        with span("callback.enqueue", code=code):
+            count = self.callback_outbox.enqueue(task_id, request)
+        log.info("任务回调已写入发件箱 id:%s code:%s msg:%s 地址数:%s", task_id, code, msg, count)
 
-        retry_count = 10
-        while retry_count > 0:
-            try:
-                if self.http_callback_url_2 is None or self.http_callback_url_2 == "":
-                    break
-                response = requests.post(url = self.http_callback_url_2, headers = headers, data = json.dumps(request))
-                log.info(response.json())
-                if response.json()["code"] == 200:
-                    break
-            except Exception as e:
-                log.error(e)
-            retry_count -= 1
+    def replay_callback(self, task_id, request):
+        """
+        重新投递已完成任务的回调
+        """
+        if http_callback_enable is not True:
+            return 0
+        count = self.callback_outbox.enqueue(task_id, request)
+        log.info("任务回调已重新写入发件箱 id:%s code:%s 地址数:%s", task_id, request.get("code"), count)
+        return count
 
     def get_wireless_ip_address(self):
         ip_address = self.app.config.get('IP_ADDRESS')
@@ -215,6 +306,8 @@ class GetwayBase:
             """优先使用指定的ip地址"""
             return ip_address
 
+        # 只在未指定ip地址时导入
+        import psutil
         names = self.app.config.get('NET_INTERFACES')
         for name in names:
             for interface, addrs in psutil.net_if_addrs().items():
@@ -274,48 +367,17 @@ class GetwayBase:
                 }
         self.on_publish(self.mqtt_topic, json.dumps(data, indent=4, separators=(',', ':')), 1)
 
-    # 上报心跳方法
-    def report_heartbeat(self):
-        interval = 0
-        while True:
-            if heartbeat_enable is not True:
-                return
-            if self.heart_beat_callback:
-                self.heart_beat_callback()
-            wireless_ip = self.get_wireless_ip_address()
-            status_http = self.machine_status.get_machine_status()
-            post_json = {
-                'ip': wireless_ip,
-                'port': self.port,
-                'uri': self.url,
-                'stamp': int(time.time() * 1000),
-                'identifyingCode': self.machine_code,
-                'status': status_http
-            }
-            try:
-                if self.heartbeat_url is not None and self.heartbeat_url != "":
-                    if interval == self.heartbeat_log_time_interval:
-                        log.info('工作站状态为：%s; ip:%s; identifyingCode:%s; url:%s', status_http, wireless_ip, self.machine_code, self.heartbeat_url)
-                    response = requests.post(self.heartbeat_url, data=json.dumps(post_json), headers={'Content-Type': 'application/json'})
-                    # 检查响应状态码
-                    response.raise_for_status()
-            except Exception as e:
-                log.error(e)
-            try:
-                if self.heartbeat_url_2 is not None and self.heartbeat_url_2 != "":
-                    if self.machine_code_2 is not None:
-                        post_json["identifyingCode"] = self.machine_code_2
-                    if interval == self.heartbeat_log_time_interval:
-                        log.info('工作站状态为：%s; ip:%s; identifyingCode:%s; url:%s', status_http, wireless_ip, self.machine_code, self.heartbeat_url)
-                    response = requests.post(self.heartbeat_url_2, json.dumps(post_json), headers={'Content-Type': 'application/json'})
-                    # 检查响应状态码
-                    response.raise_for_status()
-            except Exception as e:
-                log.error(e)
-            interval += 1
-            if interval > self.heartbeat_log_time_interval:
-                interval = 0
-            time.sleep(self.heartbeat_time_interval)
+    # 心跳内容, 设备编码由心跳服务按上报地址填写
+    def build_heartbeat(self):
+        if self.heart_beat_callback:
+            self.heart_beat_callback()
+        return {
+            'ip': self.network_identity.get(),
+            'port': self.port,
+            'uri': self.url,
+            'stamp': int(time.time() * 1000),
+            'status': self.machine_status.get_machine_status()
+        }
 
     def upload_file(self, file_path, task_id, param_code, result_type):
         result_json = {
@@ -371,11 +433,11 @@ class GetwayBase:
                     return False, f"网络不可达 [{self.target_ip}]"
                 temp_status = "UNKNOWN_ERROR"
             finally:
-                with self.machine_status.lock_online:
-                    self.machine_status.machine_online_status = temp_status
+                self.machine_status.set_online_status(temp_status)
             time.sleep(60)
 
     def run(self):
+        from gevent import pywsgi
         log.info('--- gateway start ---')
         server = pywsgi.WSGIServer(('0.0.0.0', self.port), self.app)
         server.serve_forever()
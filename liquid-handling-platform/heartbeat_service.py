@@ -0,0 +1,146 @@
+"""
+心跳上报服务
+缓存本机IP, 仅在网卡变化或定时刷新时重新解析
+多个心跳地址使用各自的连接并行上报, 设备状态变化时立即补发一次心跳
+"""
+import json
+import socket
+import threading
+import time
+
+import requests
+
+from logger_handler import create_logger
+
+log = create_logger("INFO", "Heartbeat")
+
+# IP缓存的定时刷新间隔(秒)
+IP_REFRESH_INTERVAL = 300
+
+# 单次心跳请求超时时间(秒)
+HEARTBEAT_TIMEOUT = 3
+
+
+class NetworkIdentity:
+    """
+    本机IP缓存
+    resolve: 解析IP的函数, 耗时较长(遍历所有网卡)
+    网卡列表(socket.if_nameindex)变化或超过刷新间隔时重新解析
+    """
+    def __init__(self, resolve, refresh_interval=IP_REFRESH_INTERVAL):
+        self.resolve = resolve
+        self.refresh_interval = refresh_interval
+        self.address = None
+        self._interfaces = None
+        self._resolved_at = 0.0
+
+    @staticmethod
+    def interface_signature():
+        try:
+            return tuple(socket.if_nameindex())
+        except OSError:
+            return None
+
+    def get(self):
+        interfaces = self.interface_signature()
+        if (self.address is None or interfaces != self._interfaces
+                or time.monotonic() - self._resolved_at >= self.refresh_interval):
+            address = self.resolve()
+            if address != self.address:
+                log.info("本机IP更新: %s -> %s", self.address, address)
+            self.address = address
+            self._interfaces = interfaces
+            self._resolved_at = time.monotonic()
+        return self.address
+
+
+class HeartbeatService:
+    """
+    心跳上报
+    targets: [(心跳地址, 设备编码), ...], 地址为空的忽略
+    build_payload: 生成心跳内容的函数, 设备编码由本服务按地址填写
+    每个地址一个发送线程, 某个地址响应慢不影响其他地址
+    发送线程只发送最新的心跳内容, 上一次未完成时新的内容会覆盖尚未发送的内容, 不会堆积
+    同一地址配置了两个设备编码时按两个目标分别上报
+    log_every: 每隔多少次上报输出一次日志, 不大于0时每次都输出
+    """
+    def __init__(self, targets, build_payload, interval, log_every=10, timeout=HEARTBEAT_TIMEOUT):
+        self.targets = [(url, code) for url, code in targets if url]
+        self.build_payload = build_payload
+        self.interval = interval
+        self.log_every = log_every
+        self.timeout = timeout
+        # 按目标下标保存待发送的内容与发送线程的唤醒事件
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._senders = [threading.Event() for _ in self.targets]
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        if len(self._threads) > 0 or len(self.targets) == 0:
+            return
+        self._threads.append(threading.Thread(target=self._run, name="dryer-heartbeat-thread", daemon=True))
+        for index, (url, _) in enumerate(self.targets):
+            self._threads.append(threading.Thread(target=self._send_loop, args=(index, url),
+                                                  name=f"dryer-heartbeat-send-{index}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        for event in self._senders:
+            event.set()
+
+    def notify_status_change(self, status):
+        """
+        设备状态变化时立即上报
+        """
+        self._wakeup.set()
+
+    def _run(self):
+        tick = 0
+        while not self._stopped:
+            try:
+                self.send(log_status=(self.log_every <= 0 or tick % self.log_every == 0))
+            except Exception as e:
+                log.error("心跳上报异常: %s", e)
+            tick += 1
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def send(self, log_status=False):
+        """
+        生成心跳内容并交给各地址的发送线程
+        """
+        payload = self.build_payload()
+        for index, (url, code) in enumerate(self.targets):
+            body = dict(payload)
+            if code is not None:
+                body["identifyingCode"] = code
+            if log_status:
+                log.info('工作站状态为：%s; ip:%s; identifyingCode:%s; url:%s', body.get("status"), body.get("ip"),
+                         body.get("identifyingCode"), url)
+            with self._pending_lock:
+                self._pending[index] = body
+            self._senders[index].set()
+
+    def _send_loop(self, index, url):
+        session = requests.Session()
+        event = self._senders[index]
+        while not self._stopped:
+            event.wait()
+            event.clear()
+            with self._pending_lock:
+                body = self._pending.pop(index, None)
+            if body is None:
+                continue
+            try:
+                response = session.post(url, data=json.dumps(body), headers={'Content-Type': 'application/json'},
+                                        timeout=self.timeout)
+                # 检查响应状态码
+                response.raise_for_status()
+            except Exception as e:
+                log.error("心跳 %s 上报失败: %s", url, e)
@@ -6,34 +6,47 @@ import queue
 import json
 
 
+import cooperative
 from common_robot_gateway import CommonRobotGateway
 from common_util import cacheInfoUtil, load_cache, save_cache, split_array
+from deck_layout import DeckLayout
+from robot_command import CommandSummary, RobotCommand
 from getway_base import GateWayError, GetwayBase
-from logger_handler import create_logger
+from query_instance_status import QueryInstanceStatus
+from request_schema import ContainerNormalizer, TaskContext, compile_request_schemas
+from logger_handler import LazyText, create_logger
+import metrics
+import startup_timing
+from tracing import record_span, span, traced
 from datetime import datetime
 
 log = create_logger("INFO", "LiquidHandlingGateway")
 
 
-TIPBOX_INFO_CACHE = "./.tip_box_info.json"
+# 缓存文件所在目录, 同一进程运行多台设备时每台设备配置不同的 CACHE_DIR
+CACHE_DIR = "."
+
+# Tip头信息缓存
+TIPBOX_INFO_CACHE = ".tip_box_info.json"
 
 # 原液瓶信息缓存
-SOLUTION_INFO_CACHE = "./.solution_info.json"
+SOLUTION_INFO_CACHE = ".solution_info.json"
 
 # 阈值信息缓存
-WARNING_VALUE_CACHE = "./.warning_value.json"
+WARNING_VALUE_CACHE = ".warning_value.json"
 
 class warningValue():
-    def __init__(self):
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_path = os.path.join(cache_dir, WARNING_VALUE_CACHE)
         self.default_warning_value = {
             "solutionInfo4ml":0.1,
             "solutionInfo50ml":0.1,
             "solutionInfo100ml":0.1
         }
-        self.warning_value_dict = cacheInfoUtil.init_cache(WARNING_VALUE_CACHE, self.default_warning_value)
+        self.warning_value_dict = cacheInfoUtil.init_cache(self.cache_path, self.default_warning_value)
 
     def reset(self):
-        cacheInfoUtil.reset_cache_info(SOLUTION_INFO_CACHE, self.warning_value_dict, self.default_warning_value)
+        cacheInfoUtil.reset_cache_info(self.cache_path, self.warning_value_dict, self.default_warning_value)
 
     def get_warning_value(self, solution_type):
         if solution_type in self.warning_value_dict:
@@ -47,7 +60,8 @@ class warningValue():
             log.error("未知的溶液类型")
 
 class solutionInfo():
-    def __init__(self):
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_path = os.path.join(cache_dir, SOLUTION_INFO_CACHE)
         self.default_solution_info = {
             "solutionInfo4ml":[
                 4.0, 4.0
@@ -60,7 +74,7 @@ class solutionInfo():
             ]
         }
 
-        self.warning_value = warningValue()
+        self.warning_value = warningValue(cache_dir)
 
         self.default_volumn_map = {
             "solutionInfo4ml" : 4.0,
@@ -68,10 +82,10 @@ class solutionInfo():
             "solutionInfo100ml" : 100.0
         }
 
-        self.solution_info_dict = cacheInfoUtil.init_cache(SOLUTION_INFO_CACHE, self.default_solution_info)
+        self.solution_info_dict = cacheInfoUtil.init_cache(self.cache_path, self.default_solution_info)
 
     def reset(self):
-        cacheInfoUtil.reset_cache_info(SOLUTION_INFO_CACHE, self.solution_info_dict, self.default_solution_info)
+        cacheInfoUtil.reset_cache_info(self.cache_path, self.solution_info_dict, self.default_solution_info)
 
     # 计算预警阈值
     def get_warning_value(self, solution_type):
@@ -109,14 +123,14 @@ class solutionInfo():
         """
         将所有溶液瓶恢复到默认容量-默认状态所有溶剂瓶为满状态
         """
-        cacheInfoUtil.reset_cache_info(SOLUTION_INFO_CACHE, self.solution_info_dict, self.default_solution_info)
+        cacheInfoUtil.reset_cache_info(self.cache_path, self.solution_info_dict, self.default_solution_info)
 
     def reset_solution_info(self, solution_type, location):
         """
         重置一个溶液瓶为默认容量
         """
         self.solution_info_dict[solution_type][location] = self.default_volumn_map(solution_type)
-        save_cache(json.dumps(self.solution_info_dict), SOLUTION_INFO_CACHE)
+        save_cache(json.dumps(self.solution_info_dict), self.cache_path)
 
     def set_solution_info(self, solution_type, location, value):
         """
@@ -128,15 +142,15 @@ class solutionInfo():
             2 : "solutionInfo100ml"
         }
         stock_type = solution_type_enum[solution_type]
-        self.solution_info_dict = json.loads(load_cache(SOLUTION_INFO_CACHE))
+        self.solution_info_dict = json.loads(load_cache(self.cache_path))
         self.solution_info_dict[stock_type][location] = value
-        save_cache(json.dumps(self.solution_info_dict), SOLUTION_INFO_CACHE)
+        save_cache(json.dumps(self.solution_info_dict), self.cache_path)
     
     def get_solution_info(self):
         """
         获取所有溶液瓶信息
         """
-        self.solution_info_dict = json.loads(load_cache(SOLUTION_INFO_CACHE))
+        self.solution_info_dict = json.loads(load_cache(self.cache_path))
         percentage_solution_info = {}
         for key, values in self.solution_info_dict.items():
             total = 4 if key == "solutionInfo4ml" else 50 if key == "solutionInfo50ml" else 100 
@@ -145,7 +159,8 @@ class solutionInfo():
 
 
 class tipBoxs():
-    def __init__(self):
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_path = os.path.join(cache_dir, TIPBOX_INFO_CACHE)
         self.tip_boxs = []
 
         for id in range(0, 192):
@@ -153,23 +168,25 @@ class tipBoxs():
         self.default_tip_boxs = {
             "tipBoxs": self.tip_boxs
         }
-        self.tip_boxs_dict = cacheInfoUtil.init_cache(TIPBOX_INFO_CACHE, self.default_tip_boxs)
+        self.tip_boxs_dict = cacheInfoUtil.init_cache(self.cache_path, self.default_tip_boxs)
 
     def reset_tip_boxs(self):
-        cacheInfoUtil.reset_cache_info(TIPBOX_INFO_CACHE, self.tip_boxs_dict, self.default_tip_boxs)
+        cacheInfoUtil.reset_cache_info(self.cache_path, self.tip_boxs_dict, self.default_tip_boxs)
+        # 同步内存中的状态, Tip头指标与规划预演直接读取
+        self.tip_boxs_dict = json.loads(json.dumps(self.default_tip_boxs))
     
     def get_one_tips(self):
         """
         获取一个非空的Tip头
         """
-        self.tip_boxs_dict = json.loads(load_cache(TIPBOX_INFO_CACHE))
+        self.tip_boxs_dict = json.loads(load_cache(self.cache_path))
         finally_tips_info = None
         for tips_info in self.tip_boxs_dict["tipBoxs"]:
             if not tips_info["isEmpty"]:
                 tips_info["isEmpty"] = True
                 finally_tips_info = tips_info
                 break
-        save_cache(json.dumps(self.tip_boxs_dict), TIPBOX_INFO_CACHE)
+        save_cache(json.dumps(self.tip_boxs_dict), self.cache_path)
         return finally_tips_info
     
     def get_tip_count(self):
@@ -182,7 +199,7 @@ class tipBoxs():
         """
         获取当前剩余tip头数量
         """
-        self.tip_boxs_dict = json.loads(load_cache(TIPBOX_INFO_CACHE))
+        self.tip_boxs_dict = json.loads(load_cache(self.cache_path))
         count = 0
         for tips_info in self.tip_boxs_dict["tipBoxs"]:
             if not tips_info["isEmpty"]:
@@ -190,11 +207,36 @@ class tipBoxs():
         return count
     
 class LiquidHandlingGateway(GetwayBase):
-    def __init__(self):
+    def __init__(self, settings_path=None, overrides=None):
         super().__init__()
-        settings_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'settings.json'))
-        self.load_config(settings_path)
-        self.robot = LiquidHandlingRobot(self.robot_url, self.robot_callback_url, self.robot_id, self.machine_code)
+        # 规划预演的副本中为True, 指令未提交机器人, 不输出执行结果日志也不记录规划耗时指标
+        self.dry_run = False
+        # 可通过参数或环境变量指定配置文件, 例如本地模拟环境
+        settings_path = settings_path or os.environ.get("LIQUID_HANDLING_SETTINGS") or \
+            os.path.abspath(os.path.join(os.path.dirname(__file__), 'settings.json'))
+        self.load_config(settings_path, overrides)
+
+        # 台面布局, 启动时加载一次
+        with startup_timing.phase("deck"):
+            self.deck = DeckLayout(self.app.config.get("DECK_LAYOUT"))
+            # 各接口的请求结构, 接收请求时校验
+            self.request_schemas = compile_request_schemas(self.deck)
+            self.container_normalizer = ContainerNormalizer(self.deck)
+        self.robot = LiquidHandlingRobot(self.robot_url, self.robot_callback_url, self.robot_id, self.machine_code, self.deck,
+                                         request_gzip=self.app.config.get("ROBOT_REQUEST_GZIP", False))
+        self.robot.poll_interval = self.app.config.get("ROBOT_POLL_INTERVAL", self.robot.poll_interval)
+        self.robot.retry_interval = self.app.config.get("ROBOT_RETRY_INTERVAL", self.robot.retry_interval)
+        # 实例状态数据库, 每台设备独立配置, 未配置时使用PostgreSQL
+        self.robot.instance_status = QueryInstanceStatus(self.app.config.get("INSTANCE_STATUS_DB"))
+        if self.app.config.get("ROBOT_CLIENT_BACKEND", "sync") == "asyncio":
+            if cooperative.cooperative_enable:
+                # gevent 补丁后的线程与 asyncio 事件循环线程不能混用
+                log.error("协作模式下不支持 asyncio 机器人客户端, 使用同步实现")
+            else:
+                self.robot.use_async_backend(self.app.config.get("ROBOT_REQUEST_TIMEOUT"),
+                                             self.app.config.get("ROBOT_DB_TIMEOUT"),
+                                             self.app.config.get("ROBOT_COMPLETION_TIMEOUT"))
+        startup_timing.mark("robot")
 
         # 物料站
         self.material_station = "material_station"
@@ -227,108 +269,84 @@ class LiquidHandlingGateway(GetwayBase):
 
         self.reclycle = "drip_to_recycle"
 
-        self.tip_box = tipBoxs()
-        self.solution_manager = solutionInfo()
+        # Tip头与原液瓶余量缓存, 每台设备一个目录
+        self.cache_dir = self.app.config.get("CACHE_DIR", CACHE_DIR)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.tip_box = tipBoxs(self.cache_dir)
+        self.solution_manager = solutionInfo(self.cache_dir)
 
-        self.rack_type_collection = {
-            "container_sample_3_4ml":[],
-            "container_sample_2_4ml":[],
-            "container_sample_1_4ml":[],
-            "container_bottle_20ml":[]
-        }
+        # 导出指标时读取当前tip头与原液余量
+        metrics.TIPS_REMAINING.set_function(self.get_tips_metrics)
+        metrics.STOCK_VOLUME.set_function(self.get_stock_volume_metrics)
 
         # 滴液指令到容器类型映射
-        self.drop_2_command = {
-            "container_sample_1_4ml":"drip_to_slot_4ml",
-            "container_sample_2_4ml":"drip_to_slot_4ml",
-            "container_sample_3_4ml":"drip_to_slot_4ml",
-            "container_bottle_20ml":"drip_to_slot_20ml"
-        }
+        self.drop_2_command = {rack.container_type_code: rack.commands["drop"] for rack in self.deck.racks}
 
         # 样品架开盖容器类型到指令映射
-        self.lid_open_2_command = {
-            "container_sample_1_4ml":"open_slot_4ml",
-            "container_sample_2_4ml":"open_slot_4ml",
-            "container_sample_3_4ml":"open_slot_4ml",
-            "container_bottle_20ml":"open_slot_20ml"
-        }
+        self.lid_open_2_command = {rack.container_type_code: rack.commands["open"] for rack in self.deck.racks}
 
         # 样品架关盖容器类型到指令映射
-        self.lid_close_2_command = {
-            "container_sample_1_4ml":"close_slot_4ml",
-            "container_sample_2_4ml":"close_slot_4ml",
-            "container_sample_3_4ml":"close_slot_4ml",
-            "container_bottle_20ml":"close_slot_20ml"
-        }
+        self.lid_close_2_command = {rack.container_type_code: rack.commands["close"] for rack in self.deck.racks}
 
-        self.container_type_code_map = {
-            "container_sample_1_4ml":"container_4ml",
-            "container_sample_2_4ml":"container_4ml",
-            "container_sample_3_4ml":"container_4ml",
-            "container_bottle_20ml":"container_20ml"
-        }
+        self.container_type_code_map = {rack.container_type_code: rack.commands["container"] for rack in self.deck.racks}
 
-        self.slot_type_map = {
-            "container_sample_1_4ml":"slot_4ml",
-            "container_sample_2_4ml":"slot_4ml",
-            "container_sample_3_4ml":"slot_4ml",
-            "container_bottle_20ml":"slot_20ml"
-        }
+        self.slot_type_map = {rack.container_type_code: f"slot_{rack.size}" for rack in self.deck.racks}
+        startup_timing.mark("cache")
 
-    def get_volume_by_location(self, specified_list, location, default_volume):
-        try:
-            for item in specified_list:
-                if item.get("location") == location:
-                    volume = item.get("volume")
-                    log.info(f"找到location {location}对应的volume: {volume}")
-                    return volume 
-            return default_volume
-        except Exception as e:
-            log.error(f"处理JSON数据时发生错误: {str(e)}")
-            return default_volume
+        # 机器人客户端与缓存就绪后再上报心跳
+        with startup_timing.phase("services"):
+            self.start_services()
 
-    def parse_all_bottle_volume_info(self, param, exchange_volume_list_4ml:list, exchange_volume_list_20ml:list):
-        try:
-            solution_exchange_rack_4 = param["solutionExchangeInfoRack4"]
-            solution_exchange_rack_3 = param["solutionExchangeInfoRack3"]
-            solution_exchange_rack_2 = param["solutionExchangeInfoRack2"]
-            solution_exchange_rack_1 = param["solutionExchangeInfoRack1"]
-
-            default_volume_1 = solution_exchange_rack_1["defalut_rack_info"]
-            default_volume_2 = solution_exchange_rack_2["defalut_rack_info"]
-            default_volume_3 = solution_exchange_rack_3["defalut_rack_info"]
-            default_volume_4 = solution_exchange_rack_4["defalut_rack_info"]
-
-            specified_volume_1 = solution_exchange_rack_1.get("specified_volume", [])
-            specified_volume_2 = solution_exchange_rack_2.get("specified_volume", [])
-            specified_volume_3 = solution_exchange_rack_3.get("specified_volume", [])
-            specified_volume_4 = solution_exchange_rack_4.get("specified_volume", [])
-
-            for i in range(1, 15):
-                exchange_volume_list_4ml.append(self.get_volume_by_location(specified_volume_1, i, default_volume_1))
-
-            for i in range(1, 15):
-                exchange_volume_list_4ml.append(self.get_volume_by_location(specified_volume_2, i, default_volume_2))
-            
-            for i in range(1, 15):
-                exchange_volume_list_4ml.append(self.get_volume_by_location(specified_volume_3, i, default_volume_3))
-            
-            for i in range(1, 9):
-                exchange_volume_list_20ml.append(self.get_volume_by_location(specified_volume_4, i, default_volume_4))
-
-            log.info(exchange_volume_list_4ml)
-            log.info(exchange_volume_list_20ml)
+    def build_volume_index(self, rack, specified_list):
+        """
+        建立样品架位置到排液量的索引, 并批量校验位置编号
+        同一位置重复指定时以第一条为准
+        """
+        index = {}
+        invalid_locations = []
+        for item in specified_list:
+            location = item.get("location")
+            if type(location) is not int or location < 1 or location > rack.capacity:
+                invalid_locations.append(location)
+                continue
+            index.setdefault(location, item.get("volume"))
+        if len(invalid_locations) > 0:
+            raise GateWayError(f"{rack.exchange_param}中存在无效位置: {invalid_locations}")
+        return index
 
+    @traced("parse.volumes")
+    def parse_all_bottle_volume_info(self, param):
+        """
+        解析所有样品架的排液量
+        返回 规格 -> 排液量表, 表下标为同规格逻辑编号(从0开始)
+        """
+        try:
+            volume_tables = {size: [0] * capacity for size, capacity in self.deck.size_capacity.items()}
+            for rack in self.deck.racks:
+                solution_exchange_rack = param[rack.exchange_param]
+                default_volume = solution_exchange_rack["defalut_rack_info"]
+                index = self.build_volume_index(rack, solution_exchange_rack.get("specified_volume") or [])
+                volume_tables[rack.size][rack.offset:rack.offset + rack.capacity] = [
+                    index.get(location, default_volume) for location in range(1, rack.capacity + 1)
+                ]
+                if len(index) > 0:
+                    log.info("%s 默认排液量: %s, 指定排液量: %s", rack.exchange_param, default_volume, index)
+            return volume_tables
+        except GateWayError:
+            raise
         except Exception as e:
             raise GateWayError(e)
         
-    def reset_rack_type_collection(self):
-        self.rack_type_collection = {
-            "container_sample_3_4ml":[],
-            "container_sample_2_4ml":[],
-            "container_sample_1_4ml":[],
-            "container_bottle_20ml":[]
-        }
+    @traced("parse.containers")
+    def collect_rack_containers(self, context):
+        """
+        整理上下文中的容器信息, 每个请求只整理一次
+        已通过请求校验的上下文直接使用校验时整理的结果
+        返回 容器类型 -> 去重并排序后的逻辑编号列表(同规格全局编号, 从0开始)
+        """
+        if isinstance(context, TaskContext):
+            return context.rack_containers
+        return self.container_normalizer.normalize(context.get("containers", None))
     
     def reset_tips_operate(self, _task_id, param):
         self.tip_box.reset_tip_boxs()
@@ -336,76 +354,51 @@ class LiquidHandlingGateway(GetwayBase):
 
     # 设置溶液交换信息
     def set_solution_exchenge_info(self, _task_id, param, context):
-        log.info(context)
-        log.info(param)
+        log.info("上下文: %s", LazyText(context))
+        log.info("参数: %s", LazyText(param))
         # 循环次数
         cycle_count = param.get("cycleCount")
         # 休眠时间
         sleep_time = param.get("time")
 
+        rack_containers = self.collect_rack_containers(context)
+
         while cycle_count > 0:
             cycle_count -= 1
-            ret, msg = self.discharge_liquid_operate(_task_id, param, context)
+            cycle_start = time.perf_counter()
+            ret, msg = self.discharge_liquid_operate(_task_id, param, context, rack_containers)
             if ret is False:
                 return False, msg, None
-            ret, msg, data = self.set_liquid_handling_info_operate(_task_id, param, context)
+            ret, msg, data = self.set_liquid_handling_info_operate(_task_id, param, context, rack_containers)
             if ret is False:
                 return False, msg, data
-            time.sleep(sleep_time)
+            record_span("exchange.cycle", cycle_start, remaining=cycle_count)
+            with span("exchange.sleep"):
+                time.sleep(sleep_time)
         return True, "操作成功", None
 
     # 排液流程
-    def discharge_liquid_operate(self, _task_id, param, context):
+    def discharge_liquid_operate(self, _task_id, param, context, rack_containers=None):
         """
         排液指令生成
+        rack_containers: 已整理的容器信息, 为空时从上下文中整理
         """
-        self.reset_rack_type_collection()
-        containers = context.get("containers", None)
-        if containers is None:
-            log.error("containers is None")
-            return False, "上下文信息中缺少容器信息"
-        
-        finally_container = []
-        for container in containers:
-            finally_container.extend(container.get("containers"))
-
-        for container in finally_container:
-            container_type_code = container.get("containerTypeCode", None)
-            if container_type_code is None:
-                log.error("container_type_code is None")
-                return False, "上下文信息中缺少容器类型"
-            logic_no = container.get("logicNo", None)
-            if logic_no is None:
-                log.error("logic_no is None")
-                log.error("缺少容器逻辑编号，跳过当前容器")
-                continue
-            if container_type_code == "container_sample_2_4ml":
-                logic_no += 14
-            if container_type_code == "container_sample_3_4ml":
-                logic_no += 28
-
-            container_info = {
-                "containerLogicNo": logic_no, 
-                "containerTypeCode": container_type_code
-            }
-            self.rack_type_collection[container_type_code].append(container_info)
-
-        # 4ml容器规格排液量列表
-        volume_list_4ml = []
-
-        # 20ml容器规格排液量列表
-        volume_list_20ml = []
+        plan_start = time.perf_counter()
+        if rack_containers is None:
+            rack_containers = self.collect_rack_containers(context)
 
-        self.parse_all_bottle_volume_info(param, volume_list_4ml, volume_list_20ml)
+        # 各规格容器排液量表
+        volume_tables = self.parse_all_bottle_volume_info(param)
 
         # 4ml瓶盖最大数量
-        max_value_4ml = 12
+        max_value_4ml = self.deck.lid_capacity["4ml"]
         # 20ml瓶盖最大数量
-        max_value_20ml = 8
+        max_value_20ml = self.deck.lid_capacity["20ml"]
 
         container_list_all = []
-        for container_list in self.rack_type_collection.values():
-            container_list_all.extend(container_list)
+        for container_type_code, positions in rack_containers.items():
+            temp_rack = self.deck.get_rack(container_type_code)
+            container_list_all.extend((temp_rack, position) for position in positions)
         
         params = []
         suck_params = []
@@ -413,27 +406,27 @@ class LiquidHandlingGateway(GetwayBase):
         lid_index_4ml = 0
         lid_index_20ml = 0
         while len(container_list_all) > 0:
-            container = container_list_all.pop()
-            container_logic_no = container.get("containerLogicNo") - 1  
-            temp_container_type_code = container.get("containerTypeCode")
-            temp_open_command = self.sample_open_command_4ml if temp_container_type_code != "container_bottle_20ml" else self.sample_open_command_20ml
-            temp_close_command = self.sample_close_command_4ml if temp_container_type_code != "container_bottle_20ml" else self.sample_close_command_20ml
-            temp_suck_command = self.suck_4ml if temp_container_type_code != "container_bottle_20ml" else self.suck_20ml
-            temp_slot_type = self.sample_slot_4ml if temp_container_type_code != "container_bottle_20ml" else self.sample_slot_20ml
-            temp_container_type = self.sample_container_4ml if temp_container_type_code != "container_bottle_20ml" else self.sample_container_20ml
-            temp_container_type_no_lid = self.sample_container_4ml if temp_container_type_code != "container_bottle_20ml" else self.sample_container_20ml_no_lid
+            temp_rack, container_logic_no = container_list_all.pop()
+            temp_commands = temp_rack.commands
+            temp_open_command = temp_commands["open"]
+            temp_close_command = temp_commands["close"]
+            temp_suck_command = temp_commands["suck"]
+            temp_slot_type = temp_commands["slot"]
+            temp_container_type = temp_commands["container"]
+            temp_container_type_no_lid = temp_commands["container_no_lid"]
+            is_4ml = temp_rack.size == "4ml"
 
             # 开盖
-            lid_index = lid_index_4ml if temp_container_type_code != "container_bottle_20ml" else lid_index_20ml
+            lid_index = lid_index_4ml if is_4ml else lid_index_20ml
             params.append(self.robot.create_move_command(self.lid_operation_station, self.sample_station, 0, container_logic_no, temp_container_type, temp_slot_type))
             params.append(self.robot.open_lid_command(self.lid_operation_station, temp_open_command, lid_index))
             params.append(self.robot.create_move_command(self.sample_station, self.lid_operation_station, container_logic_no, 0, temp_container_type_no_lid, temp_slot_type))
             
-            if temp_container_type_code != "container_bottle_20ml":
+            if is_4ml:
                 lid_index_4ml += 1
             else:
                 lid_index_20ml += 1
-            volume_value = volume_list_4ml[container_logic_no] if temp_container_type_code != "container_bottle_20ml" else volume_list_20ml[container_logic_no]
+            volume_value = volume_tables[temp_rack.size][container_logic_no]
             
             while volume_value > 1000:
                 volume_value -= 1000 
@@ -450,7 +443,7 @@ class LiquidHandlingGateway(GetwayBase):
                 # 安装tip头并且吸液
                 tips_info = self.tip_box.get_one_tips()
                 if tips_info is None:
-                    return False, "Tip头余量不足", None
+                    return False, "Tip头余量不足"
                 params.append(self.robot.install_tip_command(self.material_station, tips_info.get("id")))  
                 params.extend(suck_params)
 
@@ -464,65 +457,40 @@ class LiquidHandlingGateway(GetwayBase):
                 lid_index_4ml = 0
                 lid_index_20ml = 0
 
+        if not self.dry_run:
+            metrics.PLAN_SECONDS.observe(time.perf_counter() - plan_start, "discharge")
+        record_span("plan.discharge", plan_start, commands=len(params))
         if self.robot.execute_robot_command(params, self.instance_id, self.pipeline_id) is False:
             log.error("执行机械臂命令失败")
             return False, "执行机械臂命令失败"
-        log.info("执行机械臂命令成功")   
+        if not self.dry_run:
+            log.info("执行机械臂命令成功")
         return True, "执行成功"     
     
     # 设置移液信息
-    def set_liquid_handling_info_operate(self, _task_id, param, context):
-        log.info(context)
-        self.reset_rack_type_collection()
-        containers = context.get("containers", None)
-        if containers is None:
-            log.error("containers is None")
-            return False, "上下文信息中缺少容器信息"
-        
-        finally_container = []
-        for container in containers:
-            finally_container.extend(container.get("containers"))
-
-        for container in finally_container:
-            container_type_code = container.get("containerTypeCode", None)
-            if container_type_code is None:
-                log.error("container_type_code is None")
-                return False, "上下文信息中缺少容器类型"
-            
-            # if container_type_code in self.rack_type_collection:
-            logic_no = container.get("logicNo", None)
-
-            # 对机器化学家上定义的容器类型和槽位类型做一层映射，使其对应到机器人底层定义的容器类型和槽位类型
-            # container_robot_type_code = self.container_type_code_map.get(container_type_code)
-            # slot_type_code = self.slot_type_map.get(container_type_code)
-
-            if logic_no is None:
-                log.error("logic_no is None")
-                log.error("缺少容器逻辑编号，跳过当前容器")
-                continue
-            if container_type_code == "container_sample_2_4ml":
-                logic_no += 14
-            if container_type_code == "container_sample_3_4ml":
-                logic_no += 28
-
-            container_info = {
-                "containerLogicNo": logic_no, 
-                "containerTypeCode": container_type_code
-            }
-            self.rack_type_collection[container_type_code].append(container_info)
+    def set_liquid_handling_info_operate(self, _task_id, param, context, rack_containers=None):
+        """
+        移液指令生成
+        rack_containers: 已整理的容器信息, 为空时从上下文中整理
+        """
+        # 规划耗时, 不含等待机器人执行的时间
+        plan_seconds = 0.0
+        plan_start = time.perf_counter()
+        log.info("上下文: %s", LazyText(context))
+        if rack_containers is None:
+            rack_containers = self.collect_rack_containers(context)
 
         # 操作集合，按原液瓶排序
         operation_dict = {}
-        for i in range(1, 13):
-            operation_dict[i] = []
+        for bottle in self.deck.bottles:
+            operation_dict[bottle.no] = []
 
-        self.parse_operation(param.get("param4mlRack1"), operation_dict, "container_sample_1_4ml")        
-        self.parse_operation(param.get("param4mlRack2"), operation_dict, "container_sample_2_4ml")
-        self.parse_operation(param.get("param4mlRack3"), operation_dict, "container_sample_3_4ml")
-        self.parse_operation(param.get("param20mlRack1"), operation_dict, "container_bottle_20ml")
+        for rack in self.deck.racks_by_offset:
+            self.parse_operation(param.get(rack.operate_param), operation_dict, rack.container_type_code, rack_containers)
 
         # 迭代所有原液瓶
-        for i in range(1,13):
+        for bottle in self.deck.bottles:
+            i = bottle.no
             if len(operation_dict[i]) == 0:
                 continue
 
@@ -536,22 +504,23 @@ class LiquidHandlingGateway(GetwayBase):
 
             operations = operation_dict[i]
             # 开盖 原液瓶
-            source_id = self.robot.get_bottle_location(i)
-            open_command_type_put = self.robot.get_open_lid_command_string(i, "put")
-            open_command_type_take = self.robot.get_open_lid_command_string(i, "take")
-            close_command_type_put = self.robot.get_close_lid_command_string(i, "put")
-            close_command_type_take = self.robot.get_close_lid_command_string(i, "take")
-
-            if i > 0 and i <= 2:
+            source_id = bottle.location
+            suck_command_type = bottle.suck_command
+            open_command_type_put = bottle.open_put
+            open_command_type_take = bottle.open_take
+            close_command_type_put = bottle.close_put
+            close_command_type_take = bottle.close_take
+
+            if bottle.lid_station:
                 # 4ml两个固定位置放瓶盖 12 和 13
-                solution_4ml = i - 1
-                open_source_params.append(self.robot.create_move_command(self.lid_operation_station, self.material_station, 0, i - 1, self.sample_container_4ml, self.sample_slot_4ml))
-                open_source_params.append(self.robot.open_lid_command(self.lid_operation_station, self.sample_open_command_4ml_start, solution_4ml))
-                open_source_params.append(self.robot.create_move_command(self.material_station, self.lid_operation_station, i - 1, 0, self.sample_container_4ml, self.sample_slot_4ml))
+                solution_4ml = source_id
+                open_source_params.append(self.robot.create_move_command(self.lid_operation_station, self.material_station, 0, source_id, self.sample_container_4ml, self.sample_slot_4ml))
+                open_source_params.append(self.robot.open_lid_command(self.lid_operation_station, bottle.open_start, solution_4ml))
+                open_source_params.append(self.robot.create_move_command(self.material_station, self.lid_operation_station, source_id, 0, self.sample_container_4ml, self.sample_slot_4ml))
                 # 关盖
-                close_source_params.append(self.robot.create_move_command(self.lid_operation_station, self.material_station, 0, i - 1, self.sample_container_4ml, self.sample_slot_4ml))
-                close_source_params.append(self.robot.close_lid_command(self.lid_operation_station, self.sample_close_command_4ml_start, solution_4ml))
-                close_source_params.append(self.robot.create_move_command(self.material_station, self.lid_operation_station, i - 1, 0, self.sample_container_4ml, self.sample_slot_4ml))
+                close_source_params.append(self.robot.create_move_command(self.lid_operation_station, self.material_station, 0, source_id, self.sample_container_4ml, self.sample_slot_4ml))
+                close_source_params.append(self.robot.close_lid_command(self.lid_operation_station, bottle.close_start, solution_4ml))
+                close_source_params.append(self.robot.create_move_command(self.material_station, self.lid_operation_station, source_id, 0, self.sample_container_4ml, self.sample_slot_4ml))
             else:
                 # 开原液瓶盖
                 open_source_params.append(self.robot.open_lid_command(self.material_station, open_command_type_put, source_id))
@@ -580,9 +549,10 @@ class LiquidHandlingGateway(GetwayBase):
                 container_type_code = operation["container_type_code"]
                 os_bottle_volumn = operation["os_bottle_volumn"]
                 volumn_dict[container_type_code] = os_bottle_volumn
-                if container_type_code == "container_sample_1_4ml" or container_type_code == "container_sample_2_4ml" or container_type_code == "container_sample_3_4ml":
+                rack_size = self.deck.get_rack(container_type_code).size
+                if rack_size == "4ml":
                     operations_4ml.extend(operate_bottles)
-                if container_type_code == "container_bottle_20ml":
+                elif rack_size == "20ml":
                     operations_20ml.extend(operate_bottles)
 
             if len(operations_20ml) > 0:
@@ -606,7 +576,8 @@ class LiquidHandlingGateway(GetwayBase):
 
                 #吸液和滴液 
                 for operation_20ml in operations_20ml:
-                    params.append(self.robot.suck_command(self.material_station, self.robot.get_suck_command_string(i), self.robot.get_bottle_location(i), volumn_dict["container_bottle_20ml"]))
+                    current_contianer_type_code = self.logic_no_to_sample_id(operation_20ml, "20ml")
+                    params.append(self.robot.suck_command(self.material_station, suck_command_type, source_id, volumn_dict[current_contianer_type_code]))
                     params.append(self.robot.drop_command(self.sample_station, self.drop_20ml, operation_20ml))
                 
                 params.append(self.robot.uninstall_tip_command(self.reclycle_station))
@@ -645,7 +616,7 @@ class LiquidHandlingGateway(GetwayBase):
                 for operation_4ml in operation_4ml_head:
                     # 滴液当前批次
                     current_contianer_type_code = self.logic_no_to_sample_id(operation_4ml)
-                    params.append(self.robot.suck_command(self.material_station, self.robot.get_suck_command_string(i), self.robot.get_bottle_location(i), volumn_dict[current_contianer_type_code]))
+                    params.append(self.robot.suck_command(self.material_station, suck_command_type, source_id, volumn_dict[current_contianer_type_code]))
                     params.append(self.robot.drop_command(self.sample_station, self.drop_4ml, operation_4ml))
 
                 # 卸载tip头
@@ -660,43 +631,123 @@ class LiquidHandlingGateway(GetwayBase):
                     params.append(self.robot.close_lid_command(self.lid_operation_station, self.sample_close_command_4ml, lid_4ml_index))
                     params.append(self.robot.create_move_command(self.sample_station, self.lid_operation_station, 0, operation_4ml, self.sample_container_4ml, self.sample_slot_4ml))
             
-            log.info(params)
+            log.info("原液瓶%s 生成指令: %s", i, CommandSummary(params))
+            plan_seconds += time.perf_counter() - plan_start
+            record_span("plan.liquid_handling", plan_start, bottle=i, commands=len(params))
             if self.robot.execute_robot_command(params, self.instance_id, self.pipeline_id) is False:
                 log.error("执行机械臂命令失败")
                 return False, "执行机械臂命令失败", None
-            log.info("执行机械臂命令成功")   
+            if not self.dry_run:
+                log.info("执行机械臂命令成功")
+            plan_start = time.perf_counter()
+        plan_seconds += time.perf_counter() - plan_start
+        if not self.dry_run:
+            metrics.PLAN_SECONDS.observe(plan_seconds, "liquid_handling")
         return True, "执行成功", None     
 
-    def logic_no_to_sample_id(self, logic_no):
-        no = int(logic_no / 14) 
-        if no == 0:
-            return "container_sample_1_4ml"
-        elif no == 1:
-            return "container_sample_2_4ml"
-        elif no == 2:
-            return "container_sample_3_4ml"
+    def logic_no_to_sample_id(self, logic_no, size="4ml"):
+        rack = self.deck.get_rack_by_position(size, logic_no)
+        if rack is None:
+            return None
+        return rack.container_type_code
 
-    def parse_operation(self, operation_list, operation_dict, container_type_code):
+    def parse_operation(self, operation_list, operation_dict, container_type_code, rack_containers):
         """
         解析原液瓶列表
+        同一样品架上所有原液瓶共用同一份已整理的容器列表
         """
+        bottles = rack_containers[container_type_code]
         for data in operation_list.get("operateList"):
             os_bottle_no = data["originalSolutionBottle"]
             os_bottle_volumn = data["originalSolutionVolume"]
-            bottles = []
-            for bottle_info in self.rack_type_collection[container_type_code]:
-                logic_no = bottle_info.get("containerLogicNo") - 1
-                if logic_no in bottles:
-                    log.error("逻辑编号重复")
-                    continue
-                bottles.append(logic_no)
-                
             operation_dict[os_bottle_no].append({
                 "os_bottle_volumn": os_bottle_volumn,
                 "container_type_code": container_type_code,
                 "operate_bottles": bottles
             })
 
+    def get_tips_metrics(self):
+        count = sum(1 for tips_info in self.tip_box.tip_boxs_dict["tipBoxs"] if not tips_info["isEmpty"])
+        return [((), count)]
+
+    def get_stock_volume_metrics(self):
+        return [((solution_type, location), value)
+                for solution_type, values in self.solution_manager.solution_info_dict.items()
+                for location, value in enumerate(values)]
+
+    def used_source_bottles(self, param):
+        """
+        请求中使用的原液瓶编号
+        """
+        bottles = set()
+        for rack in self.deck.racks:
+            operate_param = param.get(rack.operate_param) or {}
+            for data in operate_param.get("operateList") or []:
+                bottles.add(data["originalSolutionBottle"])
+        return sorted(bottles)
+
+    def estimate_liquid_handling_tips(self, param, rack_containers):
+        """
+        移液消耗的Tip头数量, 与 set_liquid_handling_info_operate 的取Tip头规则一致
+        每个原液瓶: 有20ml容器时1个, 4ml容器每12个一批, 每批1个
+        """
+        counts = {}
+        for rack in self.deck.racks:
+            operate_param = param.get(rack.operate_param) or {}
+            for data in operate_param.get("operateList") or []:
+                count = counts.setdefault(data["originalSolutionBottle"], {"4ml": 0, "20ml": 0})
+                count[rack.size] += len(rack_containers[rack.container_type_code])
+        return sum((1 if count["20ml"] > 0 else 0) + len(split_array(range(count["4ml"])))
+                   for count in counts.values())
+
+    def estimate_discharge_tips(self, rack_containers):
+        """
+        排液消耗的Tip头数量, 与 discharge_liquid_operate 的分批规则一致
+        """
+        sizes = [self.deck.get_rack(container_type_code).size
+                 for container_type_code, positions in rack_containers.items() for _ in positions]
+        tips = 0
+        lid_index_4ml = 0
+        lid_index_20ml = 0
+        while len(sizes) > 0:
+            if sizes.pop() == "4ml":
+                lid_index_4ml += 1
+            else:
+                lid_index_20ml += 1
+            if lid_index_4ml >= self.deck.lid_capacity["4ml"] - 1 or lid_index_20ml > self.deck.lid_capacity["20ml"] - 1 \
+                    or len(sizes) == 0:
+                tips += 1
+                lid_index_4ml = 0
+                lid_index_20ml = 0
+        return tips
+
+    def estimate_required_tips(self, param, context, exchange=False):
+        """
+        估算请求需要的Tip头数量, 溶液交换每个循环先排液再移液
+        """
+        rack_containers = self.collect_rack_containers(context)
+        tips = self.estimate_liquid_handling_tips(param, rack_containers)
+        if exchange:
+            tips = (tips + self.estimate_discharge_tips(rack_containers)) * param.get("cycleCount", 1)
+        return tips
+
+    def stock_available(self, bottle_nos):
+        """
+        使用的原液瓶余量均不低于预警值
+        """
+        for bottle_no in bottle_nos:
+            bottle = self.deck.get_bottle(bottle_no)
+            if bottle is None:
+                return False
+            solution_type = f"solutionInfo{bottle.spec}"
+            values = self.solution_manager.solution_info_dict.get(solution_type)
+            if values is None or bottle.location >= len(values):
+                # 未登记余量的原液瓶不做检查
+                continue
+            if values[bottle.location] < self.solution_manager.get_warning_value(solution_type):
+                return False
+        return True
+
     def get_tips_count_operate(self, task_id, param):
         data = {
             "tipsCount": self.tip_box.get_tip_useful_count(),
@@ -722,8 +773,9 @@ class LiquidHandlingGateway(GetwayBase):
         
 class LiquidHandlingRobot(CommonRobotGateway):
 
-    def __init__(self, robot_command_url, robot_callback_url, robot_id, machine_code):
-        super().__init__(robot_command_url, robot_callback_url, robot_id, machine_code)
+    def __init__(self, robot_command_url, robot_callback_url, robot_id, machine_code, deck=None, request_gzip=False):
+        super().__init__(robot_command_url, robot_callback_url, robot_id, machine_code, request_gzip)
+        self.deck = deck or DeckLayout()
         self.sourec_workstation = ""
         self.target_workstation = ""
 
@@ -731,48 +783,31 @@ class LiquidHandlingRobot(CommonRobotGateway):
 
     # 根据原液瓶容器位置获取开盖指令类型
     def get_open_lid_command_string(self, location, move_type = "put"):
-        if location > 0 and location <= 2:
-            return "open_slot_4ml"
-        elif location > 2 and location <= 10:
-            return "open_slot_50ml" + f"_{move_type}"
-        elif location > 10 and location <= 12:
-            return "open_slot_100ml" + f"_{move_type}"
-        else:
+        bottle = self.deck.get_bottle(location)
+        if bottle is None:
             return ""
-        
+        return bottle.open_lid_command_string(move_type)
     
     # 根据原液瓶容器位置获取关盖指令类型
     def get_close_lid_command_string(self, location, move_type = "put"):
-        if location > 0 and location <= 2:
-            return "close_slot_4ml" 
-        elif location > 2 and location <= 10:
-            return "close_slot_50ml" + f"_{move_type}"
-        elif location > 10 and location <= 12:
-            return "close_slot_100ml" + f"_{move_type}"
-        else:
+        bottle = self.deck.get_bottle(location)
+        if bottle is None:
             return ""
+        return bottle.close_lid_command_string(move_type)
         
     # 根据原液瓶容器位置获取吸液指令类型
     def get_suck_command_string(self, location):
-        if location > 0 and location <= 2:
-            return "suck_from_4ml"
-        elif location > 2 and location <= 10:
-            return "suck_from_50ml"
-        elif location > 10 and location <= 12:
-            return "suck_from_100ml"
-        else:
+        bottle = self.deck.get_bottle(location)
+        if bottle is None:
             return ""
+        return bottle.suck_command
         
     # 根据原液瓶编号获取指令中的位置
     def get_bottle_location(self, bottle_id):
-        if bottle_id > 0 and bottle_id <= 2:
-            return bottle_id - 1 
-        elif bottle_id > 2 and bottle_id <= 10:
-            return bottle_id - 3
-        elif bottle_id > 10 and bottle_id <= 12:
-            return bottle_id - 11
-        else:
+        bottle = self.deck.get_bottle(bottle_id)
+        if bottle is None:
             return -1
+        return bottle.location
         
     """
     生成机器人开盖指令
@@ -784,17 +819,7 @@ class LiquidHandlingRobot(CommonRobotGateway):
         source_name: 源工作站名称
         bottle_id: 待开盖原液瓶编号
         """
-        operation = {
-            "operation":command,
-            "source":{
-                "slot_4ml_position":bottle_id,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation":source_name
-            }
-        }
-        return operation
+        return RobotCommand(command, source_name, "slot_4ml_position", bottle_id, source_name)
 
     """
     生成机器人关盖指令
@@ -805,17 +830,7 @@ class LiquidHandlingRobot(CommonRobotGateway):
         source_name: 源工作站名称
         bottle_id: 待关盖原液瓶编号
         """
-        operation = {
-            "operation": command,
-            "source":{
-                "slot_4ml_position":bottle_id,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation":source_name
-            }
-        }
-        return operation
+        return RobotCommand(command, source_name, "slot_4ml_position", bottle_id, source_name)
     
     """
     生成机器人滴液指令
@@ -825,17 +840,7 @@ class LiquidHandlingRobot(CommonRobotGateway):
         滴液指令
         source_name: 源工作站名称
         """
-        operation = {
-            "operation" : command,
-            "source":{
-                "slot_4ml_position": location_no,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation":source_name
-            }
-        }
-        return operation
+        return RobotCommand(command, source_name, "slot_4ml_position", location_no, source_name)
     
     """
     生成机器人排液指令
@@ -847,17 +852,7 @@ class LiquidHandlingRobot(CommonRobotGateway):
         location_no: 目标容器编号
         volumn: 滴液/吸液量 to_arg
         """
-        operation = {
-            "operation" : "drip_to_recycle",
-            "source":{
-                "slot_4ml_position": location_no,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation":source_name
-            }
-        }
-        return operation
+        return RobotCommand("drip_to_recycle", source_name, "slot_4ml_position", location_no, source_name)
 
     def suck_command(self, source_name, command, location_no, volumn):
         """
@@ -866,47 +861,16 @@ class LiquidHandlingRobot(CommonRobotGateway):
         location_no: 目标容器编号
         volumn: 滴液/吸液量 to_arg
         """
-        operation = {
-            "operation" : command,
-            "source":{
-                "slot_4ml_position": location_no,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation": source_name
-            },
-            "tool_arg":volumn
-        }    
-        return operation
+        return RobotCommand(command, source_name, "slot_4ml_position", location_no, source_name, tool_arg=volumn)
     
     def install_tip_command(self, source_name, location_no):
         """
         安装吸液头指令
         """
-        operation = {
-            "operation" : "move_from_drip",
-            "source":{
-                "slot_4ml_position": location_no,
-                "workstation":source_name
-            },
-            "target":{
-                "workstation": source_name
-            }
-        } 
-        return operation
+        return RobotCommand("move_from_drip", source_name, "slot_4ml_position", location_no, source_name)
     
     def uninstall_tip_command(self, workstation):
         """
         卸下吸液头指令
         """
-        operation = {
-            "operation" : "move_to_drip",
-            "source":{
-                "slot_4ml_position": 0,
-                "workstation": workstation
-            },
-            "target":{
-                "workstation": workstation
-            }
-        }
-        return operation
+        return RobotCommand("move_to_drip", workstation, "slot_4ml_position", 0, workstation)
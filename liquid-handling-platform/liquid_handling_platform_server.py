@@ -1,47 +1,158 @@
+import os
+
+# 最先导入, 统计启动各阶段耗时
+import startup_timing
+import cooperative
+# 协作模式需在导入其他模块之前打补丁
+cooperative.init(os.environ.get("LIQUID_HANDLING_SETTINGS") or cooperative.DEFAULT_SETTINGS)
+
 import threading
 import time
-from flask import Flask, json, jsonify, request, send_from_directory
+from flask import Blueprint, Flask, Response, json, jsonify, request, send_from_directory
 import json
 
 from liquid_handling_platform import LiquidHandlingGateway
 from logger_handler import create_logger
+from metrics import render_metrics
+from sampling_profiler import get_profile, start_profile
+from tracing import get_trace, list_traces
+import traffic_capture
 from operate_wrapper import operate, operate_not_lock, operate_sync
-from gevent import pywsgi
+from plan_dry_run import plan_request
 
-app = Flask(__name__)
 log = create_logger("INFO", "Main")
+startup_timing.mark("imports")
+
+def create_device_blueprint(gateway, name="liquid_handling"):
+    """
+    单台设备的业务接口, 路由绑定到传入的网关实例
+    同一进程运行多台设备时每台设备注册一个蓝图
+    """
+    bp = Blueprint(name, __name__)
+
+    @bp.route('/setLiquidHandlingInfo', methods=['POST'])
+    def setLiquidHandlingInfo():
+        return operate(gateway, request.data, gateway.set_liquid_handling_info_operate, use_context=True,
+                       schema=gateway.request_schemas["setLiquidHandlingInfo"], dedupe=True)
+
+    @bp.route('/setSolutionExchengeInfo', methods=['POST'])
+    def setSolutionExchengeInfo():
+        return operate(gateway, request.data, gateway.set_solution_exchenge_info, use_context=True,
+                       schema=gateway.request_schemas["setSolutionExchengeInfo"], dedupe=True)
+
+    @bp.route('/resetTipBoxs', methods=['POST'])
+    def reset_tip_boxs():
+        return operate(gateway, request.data, gateway.reset_tips_operate)
+
+    @bp.route('/getTipsCount', methods=['POST'])
+    def get_tips_state():
+        return operate_sync(gateway, request.data, gateway.get_tips_count_operate, have_lock=False)
+
+    @bp.route('/getStockSolutionInfo', methods=["POST"])
+    def get_stock_solution_info():
+        return operate_sync(gateway, request.data, gateway.get_stock_solution_info_operate, have_lock=False)
 
-def run():
-    log.info('--- liquid handling gateway start ---')
-    server = pywsgi.WSGIServer(('0.0.0.0', liquid_handling_gateway.port), app)
+    @bp.route("/setStockSolutionInfo", methods=["POST"])
+    def set_stock_solution_info():
+        return operate_sync(gateway, request.data, gateway.set_stock_solution_info_operate, have_lock=False,
+                            schema=gateway.request_schemas["setStockSolutionInfo"])
+
+    @bp.route("/debug/cancel/<instance_id>", methods=["POST"])
+    def cancel_instance(instance_id):
+        """
+        取消实例进行中的机器人指令等待, 任务按执行失败回调; 需使用 asyncio 机器人客户端
+        """
+        cancelled = gateway.robot.cancel_instance(instance_id)
+        if cancelled is None:
+            return jsonify({"code": 409, "msg": "当前机器人客户端不支持取消, 需配置 ROBOT_CLIENT_BACKEND 为 asyncio"}), 409
+        if cancelled == 0:
+            return jsonify({"code": 404, "msg": f"实例{instance_id}没有进行中的指令"}), 404
+        return jsonify({"code": 200, "msg": f"已取消实例{instance_id}的{cancelled}个指令等待"}), 200
+
+    @bp.route("/plan", methods=["POST"])
+    def plan():
+        """
+        规划预演: /plan?type=liquid_handling|discharge|exchange&commands=false&unlimitedTips=true
+        不占用设备, 不消耗Tip头, 不调用机器人
+        """
+        include_commands = request.args.get("commands", "true").lower() != "false"
+        unlimited_tips = request.args.get("unlimitedTips", "false").lower() == "true"
+        return jsonify(plan_request(gateway, request.data, request.args.get("type", "liquid_handling"),
+                                    unlimited_tips, include_commands)), 200
+
+    return bp
+
+def create_app(gateway):
+    """
+    创建单台设备的应用: 业务接口 + 进程级的指标与调试接口
+    """
+    app = Flask(__name__)
+    app.register_blueprint(create_device_blueprint(gateway))
+    app.register_blueprint(debug_blueprint)
+    return app
+
+def run(gateway, app):
+    with startup_timing.phase("server"):
+        from gevent import pywsgi
+    startup_timing.ready()
+    log.info('--- liquid handling gateway start --- %s', startup_timing.summary())
+    server = pywsgi.WSGIServer(('0.0.0.0', gateway.port), app)
     server.serve_forever()
     log.info('--- liquid handling gateway stop ---')
 
-@app.route('/setLiquidHandlingInfo', methods=['POST'])
-def setLiquidHandlingInfo():
-    return operate(liquid_handling_gateway, request.data, liquid_handling_gateway.set_liquid_handling_info_operate, use_context=True)
+# 指标与调试接口, 进程内所有设备共用
+debug_blueprint = Blueprint("debug", __name__)
+
+@debug_blueprint.before_app_request
+def capture_inbound_request():
+    # 只录制业务请求, 不录制调试与指标接口
+    if traffic_capture.capture_enable and request.method == "POST" and not request.path.startswith("/debug"):
+        traffic_capture.record("inbound", path=request.path, body=request.get_data(as_text=True))
+
+@debug_blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
-@app.route('/setSolutionExchengeInfo', methods=['POST'])
-def setSolutionExchengeInfo():
-    return operate(liquid_handling_gateway, request.data, liquid_handling_gateway.set_solution_exchenge_info, use_context=True)
+@debug_blueprint.route("/debug/startup", methods=["GET"])
+def get_startup():
+    return jsonify(startup_timing.get_startup()), 200
 
-@app.route('/resetTipBoxs', methods=['POST'])
-def reset_tip_boxs():
-    return operate(liquid_handling_gateway, request.data, liquid_handling_gateway.reset_tips_operate)
+@debug_blueprint.route("/debug/traces", methods=["GET"])
+def get_traces():
+    return jsonify(list_traces()), 200
 
-@app.route('/getTipsCount', methods=['POST'])
-def get_tips_state():
-    return operate_sync(liquid_handling_gateway, request.data, liquid_handling_gateway.get_tips_count_operate, have_lock=False)
+@debug_blueprint.route("/debug/trace/<task_id>", methods=["GET"])
+def get_task_trace(task_id):
+    trace = get_trace(task_id)
+    if trace is None:
+        return jsonify({"code": 404, "msg": f"未找到任务{task_id}的追踪记录"}), 404
+    return jsonify(trace), 200
 
-@app.route('/getStockSolutionInfo', methods=["POST"])
-def get_stock_solution_info():
-    return operate_sync(liquid_handling_gateway, request.data, liquid_handling_gateway.get_stock_solution_info_operate, have_lock=False)
+@debug_blueprint.route("/debug/profile", methods=["POST"])
+def start_sampling_profile():
+    """
+    开始采样: /debug/profile?seconds=30&interval_ms=10
+    """
+    seconds = request.args.get("seconds", 10, type=float)
+    interval_ms = request.args.get("interval_ms", 10, type=float)
+    session, msg = start_profile(seconds, interval_ms / 1000.0)
+    if session is None:
+        return jsonify({"code": 409, "msg": msg}), 409
+    return jsonify({"code": 200, "msg": "采样已开始", "data": session.status()}), 202
 
-@app.route("/setStockSolutionInfo", methods=["POST"])
-def set_stock_solution_info():
-    return operate_sync(liquid_handling_gateway, request.data, liquid_handling_gateway.set_stock_solution_info_operate, have_lock=False)
+@debug_blueprint.route("/debug/profile/<int:session_id>", methods=["GET"])
+def get_sampling_profile(session_id):
+    session = get_profile(session_id)
+    if session is None:
+        return jsonify({"code": 404, "msg": f"未找到采样任务{session_id}"}), 404
+    if session.running:
+        return jsonify({"code": 202, "msg": "采样进行中", "data": session.status()}), 202
+    return Response(session.collapsed(), mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename=profile-{session_id}.collapsed"})
 
 if __name__ == "__main__": 
     liquid_handling_gateway = LiquidHandlingGateway()
-    run()
+    with startup_timing.phase("app"):
+        app = create_app(liquid_handling_gateway)
+    run(liquid_handling_gateway, app)
     
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+结构化日志查询工具
+按 task_id / instance_id / instruction_id 还原单个任务的时间线
+需在配置中开启 STRUCTURED_LOG_ENABLE, 网关才会写入 .jsonl 日志
+
+python log_query.py --task-id 10001
+python log_query.py --instance-id 1518265754714114 --date 20241024 --level ERROR
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+
+from logger_handler import log_dir
+
+
+def iter_log_files(directory, date=None):
+    pattern = f"{date}_*.jsonl*" if date else "*_*.jsonl*"
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        if path.endswith(".tmp"):
+            continue
+        yield path
+
+
+def iter_records(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def match_record(record, filters):
+    for key, value in filters.items():
+        if str(record.get(key)) != value:
+            return False
+    return True
+
+
+def query_timeline(directory, filters, date=None, level=None):
+    """
+    查询满足条件的日志并按时间排序
+    """
+    records = []
+    for path in iter_log_files(directory, date):
+        for record in iter_records(path):
+            if level is not None and record.get("level") != level:
+                continue
+            if match_record(record, filters):
+                records.append(record)
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records
+
+
+def print_timeline(records, gap_threshold):
+    if len(records) == 0:
+        print("未找到匹配的日志")
+        return
+    start = records[0]["ts"]
+    previous = start
+    for record in records:
+        ts = record["ts"]
+        gap = ts - previous
+        marker = " <<<" if gap >= gap_threshold else ""
+        instruction = f" [指令{record['instruction_id']}]" if "instruction_id" in record else ""
+        print(f"{record['time']} +{ts - start:9.3f}s (间隔{gap:8.3f}s){marker} {record['level']:<5} "
+              f"{record['thread']} {record['logger']}{instruction} - {record['msg']}")
+        previous = ts
+    print(f"共{len(records)}条日志, 总耗时{records[-1]['ts'] - start:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按任务还原结构化日志时间线")
+    parser.add_argument("--task-id", help="任务编号")
+    parser.add_argument("--instance-id", help="实例编号")
+    parser.add_argument("--instruction-id", help="机器人指令编号")
+    parser.add_argument("--log-dir", default=log_dir, help="日志目录")
+    parser.add_argument("--date", help="日志日期, 如 20241024")
+    parser.add_argument("--level", help="只显示指定级别, 如 ERROR")
+    parser.add_argument("--gap", type=float, default=5.0, help="相邻日志间隔超过该秒数时标记")
+    args = parser.parse_args()
+
+    filters = {}
+    if args.task_id:
+        filters["task_id"] = args.task_id
+    if args.instance_id:
+        filters["instance_id"] = args.instance_id
+    if args.instruction_id:
+        filters["instruction_id"] = args.instruction_id
+    if len(filters) == 0:
+        parser.error("至少指定 --task-id / --instance-id / --instruction-id 之一")
+
+    print_timeline(query_timeline(args.log_dir, filters, args.date, args.level), args.gap)
+
+
+if __name__ == "__main__":
+    main()
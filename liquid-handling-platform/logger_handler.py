@@ -1,94 +1,344 @@
 from datetime import datetime, timedelta
+import atexit
+import contextvars
+import gzip
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler, SysLogHandler
+from logging.handlers import QueueHandler, QueueListener
 import os
+import queue
+import shutil
+import threading
 import time
 import re
 
 backup_days = 30
+# 日志目录总大小上限(MB), 0表示不限制
+max_total_mb = 1024
+# 日志维护任务执行间隔(秒)
+maintenance_interval = 3600
 remote_address = "192.168.1.229"
 log_dir = "./logs"
 
+# 指令完整内容输出到单独的调试日志, 默认关闭
+DUMP_LOGGER_NAME = "CommandDump"
+
+# 大对象日志默认截断长度
+MAX_LOG_TEXT_LENGTH = 2048
+
+# 结构化(JSON lines)日志开关, 开启后每条日志额外写入一份 .jsonl, 默认关闭以免重复写盘
+# 配置项 STRUCTURED_LOG_ENABLE, 排查问题需要 log_query.py 时开启
+structured_log_enable = False
+
+# 日志关联信息 task_id / instance_id / instruction_id, 随上下文在线程间传递
+_log_context = contextvars.ContextVar("log_context", default={})
+
+# 进程内共享的日志队列Handler, 由后台写线程统一输出到文件和控制台
+_queue_handler = None
+_queue_listener = None
+_log_maintenance = None
+_setup_lock = threading.Lock()
+
 def make_dir(make_dir_path):
     path = make_dir_path.strip()
     if not os.path.exists(path):
         os.makedirs(path)
 
 class DailyFileHandler(logging.FileHandler):
-    def __init__(self, log_dir, filename_prefix="gateway",  backup_days=30):
+    def __init__(self, log_dir, filename_prefix="gateway",  backup_days=30, suffix=".log"):
         self.log_dir = log_dir
         self.filename_prefix = filename_prefix
-        self.current_date = datetime.now().strftime("%Y%m%d")
+        self.suffix = suffix
+        now = datetime.now()
+        self.current_date = now.strftime("%Y%m%d")
+        # 下一次零点的时间戳, 每条日志只需比较一次时间戳
+        self._next_rollover = self._compute_next_rollover(now)
         os.makedirs(log_dir, exist_ok=True)
         self.backup_days = backup_days
         current_path = self._get_today_log_path()
-        super().__init__(current_path, encoding="utf-8")
-        self._cleanup_old_logs()
+        super().__init__(current_path, encoding="utf-8", delay=True)
+
+    @staticmethod
+    def _compute_next_rollover(now):
+        next_day = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return next_day.timestamp()
 
     def _get_today_log_path(self):
         return os.path.join(
             self.log_dir,
-            f"{self.current_date}_{self.filename_prefix}.log"
+            f"{self.current_date}_{self.filename_prefix}{self.suffix}"
         )
     
-    def _cleanup_old_logs(self):
-        """定期删除旧日志文件"""
-        try:
-            now = datetime.now()
-            # 计算截止日期
-            cutoff_date = now - timedelta(days=backup_days)
-            
-            # 遍历日志目录
-            for filename in os.listdir(self.log_dir):
-                filepath = os.path.join(self.log_dir, filename)
-                if os.path.isfile(filepath):
-                    # 匹配格式：20241024_gateway.log
-                    match = re.match(r'(\d{8})_' + re.escape(self.filename_prefix) + r'\.log', filename)
-                    if match:
-                        file_date_str = match.group(1)
-                        try:
-                            file_date = datetime.strptime(file_date_str, "%Y%m%d")
-                            # 如果文件日期早于截止日期，则删除
-                            if file_date < cutoff_date:
-                                os.remove(filepath)
-                                print(f"Deleted old log file: {filename}")
-                        except ValueError:
-                            # 日期解析失败，跳过此文件
-                            continue
-        except Exception as e:
-            print(f"Error during log cleanup: {e}")
-
     def emit(self, record):
-        today = datetime.now().strftime("%Y%m%d")
-        if today != self.current_date:
+        if record.created >= self._next_rollover:
+            record_time = datetime.fromtimestamp(record.created)
             self.close()
-            self.current_date = today
+            self.current_date = record_time.strftime("%Y%m%d")
+            self._next_rollover = self._compute_next_rollover(record_time)
             self.baseFilename = self._get_today_log_path()
             self.stream = self._open()
         super().emit(record)
 
+class LogMaintenance:
+    """
+    日志维护后台任务, 按计划执行, 不占用写日志线程
+    1. 压缩前一天及更早的日志
+    2. 删除超过保留天数的日志
+    3. 日志目录总大小超过上限时从最旧的日志开始删除
+    """
+    # 匹配格式：20241024_gateway.log / 20241024_gateway.jsonl / 20241024_gateway.log.gz
+    file_pattern = re.compile(r'^(\d{8})_[\w\-]+\.(log|jsonl)(\.gz)?$')
+    # 最近修改时间在此秒数内的文件视为仍在写入, 暂不压缩
+    active_grace_seconds = 600
+
+    def __init__(self, log_dir, backup_days, max_total_mb, interval):
+        self.log_dir = log_dir
+        self.backup_days = backup_days
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="log-maintenance-thread", daemon=True)
+        self._thread.start()
+
+    def configure(self, backup_days, max_total_mb, interval):
+        self.backup_days = backup_days
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.interval = interval
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error during log maintenance: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def _list_log_files(self):
+        files = []
+        for filename in os.listdir(self.log_dir):
+            match = self.file_pattern.match(filename)
+            if match is None:
+                continue
+            filepath = os.path.join(self.log_dir, filename)
+            if not os.path.isfile(filepath):
+                continue
+            try:
+                file_date = datetime.strptime(match.group(1), "%Y%m%d")
+            except ValueError:
+                # 日期解析失败，跳过此文件
+                continue
+            files.append((file_date, filepath))
+        files.sort()
+        return files
+
+    def _compress(self, filepath):
+        with open(filepath, "rb") as source, gzip.open(filepath + ".gz.tmp", "wb") as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(filepath + ".gz.tmp", filepath + ".gz")
+        os.remove(filepath)
+
+    def run_once(self):
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff_date = now - timedelta(days=self.backup_days)
+
+        for file_date, filepath in self._list_log_files():
+            try:
+                if file_date < cutoff_date:
+                    # 如果文件日期早于截止日期，则删除
+                    os.remove(filepath)
+                    print(f"Deleted old log file: {filepath}")
+                elif file_date < today and not filepath.endswith(".gz") \
+                        and time.time() - os.path.getmtime(filepath) > self.active_grace_seconds:
+                    self._compress(filepath)
+            except OSError as e:
+                print(f"Error during log maintenance of {filepath}: {e}")
+
+        if self.max_total_bytes <= 0:
+            return
+        files = [(file_date, filepath, os.path.getsize(filepath)) for file_date, filepath in self._list_log_files()]
+        total = sum(size for _, _, size in files)
+        for file_date, filepath, size in files:
+            # 当天的日志仍在写入, 不参与删除
+            if total <= self.max_total_bytes or file_date >= today:
+                break
+            try:
+                os.remove(filepath)
+                total -= size
+                print(f"Deleted log file over size budget: {filepath}")
+            except OSError as e:
+                print(f"Error during log maintenance of {filepath}: {e}")
+
+class LazyText:
+    """
+    延迟渲染的日志参数, 仅在日志真正输出时才转换为字符串, 并按长度截断
+    用法: log.info("上下文: %s", LazyText(context))
+    """
+    __slots__ = ("value", "max_length")
+
+    def __init__(self, value, max_length=MAX_LOG_TEXT_LENGTH):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) > self.max_length:
+            return f"{text[:self.max_length]}...(共{len(text)}字符)"
+        return text
+
+def bind_log_context(**fields):
+    """
+    在当前上下文中追加日志关联信息, 之后本上下文中的日志都会携带这些字段
+    """
+    context = dict(_log_context.get())
+    context.update({key: value for key, value in fields.items() if value is not None})
+    _log_context.set(context)
+
+def get_log_context():
+    return _log_context.get()
+
+def new_log_context(**fields):
+    """
+    复制当前上下文并绑定关联信息, 用于在新线程中执行任务
+    用法: threading.Thread(target=new_log_context(task_id=1).run, args=(func, ...))
+    """
+    context = contextvars.copy_context()
+    context.run(bind_log_context, **fields)
+    return context
+
+class LogContextFilter(logging.Filter):
+    """
+    在产生日志的线程中记录关联信息
+    """
+    def filter(self, record):
+        record.log_context = _log_context.get()
+        return True
+
+class JsonLineFormatter(logging.Formatter):
+    """
+    结构化日志, 每行一个JSON对象
+    """
+    def format(self, record):
+        data = {
+            "ts": record.created,
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "file": record.filename,
+            "func": record.funcName,
+            "line": record.lineno,
+            "msg": record.getMessage()
+        }
+        data.update(getattr(record, "log_context", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def _is_dump_record(record):
+    return record.name == DUMP_LOGGER_NAME
+
+def _is_not_dump_record(record):
+    return record.name != DUMP_LOGGER_NAME
+
+def _is_structured_record(record):
+    return structured_log_enable and record.name != DUMP_LOGGER_NAME
+
+def _setup_logging():
+    """
+    每个进程只创建一次文件和控制台Handler
+    各模块的日志只入队, 由后台写线程负责轮转、清理和输出
+    """
+    global _queue_handler, _queue_listener
+    with _setup_lock:
+        if _queue_handler is not None:
+            return _queue_handler
+        make_dir(log_dir)
+
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(threadName)s - %(filename)s - %(funcName)s - %(lineno)s - %(message)s'
+        )
+        # 1. 自定义每日文件 Handler
+        daily_handler = DailyFileHandler(log_dir, filename_prefix="gateway", backup_days=backup_days)
+        daily_handler.setFormatter(formatter)
+        daily_handler.addFilter(_is_not_dump_record)
+
+        # 2. 控制台处理器, 输出到sys.stderr
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        console_handler.addFilter(_is_not_dump_record)
+
+        # 3. 指令完整内容调试日志, 仅在开启时才会写入文件
+        dump_handler = DailyFileHandler(log_dir, filename_prefix="command_dump", backup_days=backup_days)
+        dump_handler.setFormatter(logging.Formatter('%(asctime)s - %(threadName)s - %(message)s'))
+        dump_handler.addFilter(_is_dump_record)
+
+        # 4. 结构化日志, 携带任务关联信息, 供 log_query.py 查询
+        json_handler = DailyFileHandler(log_dir, filename_prefix="gateway", backup_days=backup_days, suffix=".jsonl")
+        json_handler.setFormatter(JsonLineFormatter())
+        json_handler.addFilter(_is_structured_record)
+
+        log_queue = queue.SimpleQueue()
+        _queue_listener = QueueListener(log_queue, daily_handler, console_handler, dump_handler, json_handler,
+                                        respect_handler_level=True)
+        _queue_listener.start()
+        # 进程退出前写完队列中剩余的日志
+        atexit.register(_queue_listener.stop)
+
+        _queue_handler = QueueHandler(log_queue)
+        _queue_handler.addFilter(LogContextFilter())
+        return _queue_handler
+
+def start_log_maintenance(days=None, total_mb=None, interval=None):
+    """
+    启动(或重新配置)日志维护后台任务, 每个进程只有一个
+    """
+    global _log_maintenance
+    days = backup_days if days is None else days
+    total_mb = max_total_mb if total_mb is None else total_mb
+    interval = maintenance_interval if interval is None else interval
+    with _setup_lock:
+        if _log_maintenance is None:
+            make_dir(log_dir)
+            _log_maintenance = LogMaintenance(log_dir, days, total_mb, interval)
+            _log_maintenance.start()
+        else:
+            _log_maintenance.configure(days, total_mb, interval)
+    return _log_maintenance
+
 def create_logger(level='DEBUG', name=None):
-    make_dir(log_dir)
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    
-    # 移除原有轮转 Handler
-    for handler in logger.handlers[:]:
-        if isinstance(handler, logging.handlers.TimedRotatingFileHandler):
-            logger.removeHandler(handler)
-    
-    # 1. 添加自定义每日文件 Handler
-    daily_handler = DailyFileHandler(log_dir, filename_prefix="gateway", backup_days=backup_days)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(threadName)s - %(filename)s - %(funcName)s - %(lineno)s - %(message)s'
-    )
-    daily_handler.setFormatter(formatter)
-    logger.addHandler(daily_handler)
-    
-    # 2. 新增控制台处理器 [6,7](@ref)
-    console_handler = logging.StreamHandler()  # 输出到sys.stderr
-    console_handler.setLevel(level)  # 与控制台日志级别一致
-    console_handler.setFormatter(formatter)  # 复用相同格式
-    logger.addHandler(console_handler)
-    
-    return logger
\ No newline at end of file
+
+    queue_handler = _setup_logging()
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
+    return logger
+
+def create_dump_logger():
+    """
+    指令完整内容调试日志, 默认关闭, 由 enable_command_dump 开启
+    调用方需先判断 isEnabledFor(logging.DEBUG) 再生成大对象
+    """
+    logger = logging.getLogger(DUMP_LOGGER_NAME)
+    if _queue_handler not in logger.handlers:
+        logger.propagate = False
+        logger.setLevel(logging.CRITICAL + 1)
+        logger.addHandler(_setup_logging())
+    return logger
+
+def enable_command_dump(enable):
+    create_dump_logger().setLevel(logging.DEBUG if enable else logging.CRITICAL + 1)
+
+def enable_structured_log(enable):
+    global structured_log_enable
+    structured_log_enable = enable
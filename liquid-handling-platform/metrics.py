@@ -0,0 +1,191 @@
+"""
+进程内性能指标
+计数器/仪表/直方图, 以 Prometheus 文本格式从 /metrics 导出
+"""
+import bisect
+import threading
+
+# 已注册的全部指标, 按注册顺序导出
+_registry = []
+
+# 默认耗时直方图分桶(秒)
+DEFAULT_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    text = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs)
+    return "{" + text + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, label_values):
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"指标{self.name}标签数量错误: {label_values}")
+        return tuple(label_values)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.metric_type}")
+        self._render_samples(lines)
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, lines):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+
+
+class Gauge(_Metric):
+    """
+    仪表, 可直接设置数值, 或注册在导出时调用的取值函数
+    取值函数返回 [(标签值元组, 数值), ...]
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _render_samples(self, lines):
+        with self._lock:
+            items = list(self._values.items())
+        if self._function is not None:
+            try:
+                items.extend((tuple(key), value) for key, value in self._function())
+            except Exception:
+                pass
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_SECONDS_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数(含+Inf), 总和]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def _render_samples(self, lines):
+        with self._lock:
+            items = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+
+
+def render_metrics():
+    """
+    导出全部指标, Prometheus 文本格式
+    """
+    lines = []
+    for metric in list(_registry):
+        metric.render(lines)
+    lines.append("")
+    return "\n".join(lines)
+
+
+# 规划
+PLAN_SECONDS = Histogram("liquid_plan_seconds", "Planning time per endpoint, excluding robot execution", ("endpoint",))
+PLAN_COMMANDS = Histogram("liquid_plan_commands", "Commands per submitted robot program", (),
+                          buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+PLAN_OPERATIONS = Counter("liquid_plan_operations_total", "Submitted robot commands by operation type", ("operation",))
+
+# 机器人
+ROBOT_SUBMIT_SECONDS = Histogram("robot_submit_seconds", "Robot program submit latency")
+ROBOT_COMPLETION_SECONDS = Histogram("robot_completion_seconds", "Time from robot program submit to completion")
+ROBOT_POLL_COUNT = Histogram("robot_poll_count", "Completion polls per robot instruction", (),
+                             buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+ROBOT_SUBMIT_BYTES = Histogram("robot_submit_bytes", "Robot program request body size on the wire", (),
+                               buckets=(1024, 8192, 65536, 262144, 1048576, 4194304))
+
+# 数据库
+DB_QUERY_SECONDS = Histogram("db_status_query_seconds", "Instance status query latency")
+
+# 回调
+CALLBACK_RETRIES = Counter("callback_retries_total", "Callback delivery retries", ("target",))
+CALLBACK_FAILURES = Counter("callback_failures_total", "Callbacks given up after all retries", ("target",))
+CALLBACK_DELIVERY_SECONDS = Histogram("callback_delivery_seconds", "Time from callback enqueue to successful delivery", ("target",))
+CALLBACK_OUTBOX_PENDING = Gauge("callback_outbox_pending", "Callbacks waiting in the outbox", ("target",))
+
+# 设备与物料
+TASKS_INFLIGHT = Gauge("liquid_tasks_inflight", "Tasks accepted and not yet finished")
+REQUESTS_REJECTED = Counter("liquid_requests_rejected_total", "Requests rejected by schema validation", ("endpoint",))
+TASKS_DUPLICATE = Counter("liquid_tasks_duplicate_total", "Resubmitted task IDs answered without re-running", ("state",))
+TIPS_REMAINING = Gauge("liquid_tips_remaining", "Unused tips in the tip boxes")
+STOCK_VOLUME = Gauge("liquid_stock_volume_ml", "Remaining stock solution volume", ("solution_type", "location"))
+
+# 多设备调度
+FLEET_QUEUE_DEPTH = Gauge("fleet_queue_depth", "Experiments waiting for an eligible device")
+FLEET_QUEUE_WAIT_SECONDS = Histogram("fleet_queue_wait_seconds", "Time from fleet submit to dispatch", ("device",))
+FLEET_DISPATCHED = Counter("fleet_dispatched_total", "Experiments dispatched per device", ("device",))
+FLEET_DEVICE_TIPS = Gauge("fleet_device_tips_remaining", "Unused tips per device", ("device",))
+FLEET_DEVICE_STOCK = Gauge("fleet_device_stock_volume_ml", "Remaining stock solution volume per device",
+                           ("device", "solution_type", "location"))
+FLEET_CALLBACK_OUTBOX_PENDING = Gauge("fleet_callback_outbox_pending", "Callbacks waiting in each device's outbox",
+                                      ("device", "target"))
@@ -4,7 +4,11 @@ import time
 from flask import jsonify
 
 from getway_base import GetwayBase
-from logger_handler import create_logger
+import metrics
+from logger_handler import create_logger, new_log_context
+from request_schema import RequestError, decode_request
+from task_registry import INTERRUPTED, RUNNING
+from tracing import span, start_trace
 
 import traceback
 
@@ -12,10 +16,21 @@ import traceback
 log = create_logger("INFO", "OperateWrapper")
 class CommonTask:
     common_task_id = -1
+
+def _run_traced(task_id, wrapper, *args):
+    """
+    在任务上下文中开始追踪, 整个任务记录为一个span
+    """
+    start_trace(task_id)
+    with span("task", endpoint=args[-1].__name__):
+        return wrapper(*args)
+
 def _wrap_task(gateway:GetwayBase, task_id, param, func):
+    metrics.TASKS_INFLIGHT.inc()
     try:
         gateway.machine_status.increase()
-        ret, msg, data = func(task_id, param)
+        with span("execute", endpoint=func.__name__):
+            ret, msg, data = func(task_id, param)
         log.info(f"执行结果 ret:{ret}")
         if ret is True:
             gateway.http_callback(task_id, 200, data=data, msg="操作成功")
@@ -28,11 +43,14 @@ def _wrap_task(gateway:GetwayBase, task_id, param, func):
         log.error(stack_str)
     finally:
         gateway.machine_status.decrease()
+        metrics.TASKS_INFLIGHT.dec()
 
 def _wrap_task_context(gateway:GetwayBase, task_id, param, context, func):
+    metrics.TASKS_INFLIGHT.inc()
     try:
         gateway.machine_status.increase()
-        ret, msg, data = func(task_id, param, context)
+        with span("execute", endpoint=func.__name__):
+            ret, msg, data = func(task_id, param, context)
         log.info(f"执行结果 ret:{ret}")
         if ret is True:
             gateway.http_callback(task_id, 200, data=data, msg="操作成功")
@@ -45,11 +63,16 @@ def _wrap_task_context(gateway:GetwayBase, task_id, param, context, func):
         log.error(stack_str)
     finally:
         gateway.machine_status.decrease()
+        metrics.TASKS_INFLIGHT.dec()
 
-def _wrap_task_sync(gateway:GetwayBase, task_id, param, func):
+def _wrap_task_sync(gateway:GetwayBase, task_id, param, func, acquired=False):
+    """
+    同步执行, 不修改设备状态; acquired 为True时调用方已占用设备, 执行完成后释放
+    """
+    data = None
     try:
-        gateway.machine_status.increase()
-        ret, msg, data = func(task_id, param)
+        with span("execute", endpoint=func.__name__):
+            ret, msg, data = func(task_id, param)
         log.info(f"执行结果 ret:{ret}")
         if ret:
             return 200, msg, data
@@ -59,12 +82,15 @@ def _wrap_task_sync(gateway:GetwayBase, task_id, param, func):
         log.error(f"操作失败:{str(e)}")
         return 500, str(e), data
     finally:
-        gateway.machine_status.decrease()
+        if acquired:
+            gateway.machine_status.decrease()
 
 def _wrap_task_var(gateway:GetwayBase, task_id, param, func):
+    metrics.TASKS_INFLIGHT.inc()
     try:
         gateway.machine_status.increase()
-        ret, msg, data, vars = func(task_id, param)
+        with span("execute", endpoint=func.__name__):
+            ret, msg, data, vars = func(task_id, param)
         log.info(f"执行结果 ret:{ret}")
         if ret is True:
             gateway.http_callback(task_id, 200, data=data, msg="操作成功", vars=vars)
@@ -75,10 +101,13 @@ def _wrap_task_var(gateway:GetwayBase, task_id, param, func):
         gateway.http_callback(task_id=task_id, code=500, data=None, msg=f"{str(e)}")
     finally:
         gateway.machine_status.decrease()
+        metrics.TASKS_INFLIGHT.dec()
 
 def _warp_task_not_lock(gateway:GetwayBase, task_id, param, func):
+    metrics.TASKS_INFLIGHT.inc()
     try:
-        ret, msg, data = func(task_id, param)
+        with span("execute", endpoint=func.__name__):
+            ret, msg, data = func(task_id, param)
         log.info(f"执行结果 ret:{ret}")
         if ret is True:
             gateway.http_callback(task_id, 200, data=data, msg="操作成功")
@@ -89,43 +118,99 @@ def _warp_task_not_lock(gateway:GetwayBase, task_id, param, func):
         gateway.http_callback(task_id=task_id, code=500, data=None, msg=f"{str(e)}")
     finally:
         gateway.machine_status.reset()
+        metrics.TASKS_INFLIGHT.dec()
 
-def operate_not_lock(gateway:GetwayBase, data, function):
-    if isinstance(data, bytes):
-        json_str = data.decode('utf-8')  # 字节 → 字符串
-    else:
-        json_str = data  # 直接使用字符串
-    json_data = json.loads(json_str)
-    task_id = json_data.get('id', 10001)
-    param = json_data.get('param', {})
-    if "settings" in param:
-        settings = param["settings"]
-        param = settings[0]
+def operate_not_lock(gateway:GetwayBase, data, function, schema=None):
+    try:
+        task_request = decode_task_request(data, schema, default_id=10001)
+    except RequestError as e:
+        return jsonify(reject_request(e.task_id, function, e)), 200
+    task_id = task_request.task_id
+    param = task_request.param
     response = {
         'id': task_id,
         'msg': round(time.time() * 1000),
         'code': 200
     }
-    threading.Thread(target=_warp_task_not_lock, args=(gateway, task_id, param, function)).start()
+    task_context = new_log_context(task_id=task_id)
+    threading.Thread(target=task_context.run, args=(_run_traced, task_id, _warp_task_not_lock, gateway, task_id, param, function), name=f"task-{task_id}").start()
     return jsonify(response), 200
 
-def operate(gateway:GetwayBase, data, function, have_vars=False, use_context=False): 
-    if isinstance(data, bytes):
-        json_str = data.decode('utf-8')  # 字节 → 字符串
+def decode_task_request(data, schema=None, default_id=None):
+    """
+    解码并校验请求, 返回 TaskRequest
+    格式错误时抛出 RequestError, 已解码出任务编号时记录在异常的 task_id 中
+    """
+    task_request = decode_request(data, default_id)
+    if schema is not None:
+        try:
+            schema.validate(task_request)
+        except RequestError as e:
+            e.task_id = task_request.task_id
+            raise
+    return task_request
+
+def reject_request(task_id, function, error):
+    """
+    请求格式错误, 同步返回错误, 不修改设备状态
+    """
+    message = error.args[0]
+    log.error("任务%s 请求格式错误: %s", task_id, message)
+    metrics.REQUESTS_REJECTED.inc(1, function.__name__)
+    return {
+        'id': task_id,
+        'stamp': round(time.time() * 1000),
+        'message': message,
+        'msg': message,
+        'code': error.error_code
+    }
+
+def context_ids(context):
+    """
+    上下文中的 (pipelineId, instanceId), 无上下文时返回None
+    在占用设备之前读取, 缺少字段时不修改设备状态
+    """
+    if context is None:
+        return None
+    if not isinstance(context, dict) or context.get("pipelineId") is None or context.get("instanceId") is None:
+        raise RequestError("context 缺少 pipelineId 或 instanceId")
+    return context["pipelineId"], context["instanceId"]
+
+def duplicate_response(gateway:GetwayBase, task_id, record, replay_callback=False):
+    """
+    重复提交的任务不再执行, 返回已有的状态与结果
+    replay_callback: 任务已完成时重新投递回调
+    """
+    data = record.to_dict()
+    data["duplicate"] = True
+    response = {
+        'id': task_id,
+        'stamp': round(time.time() * 1000),
+        'code': 200,
+        'data': data
+    }
+    if record.state == RUNNING:
+        message = '任务已接收, 正在执行'
+    elif record.state == INTERRUPTED:
+        response['code'] = 500
+        message = '任务在网关重启前未完成, 执行结果未知, 请确认设备状态后使用新的任务编号提交'
     else:
-        json_str = data  # 直接使用字符串
-    json_data = json.loads(json_str)
-    task_id = json_data['id']
-    param = json_data.get('param', {})
-    if param and "settings" in param:
-        settings = param["settings"]
-        param = settings[0]
-
-    context = json_data.get("context", None)
-    if context is not None:
-        gateway.pipeline_id = context["pipelineId"]
-        gateway.instance_id = context["instanceId"]
+        message = '任务已完成'
+        if replay_callback and record.callback is not None:
+            data["callbackReplayed"] = gateway.replay_callback(task_id, record.callback) > 0
+    response['message'] = message
+    response['msg'] = message
+    log.info("任务%s 重复提交, 状态%s, 不再执行", task_id, record.state)
+    metrics.TASKS_DUPLICATE.inc(1, record.state)
+    return response
 
+def accept_task(gateway:GetwayBase, task_id, param, context, function, have_vars=False, use_context=False,
+                dedupe=False, replay_callback=False):
+    """
+    设备空闲时接收任务并启动任务线程, 返回响应内容
+    设备忙碌时不修改当前任务的实例信息
+    dedupe: 已接收过的任务编号返回已有结果, 不再执行
+    """
     response = {
         'id': task_id,
         'stamp': round(time.time() * 1000),
@@ -133,37 +218,60 @@ def operate(gateway:GetwayBase, data, function, have_vars=False, use_context=Fal
         'msg':'操作成功',
         'code': 200
     }
-    if gateway.machine_status.get_machine_status() != "IDLE":
+    try:
+        ids = context_ids(context)
+    except RequestError as e:
+        return reject_request(task_id, function, e)
+    registry = gateway.task_registry if dedupe else None
+    if registry is not None:
+        record = registry.begin(task_id, function.__name__)
+        if record is not None:
+            return duplicate_response(gateway, task_id, record, replay_callback)
+    if not gateway.machine_status.try_acquire():
+        if registry is not None:
+            registry.discard(task_id)
         response["code"] = 500
         response['message'] = f"DEVICE {gateway.machine_status.get_machine_status()}"
         response['msg'] = f"DEVICE {gateway.machine_status.get_machine_status()}"
-        return jsonify(response), 200
-    
+        return response
+
+    if ids is not None:
+        gateway.pipeline_id, gateway.instance_id = ids
+
+    # 任务线程中的日志都携带任务关联信息
+    task_context = new_log_context(task_id=task_id, instance_id=context.get("instanceId") if context is not None else None)
     if not have_vars:
         if use_context:
-            threading.Thread(target=_wrap_task_context, args=(gateway, task_id, param, context, function)).start()
+            threading.Thread(target=task_context.run, args=(_run_traced, task_id, _wrap_task_context, gateway, task_id, param, context, function), name=f"task-{task_id}").start()
         else:
-            threading.Thread(target=_wrap_task, args=(gateway, task_id, param, function)).start()
+            threading.Thread(target=task_context.run, args=(_run_traced, task_id, _wrap_task, gateway, task_id, param, function), name=f"task-{task_id}").start()
     else:
-        threading.Thread(target=_wrap_task_var, args=(gateway, task_id, param, function)).start()
-    return jsonify(response), 200
+        threading.Thread(target=task_context.run, args=(_run_traced, task_id, _wrap_task_var, gateway, task_id, param, function), name=f"task-{task_id}").start()
+    return response
 
-def operate_sync(gateway:GetwayBase, data, function, have_vars=False, have_lock=True): 
-    if isinstance(data, bytes):
-        json_str = data.decode('utf-8')  # 字节 → 字符串
-    else:
-        json_str = data  # 直接使用字符串
-    json_data = json.loads(json_str)
-    task_id = json_data['id']
-    param = json_data.get('param', {})
-    if param and "settings" in param:
-        settings = param["settings"]
-        param = settings[0]
-
-    context = json_data.get("context", None)
-    if context is not None:
-        gateway.pipeline_id = context["pipelineId"]
-        gateway.instance_id = context["instanceId"]
+def operate(gateway:GetwayBase, data, function, have_vars=False, use_context=False, schema=None, dedupe=False):
+    try:
+        task_request = decode_task_request(data, schema)
+    except RequestError as e:
+        return jsonify(reject_request(e.task_id, function, e)), 200
+    return jsonify(accept_task(gateway, task_request.task_id, task_request.param, task_request.context, function,
+                               have_vars, use_context, dedupe, task_request.replay_callback)), 200
+
+def operate_sync(gateway:GetwayBase, data, function, have_vars=False, have_lock=True, schema=None):
+    try:
+        task_request = decode_task_request(data, schema)
+    except RequestError as e:
+        return jsonify(reject_request(e.task_id, function, e)), 200
+    task_id = task_request.task_id
+    param = task_request.param
+
+    context = task_request.context
+    try:
+        ids = context_ids(context)
+    except RequestError as e:
+        return jsonify(reject_request(task_id, function, e)), 200
+    if ids is not None:
+        gateway.pipeline_id, gateway.instance_id = ids
 
     response = {
         'id': task_id,
@@ -172,13 +280,16 @@ def operate_sync(gateway:GetwayBase, data, function, have_vars=False, have_lock=
         'msg':'操作成功',
         'code': 200
     }
-    if have_lock and gateway.machine_status.get_machine_status() != "IDLE":
+    # 需要独占设备时占用, 只释放自己占用的状态; 查询接口不修改设备状态, 避免任务执行中被误置为空闲
+    if have_lock and not gateway.machine_status.try_acquire():
         response["code"] = 500
         response['message'] = f"DEVICE {gateway.machine_status.get_machine_status()}"
         response['msg'] = f"DEVICE {gateway.machine_status.get_machine_status()}"
         return jsonify(response), 200
     
-    code, msg, data = _wrap_task_sync(gateway, task_id, param, function)
+    task_context = new_log_context(task_id=task_id, instance_id=context.get("instanceId") if context is not None else None)
+    # 同步查询不记录追踪, 频繁轮询余量时不会挤掉长任务的追踪记录
+    code, msg, data = task_context.run(_wrap_task_sync, gateway, task_id, param, function, have_lock)
     response["code"] = code
     response['message'] = msg
     response['msg'] = msg
@@ -0,0 +1,213 @@
+"""
+规划预演
+只运行移液/排液/溶液交换的规划流程, 不消耗Tip头、不调用机器人、不修改库存,
+返回生成的指令与统计: 各类指令数量、Tip头用量、各原液瓶取液量、开盖次数和预计执行时间
+规划在网关的副本上进行, 设备执行任务时也可以预演
+
+网关接口: POST /plan?type=liquid_handling|discharge|exchange&commands=false&unlimitedTips=true, 请求体与对应任务接口相同
+命令行:   python plan_dry_run.py request.json --type exchange [--settings settings.json] [--no-commands]
+"""
+import argparse
+import copy
+import json
+import logging
+import sys
+import time
+
+import getway_base
+from operate_wrapper import decode_task_request, reject_request
+from request_schema import RequestError
+from robot_command import CommandSummary
+from robot_timing import DEFAULT_TIMING
+
+# 预演类型 -> 请求结构
+PLAN_TYPES = {
+    "liquid_handling": "setLiquidHandlingInfo",
+    "discharge": "dischargeLiquid",
+    "exchange": "setSolutionExchengeInfo"
+}
+
+# 命令行预演时规划流程的日志, 默认只输出警告以上级别
+PLANNER_LOGGERS = ("LiquidHandlingGateway", "CommonRobotGateway")
+
+
+class SnapshotTipBox:
+    """
+    Tip头盒快照, 按与实际相同的顺序取用, 只在内存中标记
+    unlimited: 余量不足时继续分配, 用于查看完整规划
+    """
+    def __init__(self, tip_boxs, unlimited=False):
+        self.total = len(tip_boxs)
+        self.free_ids = [tips_info["id"] for tips_info in tip_boxs if not tips_info["isEmpty"]]
+        self.unlimited = unlimited
+        self.used = 0
+
+    def get_one_tips(self):
+        if self.used < len(self.free_ids):
+            tips_id = self.free_ids[self.used]
+        elif self.unlimited:
+            tips_id = self.used % max(self.total, 1)
+        else:
+            return None
+        self.used += 1
+        return {"id": tips_id, "isEmpty": True}
+
+    def get_tip_count(self):
+        return self.total
+
+    def get_tip_useful_count(self):
+        return max(0, len(self.free_ids) - self.used)
+
+
+class PlanRecorder:
+    """
+    记录提交给机器人的指令, 直接返回执行成功
+    """
+    def __init__(self):
+        self.programs = []
+
+    def execute_robot_command(self, command, instance_id, pipeline_id):
+        self.programs.append(command)
+        return True
+
+
+def create_planner(gateway, unlimited_tips=False):
+    """
+    网关的规划副本: 共用台面布局与指令生成, Tip头使用当前余量的快照, 指令只记录不提交
+    """
+    planner = copy.copy(gateway)
+    # 不输出机器人执行成功的日志, 不计入规划耗时指标
+    planner.dry_run = True
+    planner.robot = copy.copy(gateway.robot)
+    recorder = PlanRecorder()
+    planner.robot.execute_robot_command = recorder.execute_robot_command
+    # 使用内存中的Tip头状态, 执行中的任务可能正在改写缓存文件
+    planner.tip_box = SnapshotTipBox(gateway.tip_box.tip_boxs_dict["tipBoxs"], unlimited_tips)
+    return planner, recorder
+
+
+def summarize(gateway, programs, tips, wait_seconds):
+    """
+    统计预演生成的指令
+    """
+    source_table = {(bottle.suck_command, bottle.location): bottle.no for bottle in gateway.deck.bottles}
+    commands = [command for program in programs for command in program]
+    volume_per_source = {}
+    discharge_volume = 0
+    lid_cycles = {}
+    for command in commands:
+        operation = command.operation
+        if operation.startswith("suck_from_"):
+            if command.source_workstation == gateway.material_station:
+                bottle_no = source_table.get((operation, command.source_no))
+                volume_per_source[bottle_no] = volume_per_source.get(bottle_no, 0) + command.tool_arg
+            else:
+                discharge_volume += command.tool_arg
+        elif operation.startswith("open_") and not operation.endswith("_take"):
+            # 物料站原液瓶开盖分为放入和取出两条指令, 只计一次
+            lid_cycles[operation] = lid_cycles.get(operation, 0) + 1
+    program_seconds = [DEFAULT_TIMING.estimate(program) for program in programs]
+    robot_seconds = sum(program_seconds)
+    return {
+        "programs": [{"commands": len(program), "estimatedSeconds": seconds}
+                     for program, seconds in zip(programs, program_seconds)],
+        "commands": len(commands),
+        "commandsByType": CommandSummary(commands).counts(),
+        "tips": tips,
+        "volumePerSource": {str(bottle_no): volume for bottle_no, volume in sorted(volume_per_source.items())},
+        "dischargeVolume": discharge_volume,
+        "lidCycles": {"total": sum(lid_cycles.values()), "byOperation": lid_cycles},
+        "robotSeconds": robot_seconds,
+        "waitSeconds": wait_seconds,
+        "estimatedMakespanSeconds": robot_seconds + wait_seconds
+    }
+
+
+def run_plan(gateway, plan_type, param, context, unlimited_tips=False, include_commands=True):
+    """
+    预演规划, context 为已校验的上下文
+    溶液交换按循环次数依次排液、移液, 循环间的等待时间只计入预计执行时间
+    """
+    start = time.perf_counter()
+    planner, recorder = create_planner(gateway, unlimited_tips)
+    rack_containers = gateway.collect_rack_containers(context)
+    tips_before = planner.tip_box.get_tip_useful_count()
+    wait_seconds = 0
+    if plan_type == "liquid_handling":
+        ret, msg, _ = planner.set_liquid_handling_info_operate(0, param, context, rack_containers)
+    elif plan_type == "discharge":
+        ret, msg = planner.discharge_liquid_operate(0, param, context, rack_containers)
+    else:
+        ret, msg = True, "操作成功"
+        for _ in range(param["cycleCount"]):
+            ret, msg = planner.discharge_liquid_operate(0, param, context, rack_containers)
+            if ret is False:
+                break
+            ret, msg, _ = planner.set_liquid_handling_info_operate(0, param, context, rack_containers)
+            if ret is False:
+                break
+            wait_seconds += param["time"]
+    result = {
+        "type": plan_type,
+        "ok": ret,
+        "msg": msg,
+        "planMs": round((time.perf_counter() - start) * 1000, 3),
+        "tipsBefore": tips_before,
+        "tipsRemaining": planner.tip_box.get_tip_useful_count(),
+        "summary": summarize(gateway, recorder.programs, planner.tip_box.used, wait_seconds)
+    }
+    if include_commands:
+        result["commands"] = [[command.to_dict() for command in program] for program in recorder.programs]
+    return result
+
+
+def plan_request(gateway, data, plan_type, unlimited_tips=False, include_commands=True):
+    """
+    网关接口: 校验请求并预演, 返回响应内容
+    """
+    try:
+        if plan_type not in PLAN_TYPES:
+            raise RequestError(f"未知的预演类型: {plan_type}, 可选 {', '.join(PLAN_TYPES)}")
+        task_request = decode_task_request(data, gateway.request_schemas[PLAN_TYPES[plan_type]])
+    except RequestError as e:
+        return reject_request(e.task_id, run_plan, e)
+    result = run_plan(gateway, plan_type, task_request.param, task_request.context, unlimited_tips, include_commands)
+    return {
+        'id': task_request.task_id,
+        'stamp': round(time.time() * 1000),
+        'message': result["msg"],
+        'msg': result["msg"],
+        'code': 200 if result["ok"] else 500,
+        'data': result
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="规划预演, 不消耗Tip头且不调用机器人")
+    parser.add_argument("request", help="任务请求JSON文件, - 表示从标准输入读取")
+    parser.add_argument("--type", choices=list(PLAN_TYPES), default="liquid_handling")
+    parser.add_argument("--settings", default=None, help="网关配置文件, Tip头余量取自其中的 CACHE_DIR")
+    parser.add_argument("--unlimited-tips", action="store_true", help="不受当前Tip头余量限制")
+    parser.add_argument("--no-commands", action="store_true", help="只输出统计")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    getway_base.heartbeat_enable = False
+    from liquid_handling_platform import LiquidHandlingGateway
+    gateway = LiquidHandlingGateway(args.settings)
+    for name in PLANNER_LOGGERS:
+        logging.getLogger(name).setLevel(args.log_level)
+
+    if args.request == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.request, "rb") as f:
+            data = f.read()
+    response = plan_request(gateway, data, args.type, args.unlimited_tips, not args.no_commands)
+    json.dump(response, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 0 if response["code"] == 200 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+规划流程微基准测试
+用合成的容器上下文和参数驱动排液/移液规划, 机器人与Tip头读写替换为内存实现
+统计生成指令数、机器人耗时估计、内存峰值和规划耗时, 并与基线比较
+
+python planner_benchmark.py                     # 运行并与基线比较, 有回归时返回1
+python planner_benchmark.py --save-baseline     # 更新基线
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import getway_base
+from bench_workload import build_context, build_exchange_param, build_liquid_handling_param
+from robot_timing import DEFAULT_TIMING
+
+# 规划流程使用的日志, 默认只输出警告以上级别, 避免日志输出影响计时
+PLANNER_LOGGERS = ("LiquidHandlingGateway", "CommonRobotGateway")
+
+# 单次计时样本的最短时间(秒), 耗时很短的函数在一个样本内重复调用多次
+MIN_SAMPLE_SECONDS = 0.005
+
+# 参考负载与被测函数交替计时的轮数
+CALIBRATION_ROUNDS = 3
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "planner_benchmark_baseline.json")
+
+# 基准场景: 名称 -> (样品架放置比例, 原液瓶数量, 每架单独指定排液量的位置数量)
+SCENARIOS = {
+    "full_deck_all_sources": (1.0, 12, 0),
+    "full_deck_one_source": (1.0, 1, 0),
+    "half_deck_three_sources": (0.5, 3, 0),
+    "full_deck_overrides": (1.0, 12, 8),
+    "sparse_deck_all_sources": (0.15, 12, 2)
+}
+
+
+class BenchmarkTipBox:
+    """
+    内存中的Tip头盒, 不读写缓存文件且不会用尽
+    """
+    def __init__(self, total=192):
+        self.total = total
+        self.used = 0
+
+    def get_one_tips(self):
+        tips_info = {"id": self.used % self.total, "isEmpty": True}
+        self.used += 1
+        return tips_info
+
+    def get_tip_count(self):
+        return self.total
+
+    def get_tip_useful_count(self):
+        return self.total
+
+
+class RecordingRobot:
+    """
+    记录提交给机器人的指令, 直接返回执行成功
+    """
+    def __init__(self):
+        self.programs = []
+
+    def execute_robot_command(self, command, instance_id, pipeline_id):
+        self.programs.append(command)
+        return True
+
+    def reset(self):
+        self.programs = []
+
+
+def create_gateway(log_level="WARNING"):
+    """
+    创建不上报心跳、不投递回调的网关, 替换Tip头与机器人调用
+    任务索引与缓存文件写入临时目录, 不在工作目录中留下文件
+    """
+    getway_base.heartbeat_enable = False
+    getway_base.http_callback_enable = False
+    from liquid_handling_platform import LiquidHandlingGateway
+    workdir = tempfile.TemporaryDirectory(prefix="planner_benchmark_")
+    gateway = LiquidHandlingGateway(overrides={
+        "CACHE_DIR": workdir.name,
+        "CALLBACK_OUTBOX_PATH": os.path.join(workdir.name, "callback_outbox.db"),
+        "TASK_REGISTRY_PATH": os.path.join(workdir.name, "task_registry.db")
+    })
+    # 临时目录随网关释放时删除
+    gateway.benchmark_workdir = workdir
+    for name in PLANNER_LOGGERS:
+        logging.getLogger(name).setLevel(log_level)
+    gateway.tip_box = BenchmarkTipBox()
+    recorder = RecordingRobot()
+    gateway.robot.execute_robot_command = recorder.execute_robot_command
+    gateway.instance_id = 1
+    gateway.pipeline_id = 1
+    return gateway, recorder
+
+
+def build_cases(gateway, scenario, seed):
+    fill, sources, overrides = SCENARIOS[scenario]
+    rng = random.Random(f"{scenario}:{seed}")
+    context = build_context(gateway.deck, rng, fill)
+    liquid_param = build_liquid_handling_param(gateway.deck, rng, sources)
+    exchange_param = build_exchange_param(gateway.deck, rng, sources, overrides, cycle_count=1, sleep_time=0)
+    rack_containers = gateway.collect_rack_containers(context)
+    return {
+        "parse.containers": lambda: gateway.collect_rack_containers(context),
+        "parse.volumes": lambda: gateway.parse_all_bottle_volume_info(exchange_param),
+        "discharge": lambda: gateway.discharge_liquid_operate(0, exchange_param, context, rack_containers),
+        "liquid_handling": lambda: gateway.set_liquid_handling_info_operate(0, liquid_param, context, rack_containers)
+    }
+
+
+def calibration_workload():
+    """
+    固定的纯Python参考负载, 用于折算不同机器和不同负载下的速度差异
+    """
+    table = {}
+    for index in range(2000):
+        key = f"slot_{index % 64}"
+        table[key] = table.get(key, 0) + index
+    return sorted(table.items())
+
+
+def measure_time(function, repeats, before_call=None):
+    """
+    测量单次调用耗时(秒)列表, 耗时很短的函数在一个样本内重复调用多次
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            if before_call is not None:
+                before_call()
+            function()
+        if time.perf_counter() - start >= MIN_SAMPLE_SECONDS:
+            break
+        loops *= 2
+
+    wall = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(loops):
+                if before_call is not None:
+                    before_call()
+                function()
+            wall.append((time.perf_counter() - start) / loops)
+    finally:
+        gc.enable()
+    return wall
+
+
+def measure(function, recorder, repeats):
+    """
+    单个规划函数的统计结果
+    指令数和机器人耗时只取一次运行的结果, 规划是确定性的
+    """
+    recorder.reset()
+    function()
+    programs = recorder.programs
+    commands = sum(len(program) for program in programs)
+    robot_seconds = sum(DEFAULT_TIMING.estimate(program) for program in programs)
+
+    tracemalloc.start()
+    try:
+        recorder.reset()
+        baseline_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        peak_bytes = tracemalloc.get_traced_memory()[1] - baseline_bytes
+    finally:
+        tracemalloc.stop()
+
+    # 参考负载与被测函数交替计时, 抵消测量期间机器负载的变化
+    wall = []
+    calibration = []
+    for _ in range(CALIBRATION_ROUNDS):
+        calibration.extend(measure_time(calibration_workload, repeats))
+        wall.extend(measure_time(function, repeats, recorder.reset))
+    calibration.extend(measure_time(calibration_workload, repeats))
+
+    return {
+        "programs": len(programs),
+        "commands": commands,
+        "robot_seconds": round(robot_seconds, 3),
+        "peak_kb": round(peak_bytes / 1024, 1),
+        "wall_ms_min": round(min(wall) * 1000, 3),
+        "wall_ms_median": round(statistics.median(wall) * 1000, 3),
+        "calibration_ms": round(min(calibration) * 1000, 4)
+    }
+
+
+def run_benchmarks(scenarios, repeats, seed, log_level="WARNING"):
+    gateway, recorder = create_gateway(log_level)
+    results = {}
+    for scenario in scenarios:
+        for name, function in build_cases(gateway, scenario, seed).items():
+            results[f"{scenario}/{name}"] = measure(function, recorder, repeats)
+    return results
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, time_slack_ms=0.1):
+    """
+    与基线比较, 返回回归说明列表
+    指令数和机器人耗时估计必须一致, 耗时和内存允许一定比例的波动
+    耗时按最小值比较, 并按参考负载耗时折算到基线测量时的机器速度
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for field in ("programs", "commands", "robot_seconds"):
+            if current[field] != previous[field]:
+                regressions.append(f"{key} {field}: {previous[field]} -> {current[field]}")
+        wall_ms_min = round(current["wall_ms_min"] * previous["calibration_ms"] / current["calibration_ms"], 3)
+        if wall_ms_min > previous["wall_ms_min"] * (1 + time_tolerance) + time_slack_ms:
+            regressions.append(f"{key} wall_ms_min(折算): {previous['wall_ms_min']} -> {wall_ms_min}")
+        if current["peak_kb"] > previous["peak_kb"] * (1 + memory_tolerance):
+            regressions.append(f"{key} peak_kb: {previous['peak_kb']} -> {current['peak_kb']}")
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'场景/函数':<48} {'程序':>4} {'指令':>6} {'机器人(s)':>10} {'峰值KB':>9} {'最小ms':>9} {'中位ms':>9} {'基线ms':>9}")
+    for key, current in results.items():
+        previous = baseline.get(key, {})
+        print(f"{key:<48} {current['programs']:>4} {current['commands']:>6} {current['robot_seconds']:>10} "
+              f"{current['peak_kb']:>9} {current['wall_ms_min']:>9} {current['wall_ms_median']:>9} "
+              f"{previous.get('wall_ms_min', '-'):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="规划流程微基准测试")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="只运行指定场景, 可重复")
+    parser.add_argument("--repeats", type=int, default=20, help="每个函数的计时次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING", help="规划流程日志级别, INFO时计入日志开销")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="允许的耗时增长比例")
+    parser.add_argument("--time-slack-ms", type=float, default=0.1, help="允许的耗时绝对波动(毫秒)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="允许的内存峰值增长比例")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scenario or list(SCENARIOS), args.repeats, args.seed, args.log_level)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"基线已保存: {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.time_slack_ms)
+    if len(regressions) > 0:
+        print("发现回归:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("未发现回归")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
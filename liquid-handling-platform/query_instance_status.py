@@ -1,8 +1,13 @@
 
 
 # 数据库连接参数
-import psycopg2
-from psycopg2 import sql
+import sqlite3
+import time
+
+import metrics
+import traffic_capture
+from cooperative import run_blocking
+from tracing import traced
 
 db_params = {
     'dbname': 'aichem_worker',          # 数据库名称
@@ -13,9 +18,31 @@ db_params = {
 }
 
 class QueryInstanceStatus:
+    """
+    实例状态数据库, 每个网关一个, 同一进程中的多台设备可以使用不同的数据库
+    db_url: 例如 sqlite:///./simulator.db, 未配置时使用 db_params 中的PostgreSQL
+    """
+    def __init__(self, db_url=None):
+        # 本地模拟环境使用的SQLite数据库文件, 为空时查询PostgreSQL
+        if db_url and db_url.startswith("sqlite:///"):
+            self.sqlite_path = db_url[len("sqlite:///"):]
+        else:
+            self.sqlite_path = None
+
+    def check_sqlite_instance_status(self, instance_id):
+        try:
+            with sqlite3.connect(self.sqlite_path, timeout=5) as conn:
+                result = conn.execute("SELECT status FROM task_instance WHERE id = ?", (instance_id,)).fetchone()
+            return result[0] if result else -1
+        except sqlite3.Error as e:
+            print(f"数据库错误: {e}")
+            return -1
+
     @staticmethod
-    def check_instance_status(instance_id):
-        """检查实例状态"""
+    def check_postgres_instance_status(instance_id):
+        # 本地模拟环境使用SQLite, 只在查询PostgreSQL时导入
+        import psycopg2
+        from psycopg2 import sql
         try:
             # 连接到 PostgreSQL 数据库
             conn = psycopg2.connect(**db_params)
@@ -41,7 +68,25 @@ class QueryInstanceStatus:
             if 'conn' in locals():
                 conn.close()
 
+    @traced("db.status")
+    def check_instance_status(self, instance_id):
+        """检查实例状态"""
+        start = time.perf_counter()
+        status = -1
+        try:
+            if self.sqlite_path is not None:
+                # SQLite 无法让出执行权, 协作模式下在线程池中查询
+                status = run_blocking(self.check_sqlite_instance_status, instance_id)
+            else:
+                # 协作模式下 psycopg2 使用等待回调, 查询期间让出执行权
+                status = self.check_postgres_instance_status(instance_id)
+            return status
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.DB_QUERY_SECONDS.observe(seconds)
+            traffic_capture.record("db.status", instance_id=instance_id, status=status, seconds=round(seconds, 6))
+
 if __name__ == '__main__':
-    print(QueryInstanceStatus.check_instance_status(1518265754714114))
+    print(QueryInstanceStatus().check_instance_status(1518265754714114))
 
 
@@ -0,0 +1,280 @@
+"""
+请求解码与参数校验
+各接口的参数结构在启动时按台面布局编译为校验函数, 接收请求时在请求线程中同步校验,
+格式错误的请求直接返回错误, 不占用设备也不进入任务线程
+校验通过的上下文附带已整理的容器信息(TaskContext.rack_containers), 规划流程不再重复整理
+"""
+import json
+
+from getway_base import GateWayError
+from logger_handler import create_logger
+
+log = create_logger("INFO", "RequestSchema")
+
+# 请求格式错误时响应中的错误码
+REQUEST_ERROR_CODE = 400
+
+# 原液类型 stock_solution_type -> 原液瓶规格
+STOCK_SOLUTION_SPECS = ("4ml", "50ml", "100ml")
+
+
+class RequestError(GateWayError):
+    """
+    请求格式错误
+    task_id: 已解码出的任务编号, 请求无法解码时为空
+    """
+    def __init__(self, message, task_id=None):
+        super().__init__(message, REQUEST_ERROR_CODE)
+        self.task_id = task_id
+
+
+class TaskRequest:
+    """
+    解码后的任务请求
+    replay_callback: 重复提交已完成的任务时是否重新投递回调
+    """
+    __slots__ = ("task_id", "param", "context", "replay_callback")
+
+    def __init__(self, task_id, param, context, replay_callback=False):
+        self.task_id = task_id
+        self.param = param
+        self.context = context
+        self.replay_callback = replay_callback
+
+
+class TaskContext(dict):
+    """
+    已校验的上下文, 内容与请求中的 context 相同
+    rack_containers: 容器类型 -> 去重并排序后的逻辑编号列表(同规格全局编号, 从0开始)
+    """
+    __slots__ = ("rack_containers",)
+
+    def __init__(self, context, rack_containers):
+        super().__init__(context)
+        self.rack_containers = rack_containers
+
+
+def decode_request(data, default_id=None):
+    """
+    解码请求体, 返回 TaskRequest
+    param 为 {"settings": [...]} 时取第一组设置
+    replayCallback 为 true 时, 重复提交已完成的任务会重新投递回调
+    """
+    try:
+        json_data = json.loads(data)
+    except ValueError as e:
+        raise RequestError(f"请求不是有效的JSON: {e}")
+    if not isinstance(json_data, dict):
+        raise RequestError("请求应为JSON对象")
+    task_id = json_data.get("id", default_id)
+    if task_id is None:
+        raise RequestError("请求缺少任务编号id")
+    param = json_data.get("param") or {}
+    if not isinstance(param, dict):
+        raise RequestError("param 应为对象")
+    if "settings" in param:
+        settings = param["settings"]
+        if not isinstance(settings, list) or len(settings) == 0 or not isinstance(settings[0], dict):
+            raise RequestError("param.settings 应为非空的对象列表")
+        param = settings[0]
+    context = json_data.get("context", None)
+    if context is not None and not isinstance(context, dict):
+        raise RequestError("context 应为对象")
+    return TaskRequest(task_id, param, context, json_data.get("replayCallback") is True)
+
+
+def format_path(path):
+    """
+    path 为 (上级路径, 字段名或下标), 只在校验失败时拼接为文本
+    """
+    keys = []
+    while path is not None:
+        path, key = path
+        keys.append(key)
+    text = ""
+    for key in reversed(keys):
+        text += f"[{key}]" if isinstance(key, int) else (f".{key}" if text else key)
+    return text
+
+
+def integer(minimum=None, maximum=None):
+    describe = "整数" if minimum is None else f"不小于{minimum}的整数" if maximum is None else f"{minimum}~{maximum}的整数"
+
+    def check(value, path):
+        if type(value) is not int or (minimum is not None and value < minimum) \
+                or (maximum is not None and value > maximum):
+            raise RequestError(f"{format_path(path)} 应为{describe}, 实际为 {value!r}")
+    return check
+
+
+def number(minimum=None):
+    describe = "数值" if minimum is None else f"不小于{minimum}的数值"
+
+    def check(value, path):
+        if type(value) not in (int, float) or (minimum is not None and value < minimum):
+            raise RequestError(f"{format_path(path)} 应为{describe}, 实际为 {value!r}")
+    return check
+
+
+def list_of(item=None):
+    def check(value, path):
+        if type(value) is not list:
+            raise RequestError(f"{format_path(path)} 应为列表")
+        if item is not None:
+            for index, element in enumerate(value):
+                item(element, (path, index))
+    return check
+
+
+def obj(fields):
+    """
+    fields: 字段名 -> (校验函数, 是否必填), 校验函数为空时只检查是否存在
+    值为 null 与未填写相同
+    """
+    fields = list((name, check, required) for name, (check, required) in fields.items())
+
+    def check_obj(value, path):
+        if type(value) is not dict:
+            raise RequestError(f"{format_path(path)} 应为对象")
+        for name, check, required in fields:
+            field = value.get(name)
+            if field is None:
+                if required:
+                    raise RequestError(f"{format_path((path, name))} 不能为空")
+                continue
+            if check is not None:
+                check(field, (path, name))
+    return check_obj
+
+
+def stock_slot(deck):
+    """
+    原液瓶位置(从0开始)按原液类型对应规格的瓶数校验
+    """
+    spec_count = {spec: 0 for spec in STOCK_SOLUTION_SPECS}
+    for bottle in deck.bottles:
+        if bottle.spec in spec_count:
+            spec_count[bottle.spec] += 1
+    check_fields = obj({
+        "location": (integer(0, max(spec_count.values()) - 1), True),
+        "stock_solution_type": (integer(0, len(STOCK_SOLUTION_SPECS) - 1), True),
+        "value": (number(), True)
+    })
+
+    def check(value, path):
+        check_fields(value, path)
+        spec = STOCK_SOLUTION_SPECS[value["stock_solution_type"]]
+        count = spec_count[spec]
+        if value["location"] >= count:
+            raise RequestError(f"{format_path((path, 'location'))} 应为0~{count - 1}的整数({spec}原液瓶), "
+                               f"实际为 {value['location']!r}")
+    return check
+
+
+class ContainerNormalizer:
+    """
+    整理上下文中的容器信息, 容器组可能嵌套
+    """
+    def __init__(self, deck):
+        self.deck = deck
+
+    def normalize(self, containers):
+        if containers is None:
+            log.error("containers is None")
+            raise RequestError("上下文信息中缺少容器信息")
+        if not isinstance(containers, list):
+            raise RequestError("context.containers 应为列表")
+
+        rack_positions = {rack.container_type_code: set() for rack in self.deck.racks}
+        pending = list(containers)
+        while len(pending) > 0:
+            container = pending.pop()
+            if not isinstance(container, dict):
+                raise RequestError(f"容器信息应为对象, 实际为 {container!r}")
+            if "containers" in container:
+                pending.extend(container.get("containers") or [])
+                continue
+            container_type_code = container.get("containerTypeCode", None)
+            if container_type_code is None:
+                log.error("container_type_code is None")
+                raise RequestError("上下文信息中缺少容器类型")
+            logic_no = container.get("logicNo", None)
+            if logic_no is None:
+                log.error("logic_no is None")
+                log.error("缺少容器逻辑编号，跳过当前容器")
+                continue
+            rack = self.deck.get_rack(container_type_code)
+            if rack is None:
+                log.error(f"未知的容器类型: {container_type_code}")
+                raise RequestError("上下文信息中容器类型未定义")
+            if type(logic_no) is not int or logic_no < 1 or logic_no > rack.capacity:
+                raise RequestError(f"{container_type_code} 的容器逻辑编号应为1~{rack.capacity}的整数, 实际为 {logic_no!r}")
+            rack_positions[container_type_code].add(rack.to_position(logic_no) - 1)
+
+        return {container_type_code: sorted(positions) for container_type_code, positions in rack_positions.items()}
+
+
+class RequestSchema:
+    """
+    单个接口的请求结构
+    param: 参数校验函数, 为空时不校验
+    containers: 需要上下文时的容器整理, 为空时不要求上下文
+    """
+    def __init__(self, endpoint, param=None, containers=None):
+        self.endpoint = endpoint
+        self.param = param
+        self.containers = containers
+        self.context = obj({"pipelineId": (None, True), "instanceId": (None, True),
+                            "containers": (list_of(), True)}) if containers is not None else None
+
+    def validate(self, task_request):
+        """
+        校验请求, 需要上下文时将 context 替换为附带容器信息的 TaskContext
+        """
+        if self.param is not None:
+            self.param(task_request.param, (None, "param"))
+        if self.context is not None:
+            if task_request.context is None:
+                raise RequestError("请求缺少上下文信息context")
+            self.context(task_request.context, (None, "context"))
+            task_request.context = TaskContext(task_request.context,
+                                               self.containers.normalize(task_request.context["containers"]))
+        return task_request
+
+
+def compile_request_schemas(deck):
+    """
+    按台面布局编译各接口的请求结构, 返回 接口名 -> RequestSchema
+    """
+    volume = number(0)
+    operate = obj({
+        "operateList": (list_of(obj({
+            "originalSolutionBottle": (integer(1, deck.bottle_count), True),
+            "originalSolutionVolume": (volume, True)
+        })), True)
+    })
+    liquid_fields = {rack.operate_param: (operate, True) for rack in deck.racks}
+
+    discharge_fields = {}
+    for rack in deck.racks:
+        discharge_fields[rack.exchange_param] = (obj({
+            "defalut_rack_info": (volume, True),
+            "specified_volume": (list_of(obj({
+                "location": (integer(1, rack.capacity), True),
+                "volume": (volume, True)
+            })), False)
+        }), True)
+    exchange_fields = dict(liquid_fields)
+    exchange_fields.update(discharge_fields)
+    exchange_fields["cycleCount"] = (integer(0), True)
+    exchange_fields["time"] = (number(0), True)
+
+    containers = ContainerNormalizer(deck)
+    schemas = [
+        RequestSchema("setLiquidHandlingInfo", obj(liquid_fields), containers),
+        RequestSchema("setSolutionExchengeInfo", obj(exchange_fields), containers),
+        # 只排液, 用于规划预演
+        RequestSchema("dischargeLiquid", obj(discharge_fields), containers),
+        RequestSchema("setStockSolutionInfo", stock_slot(deck)),
+    ]
+    return {schema.endpoint: schema for schema in schemas}
@@ -0,0 +1,144 @@
+"""
+机器人指令紧凑表示
+规划阶段只记录指令字段, 提交时再直接编码为机器人接口的JSON格式
+编码时复用预先编码好的字段片段
+"""
+import json
+import sys
+from functools import lru_cache
+
+
+class RobotCommand:
+    """
+    单条机器人指令
+    operation: 指令类型
+    container_type: 容器类型, 仅move指令使用
+    source_key/target_key: 槽位类型字段名, 为空时不输出编号
+    tool_arg: 吸液量等工具参数, 为空时不输出
+    """
+    __slots__ = ("operation", "container_type", "source_key", "source_no", "source_workstation",
+                 "target_key", "target_no", "target_workstation", "tool_arg")
+
+    def __init__(self, operation, source_workstation, source_key, source_no,
+                 target_workstation, target_key=None, target_no=None, container_type=None, tool_arg=None):
+        self.operation = sys.intern(operation)
+        self.container_type = sys.intern(container_type) if container_type is not None else None
+        self.source_key = source_key
+        self.source_no = source_no
+        self.source_workstation = sys.intern(source_workstation)
+        self.target_key = target_key
+        self.target_no = target_no
+        self.target_workstation = sys.intern(target_workstation)
+        self.tool_arg = tool_arg
+
+    def to_dict(self):
+        """
+        转换为机器人接口的字典格式
+        """
+        operation = {"operation": self.operation}
+        if self.container_type is not None:
+            operation["containerTypeCode"] = self.container_type
+        source = {}
+        if self.source_key is not None:
+            source[self.source_key] = self.source_no
+        source["workstation"] = self.source_workstation
+        operation["source"] = source
+        target = {}
+        if self.target_key is not None:
+            target[self.target_key] = self.target_no
+        target["workstation"] = self.target_workstation
+        operation["target"] = target
+        if self.tool_arg is not None:
+            operation["tool_arg"] = self.tool_arg
+        return operation
+
+    def encode(self):
+        """
+        编码为紧凑JSON字符串
+        """
+        parts = [_head_fragment(self.operation, self.container_type)]
+        if self.source_key is not None:
+            parts.append(_key_fragment(self.source_key))
+            parts.append(_number(self.source_no))
+            parts.append(",")
+        parts.append(_workstation_fragment(self.source_workstation))
+        parts.append(',"target":{')
+        if self.target_key is not None:
+            parts.append(_key_fragment(self.target_key))
+            parts.append(_number(self.target_no))
+            parts.append(",")
+        parts.append(_workstation_fragment(self.target_workstation))
+        if self.tool_arg is not None:
+            parts.append(',"tool_arg":')
+            parts.append(_number(self.tool_arg))
+        parts.append("}")
+        return "".join(parts)
+
+    def __repr__(self):
+        return self.encode()
+
+
+@lru_cache(maxsize=None)
+def _head_fragment(operation, container_type):
+    head = '{"operation":' + json.dumps(operation)
+    if container_type is not None:
+        head += ',"containerTypeCode":' + json.dumps(container_type)
+    return head + ',"source":{'
+
+
+@lru_cache(maxsize=None)
+def _key_fragment(key):
+    return json.dumps(key) + ":"
+
+
+@lru_cache(maxsize=None)
+def _workstation_fragment(workstation):
+    return '"workstation":' + json.dumps(workstation) + "}"
+
+
+def _number(value):
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value)
+
+
+def encode_command(command):
+    """
+    编码单条指令, 兼容字典格式的指令
+    """
+    if isinstance(command, RobotCommand):
+        return command.encode()
+    return json.dumps(command, separators=(",", ":"))
+
+
+def encode_commands(commands):
+    """
+    编码指令列表为JSON数组字符串
+    """
+    return "[" + ",".join([encode_command(command) for command in commands]) + "]"
+
+
+class CommandSummary:
+    """
+    指令列表摘要, 按指令类型统计数量
+    仅在日志真正输出时才统计和渲染, 渲染结果按长度截断
+    """
+    __slots__ = ("commands", "max_length")
+
+    def __init__(self, commands, max_length=512):
+        self.commands = commands
+        self.max_length = max_length
+
+    def counts(self):
+        counts = {}
+        for command in self.commands:
+            operation = command.operation if isinstance(command, RobotCommand) else command.get("operation")
+            counts[operation] = counts.get(operation, 0) + 1
+        return counts
+
+    def __str__(self):
+        detail = ", ".join(f"{operation}x{count}" for operation, count in self.counts().items())
+        text = f"共{len(self.commands)}条指令: {detail}"
+        if len(text) > self.max_length:
+            return text[:self.max_length] + "..."
+        return text
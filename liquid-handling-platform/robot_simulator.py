@@ -0,0 +1,331 @@
+"""
+机器人与上位机后台模拟服务
+本地替代 192.168.110.179 上的指令下发、执行查询、任务回调、心跳和结果上传接口
+并用SQLite模拟 task_instance 表, 配合 settings_simulator.json 使用
+
+python robot_simulator.py --port 18080 --time-scale 0.001
+"""
+import argparse
+import gzip
+import itertools
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+from robot_timing import RobotTimingModel
+
+# 模拟实例强制失败时的状态码, 与 QueryInstanceStatus 一致
+INSTANCE_STATUS_FAILED = 260
+
+# 保留的最近回调数量
+MAX_CALLBACKS = 10000
+
+app = Flask(__name__)
+
+
+class RobotSimulator:
+    """
+    模拟机器人, 指令按提交顺序串行执行
+    time_scale: 实际等待时间 = 估计耗时 * time_scale
+    submit_failure_rate: 提交指令时返回500的概率
+    detail_failure_rate: 查询执行结果时返回异常的概率
+    execution_failure_rate: 指令执行失败的概率, 失败后机器人重试一次
+    回放录制流量时可预先设置每条指令的执行时间和每次回调的响应时间, 按提交顺序依次使用
+    """
+    def __init__(self, db_path, time_scale=0.001, operation_seconds=None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.instruction_ids = itertools.count(1)
+        self.random = random.Random()
+        self.init_db()
+        self.configure(time_scale=time_scale, operation_seconds=operation_seconds,
+                       submit_failure_rate=0.0, detail_failure_rate=0.0, execution_failure_rate=0.0)
+        self.reset()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS task_instance (id INTEGER PRIMARY KEY, status INTEGER NOT NULL)")
+
+    def configure(self, time_scale=None, operation_seconds=None, submit_failure_rate=None,
+                  detail_failure_rate=None, execution_failure_rate=None, seed=None):
+        with self.lock:
+            if time_scale is not None:
+                self.time_scale = float(time_scale)
+            if operation_seconds is not None or not hasattr(self, "timing"):
+                self.timing = RobotTimingModel(operation_seconds)
+            if submit_failure_rate is not None:
+                self.submit_failure_rate = float(submit_failure_rate)
+            if detail_failure_rate is not None:
+                self.detail_failure_rate = float(detail_failure_rate)
+            if execution_failure_rate is not None:
+                self.execution_failure_rate = float(execution_failure_rate)
+            if seed is not None:
+                self.random.seed(seed)
+
+    def config(self):
+        with self.lock:
+            return {
+                "time_scale": self.time_scale,
+                "operation_seconds": self.timing.operation_seconds,
+                "submit_failure_rate": self.submit_failure_rate,
+                "detail_failure_rate": self.detail_failure_rate,
+                "execution_failure_rate": self.execution_failure_rate
+            }
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.robot_free_at = self.started_at
+            # 指令编号 -> {start, done_at, failed_until, commands, robot_seconds}
+            self.instructions = {}
+            self.busy_intervals = []
+            self.callbacks = []
+            self.heartbeats = 0
+            self.last_heartbeat = None
+            self.uploads = 0
+            self.submit_failures = 0
+            self.detail_failures = 0
+            self.execution_failures = 0
+            self.scripted_robot_seconds = []
+            self.scripted_callback_seconds = []
+
+    def script(self, robot_seconds=None, callback_seconds=None):
+        """
+        设置回放时的指令执行时间和回调响应时间(秒, 已按回放速度折算)
+        """
+        with self.lock:
+            self.scripted_robot_seconds = list(robot_seconds or [])
+            self.scripted_callback_seconds = list(callback_seconds or [])
+
+    def submit(self, body):
+        """
+        接收指令列表, 返回指令编号, 提交失败返回None
+        """
+        commands = body.get("param") or []
+        robot_seconds = self.timing.estimate(commands)
+        now = time.time()
+        with self.lock:
+            if self.random.random() < self.submit_failure_rate:
+                self.submit_failures += 1
+                return None
+            if len(self.scripted_robot_seconds) > 0:
+                duration = self.scripted_robot_seconds.pop(0)
+            else:
+                duration = robot_seconds * self.time_scale
+            start = max(now, self.robot_free_at)
+            failed_until = None
+            if self.random.random() < self.execution_failure_rate:
+                # 执行失败后机器人重新执行整段指令
+                self.execution_failures += 1
+                failed_until = start + duration
+                duration *= 2
+            done_at = start + duration
+            self.robot_free_at = done_at
+            self.busy_intervals.append((start, done_at))
+            instruction_id = next(self.instruction_ids)
+            self.instructions[instruction_id] = {
+                "instance_id": body.get("instanceId"),
+                "start": start,
+                "done_at": done_at,
+                "failed_until": failed_until,
+                "commands": len(commands),
+                "robot_seconds": robot_seconds
+            }
+        return instruction_id
+
+    def detail(self, instruction_id):
+        """
+        查询指令执行结果, 返回 callbackData 字符串, 查询失败返回None
+        """
+        now = time.time()
+        with self.lock:
+            if self.random.random() < self.detail_failure_rate:
+                self.detail_failures += 1
+                return None
+            instruction = self.instructions.get(instruction_id)
+        if instruction is None:
+            return None
+        if instruction["failed_until"] is not None and instruction["start"] <= now < instruction["failed_until"]:
+            return json.dumps({"code": 500, "msg": "模拟执行失败"})
+        if now < instruction["done_at"]:
+            return ""
+        return json.dumps({"code": 200})
+
+    def next_callback_delay(self):
+        with self.lock:
+            if len(self.scripted_callback_seconds) > 0:
+                return self.scripted_callback_seconds.pop(0)
+        return 0.0
+
+    def add_callback(self, body):
+        with self.lock:
+            self.callbacks.append({"received_at": time.time(), "body": body})
+            if len(self.callbacks) > MAX_CALLBACKS:
+                del self.callbacks[:len(self.callbacks) - MAX_CALLBACKS]
+
+    def get_callbacks(self, since=0.0):
+        with self.lock:
+            return [callback for callback in self.callbacks if callback["received_at"] >= since]
+
+    def add_heartbeat(self, body):
+        with self.lock:
+            self.heartbeats += 1
+            self.last_heartbeat = body
+
+    def add_upload(self):
+        with self.lock:
+            self.uploads += 1
+
+    def set_instance_status(self, instance_id, status):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO task_instance (id, status) VALUES (?, ?)", (instance_id, status))
+
+    def stats(self):
+        """
+        统计机器人繁忙与空闲时间(秒, 模拟时间需除以 time_scale 换算为真实机器人时间)
+        """
+        now = time.time()
+        with self.lock:
+            busy = sum(max(0.0, min(end, now) - start) for start, end in self.busy_intervals if start < now)
+            elapsed = now - self.started_at
+            return {
+                "elapsed_seconds": round(elapsed, 3),
+                "busy_seconds": round(busy, 3),
+                "idle_seconds": round(elapsed - busy, 3),
+                "utilization": round(busy / elapsed, 4) if elapsed > 0 else 0.0,
+                "instructions": len(self.instructions),
+                "commands": sum(item["commands"] for item in self.instructions.values()),
+                "robot_seconds": round(sum(item["robot_seconds"] for item in self.instructions.values()), 3),
+                "callbacks": len(self.callbacks),
+                "heartbeats": self.heartbeats,
+                "last_heartbeat": self.last_heartbeat,
+                "uploads": self.uploads,
+                "submit_failures": self.submit_failures,
+                "detail_failures": self.detail_failures,
+                "execution_failures": self.execution_failures
+            }
+
+
+simulator = None
+
+
+def read_json_body():
+    data = request.get_data()
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data or b"{}")
+
+
+@app.route("/worker/instruction/common-instruction/forward", methods=["POST"])
+def forward_instruction():
+    instruction_id = simulator.submit(read_json_body())
+    if instruction_id is None:
+        return jsonify({"code": 500, "msg": "模拟下发失败", "data": None}), 500
+    return jsonify({"code": 200, "msg": "操作成功", "data": instruction_id}), 200
+
+
+@app.route("/worker/instruction/detail/<int:instruction_id>", methods=["GET"])
+def instruction_detail(instruction_id):
+    callback_data = simulator.detail(instruction_id)
+    if callback_data is None:
+        return jsonify({"code": 500, "msg": "模拟查询失败", "data": None}), 200
+    return jsonify({"code": 200, "msg": "操作成功", "data": {"id": instruction_id, "callbackData": callback_data}}), 200
+
+
+@app.route("/worker/instruction/callback", methods=["POST"])
+def instruction_callback():
+    simulator.add_callback(read_json_body())
+    delay = simulator.next_callback_delay()
+    if delay > 0:
+        time.sleep(delay)
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/worker/workstation/heartbeat", methods=["POST"])
+def workstation_heartbeat():
+    simulator.add_heartbeat(read_json_body())
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/worker/expr-result", methods=["POST"])
+def expr_result():
+    simulator.add_upload()
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/sim/stats", methods=["GET"])
+def sim_stats():
+    return jsonify(simulator.stats()), 200
+
+
+@app.route("/sim/reset", methods=["POST"])
+def sim_reset():
+    simulator.reset()
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/sim/config", methods=["GET", "POST"])
+def sim_config():
+    if request.method == "POST":
+        body = request.get_json(force=True) or {}
+        simulator.configure(**{key: body.get(key) for key in ("time_scale", "operation_seconds", "submit_failure_rate",
+                                                              "detail_failure_rate", "execution_failure_rate", "seed")})
+    return jsonify(simulator.config()), 200
+
+
+@app.route("/sim/script", methods=["POST"])
+def sim_script():
+    body = request.get_json(force=True) or {}
+    simulator.script(body.get("robot_seconds"), body.get("callback_seconds"))
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/sim/callbacks", methods=["GET"])
+def sim_callbacks():
+    since = request.args.get("since", 0.0, type=float)
+    return jsonify(simulator.get_callbacks(since)), 200
+
+
+@app.route("/sim/instance/<int:instance_id>/status", methods=["POST"])
+def sim_instance_status(instance_id):
+    body = request.get_json(force=True) or {}
+    simulator.set_instance_status(instance_id, int(body.get("status", 0)))
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+@app.route("/sim/instance/<int:instance_id>/fail", methods=["POST"])
+def sim_instance_fail(instance_id):
+    simulator.set_instance_status(instance_id, INSTANCE_STATUS_FAILED)
+    return jsonify({"code": 200, "msg": "操作成功"}), 200
+
+
+def main():
+    global simulator
+    parser = argparse.ArgumentParser(description="机器人与上位机后台模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--db", default="simulator.db", help="task_instance 模拟数据库文件")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="机器人耗时缩放比例")
+    parser.add_argument("--operation-seconds", help="指令耗时配置JSON文件, 指令名或前缀 -> 秒")
+    parser.add_argument("--submit-failure-rate", type=float, default=0.0)
+    parser.add_argument("--detail-failure-rate", type=float, default=0.0)
+    parser.add_argument("--execution-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    operation_seconds = None
+    if args.operation_seconds:
+        with open(args.operation_seconds, "r", encoding="utf-8") as f:
+            operation_seconds = json.load(f)
+    simulator = RobotSimulator(args.db, args.time_scale, operation_seconds)
+    simulator.configure(submit_failure_rate=args.submit_failure_rate, detail_failure_rate=args.detail_failure_rate,
+                        execution_failure_rate=args.execution_failure_rate, seed=args.seed)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
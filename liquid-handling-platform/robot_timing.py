@@ -0,0 +1,57 @@
+"""
+机器人动作耗时模型
+按指令类型估算机器人执行时间, 供模拟器、基准测试和规划预估共用
+"""
+from functools import lru_cache
+
+# 各类指令的估计耗时(秒), 先按完整指令名匹配, 再按前缀匹配
+DEFAULT_OPERATION_SECONDS = {
+    "move": 12.0,
+    "move_from_drip": 8.0,
+    "move_to_drip": 6.0,
+    "drip_to_recycle": 5.0,
+    "open_slot": 15.0,
+    "close_slot": 15.0,
+    "suck_from": 6.0,
+    "drip_to": 4.0
+}
+
+# 未知指令的估计耗时(秒)
+DEFAULT_SECONDS = 5.0
+
+
+class RobotTimingModel:
+    """
+    指令耗时模型
+    operation_seconds: 指令名或前缀 -> 耗时(秒), 覆盖默认值
+    """
+    def __init__(self, operation_seconds=None, default_seconds=DEFAULT_SECONDS):
+        self.operation_seconds = dict(DEFAULT_OPERATION_SECONDS)
+        if operation_seconds:
+            self.operation_seconds.update(operation_seconds)
+        self.default_seconds = default_seconds
+        # 前缀按长度倒序, 优先匹配更具体的前缀
+        self._prefixes = sorted(self.operation_seconds, key=len, reverse=True)
+        self.operation_cost = lru_cache(maxsize=None)(self._operation_cost)
+
+    def _operation_cost(self, operation):
+        seconds = self.operation_seconds.get(operation)
+        if seconds is not None:
+            return seconds
+        for prefix in self._prefixes:
+            if operation.startswith(prefix):
+                return self.operation_seconds[prefix]
+        return self.default_seconds
+
+    def estimate(self, commands):
+        """
+        估算指令列表的执行时间(秒), 兼容字典格式的指令
+        """
+        total = 0.0
+        for command in commands:
+            operation = command.get("operation") if isinstance(command, dict) else command.operation
+            total += self.operation_cost(operation)
+        return total
+
+
+DEFAULT_TIMING = RobotTimingModel()
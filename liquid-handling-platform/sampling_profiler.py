@@ -0,0 +1,123 @@
+"""
+按需采样分析器
+在运行中的网关里定时采样所有线程的调用栈, 输出 collapsed stacks 格式
+可直接交给 flamegraph.pl / speedscope 生成火焰图
+"""
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import cooperative
+
+# 单次采样最长时间(秒)
+MAX_PROFILE_SECONDS = 300
+
+# 最短采样间隔(秒)
+MIN_INTERVAL = 0.001
+
+# 保留的最近采样结果数量
+MAX_SESSIONS = 10
+
+_session_ids = itertools.count(1)
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}".replace(";", ":")
+
+
+class ProfileSession:
+    """
+    一次采样任务
+    """
+    def __init__(self, session_id, seconds, interval):
+        self.session_id = session_id
+        self.seconds = seconds
+        self.interval = interval
+        self.started_at = time.time()
+        self.finished_at = None
+        self.samples = 0
+        self.stacks = {}
+        self._thread = threading.Thread(target=self._run, name=f"sampling-profiler-{session_id}", daemon=True)
+
+    @property
+    def running(self):
+        return self.finished_at is None
+
+    def start(self):
+        if cooperative.cooperative_enable:
+            # 协作模式下线程都是greenlet, 需在真实线程中采样才能看到正在运行的greenlet
+            cooperative.original("_thread", "start_new_thread")(self._run, ())
+        else:
+            self._thread.start()
+
+    def _run(self):
+        own_ident = cooperative.original("_thread", "get_ident")()
+        sleep = cooperative.original("time", "sleep")
+        deadline = time.perf_counter() + self.seconds
+        try:
+            while time.perf_counter() < deadline:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    names.append(thread_names.get(ident, str(ident)).replace(";", ":").replace(" ", "_"))
+                    names.reverse()
+                    key = ";".join(names)
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+                sleep(self.interval)
+        finally:
+            self.finished_at = time.time()
+
+    def collapsed(self):
+        """
+        collapsed stacks 格式: 线程;栈底;...;栈顶 采样次数
+        """
+        lines = [f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + "\n"
+
+    def status(self):
+        return {
+            "id": self.session_id,
+            "running": self.running,
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "samples": self.samples,
+            "stacks": len(self.stacks)
+        }
+
+
+def start_profile(seconds, interval=0.01):
+    """
+    开始采样, 同一时间只允许一个采样任务
+    返回 (session, 错误信息)
+    """
+    seconds = min(max(float(seconds), 0.1), MAX_PROFILE_SECONDS)
+    interval = max(float(interval), MIN_INTERVAL)
+    with _sessions_lock:
+        for session in _sessions.values():
+            if session.running:
+                return None, f"采样任务{session.session_id}正在运行"
+        session = ProfileSession(next(_session_ids), seconds, interval)
+        _sessions[session.session_id] = session
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+    session.start()
+    return session, ""
+
+
+def get_profile(session_id):
+    with _sessions_lock:
+        return _sessions.get(session_id)
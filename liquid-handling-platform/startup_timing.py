@@ -0,0 +1,78 @@
+"""
+启动耗时统计
+记录网关进程从入口脚本开始到开始监听端口各阶段的耗时, 通过 /debug/startup 查看
+看门狗在网关崩溃后重启进程, 冷启动期间设备离线, 用于排查启动慢的阶段
+
+入口脚本需最先导入本模块, 计时从导入时开始; 本模块只依赖标准库, 可在协作模式打补丁之前导入
+"""
+import sys
+import time
+from contextlib import contextmanager
+
+# 可选依赖, 只在开启对应功能时导入, /debug/startup 中列出是否已加载
+OPTIONAL_MODULES = ("paho.mqtt.client", "psycopg2", "psutil", "gevent", "aiohttp", "asyncpg")
+
+_started_at = time.time()
+_start = time.perf_counter()
+_last = _start
+# 阶段名 -> [累计耗时, 次数], 多设备进程中同名阶段累加
+_phases = {}
+_ready_seconds = None
+
+
+def _add(name, seconds):
+    phase = _phases.setdefault(name, [0.0, 0])
+    phase[0] += seconds
+    phase[1] += 1
+
+
+def mark(name):
+    """
+    记录上一阶段结束到现在的耗时, 例如入口脚本导入模块的耗时
+    """
+    global _last
+    now = time.perf_counter()
+    _add(name, now - _last)
+    _last = now
+
+
+@contextmanager
+def phase(name):
+    """
+    记录代码块的耗时, 阶段之间不嵌套
+    """
+    global _last
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _last = time.perf_counter()
+        _add(name, _last - start)
+
+
+def ready():
+    """
+    启动完成, 即将开始监听端口, 返回总耗时(秒)
+    """
+    global _ready_seconds
+    mark("other")
+    _ready_seconds = time.perf_counter() - _start
+    return _ready_seconds
+
+
+def get_startup():
+    return {
+        "startedAt": round(_started_at * 1000),
+        "readySeconds": round(_ready_seconds, 6) if _ready_seconds is not None else None,
+        "phases": [{"name": name, "seconds": round(seconds, 6), "count": count}
+                   for name, (seconds, count) in _phases.items()],
+        "optionalModules": {name: name in sys.modules for name in OPTIONAL_MODULES}
+    }
+
+
+def summary():
+    """
+    单行文本, 启动完成时写入日志
+    """
+    phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, (seconds, _) in _phases.items())
+    return f"启动耗时 {(_ready_seconds or 0) * 1000:.0f}ms: {phases}"
@@ -0,0 +1,153 @@
+"""
+近期任务索引
+记录已接收任务的状态与回调内容, 上游因响应慢重发同一任务编号时返回已有结果, 不再重复执行
+内存中按最近使用保留一部分记录, 全部记录写入SQLite并按接收时间只保留最近的若干条, 重启后仍可识别重复请求
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from logger_handler import create_logger
+
+log = create_logger("INFO", "TaskRegistry")
+
+# 索引文件
+TASK_REGISTRY_PATH = "./.task_registry.db"
+
+# 磁盘上保留的任务数量
+TASK_REGISTRY_CAPACITY = 10000
+
+# 内存中缓存的任务数量
+TASK_REGISTRY_CACHE_SIZE = 256
+
+# 任务状态
+RUNNING = "RUNNING"
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+# 网关重启前未完成, 执行结果未知
+INTERRUPTED = "INTERRUPTED"
+
+
+class TaskRecord:
+    """
+    callback: 任务完成时的回调内容, 未完成时为空
+    """
+    __slots__ = ("task_id", "endpoint", "state", "accepted_at", "finished_at", "callback")
+
+    def __init__(self, task_id, endpoint, state, accepted_at, finished_at=None, callback=None):
+        self.task_id = task_id
+        self.endpoint = endpoint
+        self.state = state
+        self.accepted_at = accepted_at
+        self.finished_at = finished_at
+        self.callback = callback
+
+    def to_dict(self):
+        data = {
+            "state": self.state,
+            "endpoint": self.endpoint,
+            "acceptedAt": round(self.accepted_at * 1000),
+        }
+        if self.finished_at is not None:
+            data["finishedAt"] = round(self.finished_at * 1000)
+        if self.callback is not None:
+            data["result"] = {"code": self.callback.get("code"), "msg": self.callback.get("msg"),
+                              "data": self.callback.get("data")}
+        return data
+
+
+class TaskRegistry:
+    def __init__(self, path=TASK_REGISTRY_PATH, capacity=TASK_REGISTRY_CAPACITY, cache_size=TASK_REGISTRY_CACHE_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS task (
+                    task_id TEXT PRIMARY KEY,
+                    endpoint TEXT,
+                    state TEXT NOT NULL,
+                    accepted REAL NOT NULL,
+                    finished REAL,
+                    callback TEXT
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS task_accepted ON task (accepted)")
+            # 上次运行时未完成的任务
+            count = self._conn.execute("UPDATE task SET state = ? WHERE state = ?", (INTERRUPTED, RUNNING)).rowcount
+        if count > 0:
+            log.error("%s 个任务在网关重启前未完成, 重复提交时不会再次执行", count)
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _lookup(self, key):
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        row = self._conn.execute("SELECT endpoint, state, accepted, finished, callback FROM task WHERE task_id = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        endpoint, state, accepted, finished, callback = row
+        record = TaskRecord(key, endpoint, state, accepted, finished, json.loads(callback) if callback else None)
+        self._remember(key, record)
+        return record
+
+    def get(self, task_id):
+        with self._lock:
+            return self._lookup(str(task_id))
+
+    def begin(self, task_id, endpoint):
+        """
+        登记新任务, 任务编号已存在时返回已有记录, 否则返回None
+        """
+        key = str(task_id)
+        with self._lock:
+            record = self._lookup(key)
+            if record is not None:
+                return record
+            record = TaskRecord(key, endpoint, RUNNING, time.time())
+            with self._conn:
+                self._conn.execute("INSERT INTO task (task_id, endpoint, state, accepted) VALUES (?, ?, ?, ?)",
+                                   (key, endpoint, RUNNING, record.accepted_at))
+                self._conn.execute("DELETE FROM task WHERE accepted < (SELECT accepted FROM task "
+                                   "ORDER BY accepted DESC LIMIT 1 OFFSET ?)", (self.capacity - 1,))
+            self._remember(key, record)
+        return None
+
+    def discard(self, task_id):
+        """
+        删除登记, 用于登记后未能接收的任务
+        """
+        key = str(task_id)
+        with self._lock:
+            self._cache.pop(key, None)
+            with self._conn:
+                self._conn.execute("DELETE FROM task WHERE task_id = ?", (key,))
+
+    def finish(self, task_id, callback):
+        """
+        记录任务的回调内容, 未登记或已完成的任务忽略
+        """
+        key = str(task_id)
+        with self._lock:
+            record = self._lookup(key)
+            if record is None or record.state != RUNNING:
+                return
+            record.state = SUCCESS if callback.get("code") == 200 else FAILED
+            record.finished_at = time.time()
+            record.callback = callback
+            with self._conn:
+                self._conn.execute("UPDATE task SET state = ?, finished = ?, callback = ? WHERE task_id = ?",
+                                   (record.state, record.finished_at, json.dumps(callback, ensure_ascii=False), key))
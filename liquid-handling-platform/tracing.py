@@ -0,0 +1,146 @@
+"""
+任务阶段耗时追踪
+每个任务记录一组轻量的阶段耗时(span), 可导出为 Chrome trace JSON
+在 chrome://tracing 或 https://ui.perfetto.dev 中打开即可查看
+"""
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 内存中保留的最近任务数量, 只有在任务线程中执行的接口记录追踪, 同步查询接口不占用
+MAX_TRACES = 100
+
+# 单个任务最多记录的span数量, 防止长时间轮询占用过多内存
+MAX_EVENTS_PER_TRACE = 20000
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+
+
+class Trace:
+    """
+    单个任务的追踪记录
+    """
+    __slots__ = ("task_id", "wall_start", "perf_start", "events", "thread_names", "dropped", "lock")
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.wall_start = time.time()
+        self.perf_start = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((self.wall_start + start - self.perf_start) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            if len(self.events) >= MAX_EVENTS_PER_TRACE:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            self.thread_names[thread.ident] = thread.name
+
+    def to_chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+            dropped = self.dropped
+        pid = os.getpid()
+        metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in thread_names.items()]
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "task_id": str(self.task_id),
+                "start": self.wall_start,
+                "dropped_events": dropped
+            }
+        }
+
+
+def start_trace(task_id):
+    """
+    在当前上下文中开始一个任务的追踪
+    通常与 logger_handler.new_log_context 一起在任务上下文中调用
+    """
+    trace = Trace(task_id)
+    with _traces_lock:
+        _traces[str(task_id)] = trace
+        _traces.move_to_end(str(task_id))
+        while len(_traces) > MAX_TRACES:
+            _traces.popitem(last=False)
+    _current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(name, category="task", **args):
+    """
+    记录一个阶段的耗时, 当前上下文没有追踪时不做任何事
+    用法: with span("robot.submit", instruction=1): ...
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.perf_counter(), args)
+
+
+def record_span(name, start, category="task", **args):
+    """
+    记录从 start(time.perf_counter()) 到现在的阶段耗时, 用于不便使用 with 的长流程
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, category, start, time.perf_counter(), args)
+
+
+def traced(name, category="task"):
+    """
+    函数装饰器, 将整个函数调用记录为一个span
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return func(*args, **kwargs)
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_trace(task_id):
+    with _traces_lock:
+        trace = _traces.get(str(task_id))
+    if trace is None:
+        return None
+    return trace.to_chrome_trace()
+
+
+def list_traces():
+    with _traces_lock:
+        return [{"task_id": task_id, "start": trace.wall_start, "events": len(trace.events)}
+                for task_id, trace in _traces.items()]
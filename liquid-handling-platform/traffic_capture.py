@@ -0,0 +1,87 @@
+"""
+流量录制
+可选地将入站请求以及机器人、数据库、回调的出站交互按时间顺序追加写入录制文件
+每行一条紧凑JSON记录, 配合 traffic_replay.py 在本地模拟环境中回放
+
+记录类型:
+inbound        入站请求 path/body
+robot.submit   机器人指令提交 instance_id/commands/operations/bytes/seconds/status/instruction_id
+robot.complete 机器人指令完成 instruction_id/seconds/polls/ok
+db.status      实例状态查询 instance_id/status/seconds
+callback       任务回调 target/task_id/code/seconds/ok
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from logger_handler import get_log_context
+
+# 录制开关, 由 enable_capture 设置
+capture_enable = False
+
+# 录制文件目录
+capture_dir = "./captures"
+
+# 是否记录完整的机器人指令内容, 默认只记录统计信息
+capture_robot_body = False
+
+_capture_file = None
+_capture_lock = threading.Lock()
+
+
+def enable_capture(enable, directory=None, robot_body=False):
+    """
+    开启或关闭录制, 每次开启写入一个新的录制文件, 已按相同配置开启时不做处理
+    """
+    global capture_enable, capture_dir, capture_robot_body, _capture_file
+    with _capture_lock:
+        # 同一进程中多台设备加载相同配置时不重复创建录制文件
+        if enable and capture_enable and (directory or capture_dir) == capture_dir \
+                and bool(robot_body) == capture_robot_body:
+            return
+        if _capture_file is not None:
+            _capture_file.close()
+            _capture_file = None
+        capture_dir = directory or capture_dir
+        capture_robot_body = bool(robot_body)
+        if enable:
+            os.makedirs(capture_dir, exist_ok=True)
+            path = os.path.join(capture_dir, datetime.now().strftime("%Y%m%d_%H%M%S") + "_capture.jsonl")
+            _capture_file = open(path, "a", encoding="utf-8", buffering=1)
+        capture_enable = bool(enable)
+
+
+def record(event_type, **fields):
+    """
+    追加一条录制记录, 未开启录制时直接返回
+    自动附带当前日志上下文中的 task_id / instance_id / instruction_id, 值为None的字段不写入
+    """
+    if not capture_enable:
+        return
+    event = {"ts": round(time.time(), 6), "type": event_type}
+    event.update(get_log_context())
+    event.update((key, value) for key, value in fields.items() if value is not None)
+    line = json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=str)
+    with _capture_lock:
+        if _capture_file is not None:
+            _capture_file.write(line + "\n")
+
+
+def read_capture(path):
+    """
+    读取录制文件, 跳过写入中断导致的不完整行
+    """
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    events.sort(key=lambda event: event["ts"])
+    return events
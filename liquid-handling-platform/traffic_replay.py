@@ -0,0 +1,143 @@
+"""
+录制流量回放
+将录制文件中的入站请求按原始时间间隔重新发送到网关, 并把录制的机器人执行时间和回调耗时
+交给模拟服务按顺序复现, 用于在本地重现线上慢任务和比较规划/执行流程的改动
+
+python robot_simulator.py
+LIQUID_HANDLING_SETTINGS=settings_simulator.json python liquid_handling_platform_server.py
+python traffic_replay.py captures/20241024_093000_capture.jsonl --speed 10
+"""
+import argparse
+import json
+import statistics
+import time
+
+import requests
+
+from traffic_capture import read_capture
+
+
+def summarize_capture(events):
+    """
+    录制内容统计
+    """
+    def seconds_of(event_type, **match):
+        return [event["seconds"] for event in events if event["type"] == event_type and "seconds" in event
+                and all(event.get(key) == value for key, value in match.items())]
+
+    def describe(values):
+        if len(values) == 0:
+            return "-"
+        return f"n={len(values)} p50={statistics.median(values):.3f}s max={max(values):.3f}s"
+
+    span = events[-1]["ts"] - events[0]["ts"] if len(events) > 0 else 0.0
+    return {
+        "span_seconds": round(span, 3),
+        "inbound": sum(1 for event in events if event["type"] == "inbound"),
+        "robot_submit": describe(seconds_of("robot.submit")),
+        "robot_complete": describe(seconds_of("robot.complete", ok=True)),
+        "db_status": describe(seconds_of("db.status")),
+        "callback": describe(seconds_of("callback", target="http_callback_url"))
+    }
+
+
+class TrafficReplayer:
+    def __init__(self, gateway_url, simulator_url, speed=1.0, keep_timing=True, timeout=600.0):
+        self.gateway_url = gateway_url.rstrip("/")
+        self.simulator_url = simulator_url.rstrip("/")
+        self.speed = speed
+        self.keep_timing = keep_timing
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def prepare_simulator(self, events):
+        """
+        按录制顺序设置模拟机器人的执行时间和回调耗时
+        """
+        robot_seconds = [event["seconds"] / self.speed for event in events
+                         if event["type"] == "robot.complete" and event.get("ok")]
+        callback_seconds = [event["seconds"] / self.speed for event in events
+                            if event["type"] == "callback" and event.get("target") == "http_callback_url"]
+        self.session.post(self.simulator_url + "/sim/reset")
+        self.session.post(self.simulator_url + "/sim/script",
+                          json={"robot_seconds": robot_seconds, "callback_seconds": callback_seconds})
+
+    def replay(self, events):
+        inbound = [event for event in events if event["type"] == "inbound"]
+        if len(inbound) == 0:
+            return {"sent": 0}
+        # 录制中有回调的任务, 回放时等待其回调
+        callback_task_ids = {event.get("callback_task_id") for event in events if event["type"] == "callback"}
+
+        self.prepare_simulator(events)
+        first_ts = inbound[0]["ts"]
+        start = time.time()
+        results = []
+        for event in inbound:
+            if self.keep_timing:
+                delay = start + (event["ts"] - first_ts) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sent_at = time.time()
+            response = self.session.post(self.gateway_url + event["path"], data=event["body"].encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, timeout=self.timeout)
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            task_id = json.loads(event["body"]).get("id") if event["body"] else None
+            results.append({
+                "path": event["path"],
+                "task_id": task_id,
+                "sent_at": sent_at,
+                "accept_seconds": time.time() - sent_at,
+                "accepted": response.status_code == 200 and body.get("code") == 200
+            })
+
+        pending = {result["task_id"]: result for result in results
+                   if result["accepted"] and result["task_id"] in callback_task_ids}
+        deadline = time.time() + self.timeout
+        while len(pending) > 0 and time.time() < deadline:
+            for callback in self.session.get(self.simulator_url + "/sim/callbacks", params={"since": start}).json():
+                result = pending.pop(callback["body"].get("id"), None)
+                if result is not None:
+                    result["complete_seconds"] = callback["received_at"] - result["sent_at"]
+            time.sleep(0.1)
+
+        complete = [result["complete_seconds"] for result in results if "complete_seconds" in result]
+        robot = self.session.get(self.simulator_url + "/sim/stats").json()
+        return {
+            "sent": len(results),
+            "accepted": sum(1 for result in results if result["accepted"]),
+            "rejected": [f"{result['path']}#{result['task_id']}" for result in results if not result["accepted"]],
+            "timed_out": sorted(str(task_id) for task_id in pending),
+            "elapsed_seconds": round(time.time() - start, 3),
+            "accept_p50": round(statistics.median(result["accept_seconds"] for result in results), 4),
+            "complete_p50": round(statistics.median(complete), 3) if complete else None,
+            "complete_max": round(max(complete), 3) if complete else None,
+            "robot_busy_seconds": robot["busy_seconds"],
+            "robot_idle_seconds": robot["idle_seconds"]
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的网关流量")
+    parser.add_argument("capture", help="录制文件")
+    parser.add_argument("--gateway", default="http://127.0.0.1:6001", help="网关地址")
+    parser.add_argument("--simulator", default="http://127.0.0.1:18080", help="模拟服务地址")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放加速倍数, 请求间隔和机器人耗时都按该倍数缩短")
+    parser.add_argument("--no-timing", action="store_true", help="不保留请求间隔, 依次发送")
+    parser.add_argument("--timeout", type=float, default=600.0, help="等待回调的最长时间(秒)")
+    parser.add_argument("--summary-only", action="store_true", help="只输出录制内容统计, 不回放")
+    args = parser.parse_args()
+
+    events = read_capture(args.capture)
+    print("录制内容:", json.dumps(summarize_capture(events), ensure_ascii=False))
+    if args.summary_only:
+        return
+    replayer = TrafficReplayer(args.gateway, args.simulator, args.speed, not args.no_timing, args.timeout)
+    print("回放结果:", json.dumps(replayer.replay(events), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()